@@ -0,0 +1,123 @@
+"""
+Benchmark of the unit batching of the temporal update
+-----------------------------------------------------
+Reruns compute_trace + update_temporal (and the saves of YrA, C, S, b0, c0) of
+a finished session once per unit batch size, and reports wall time and the
+number of Dask tasks for each, against the one-unit-per-chunk layout (batch 1).
+
+The session must have been run with keep_intermediate=True, so the arrays the
+second temporal update reads (Y_fm_chk, A, b, f, C, C_chk) are still on disk.
+
+Usage
+-----
+    python benchmark_unit_batch.py /scratch/s4750098/minian_outputs/24_T2 \\
+        --batches 1 8 32 128 --minian-path /path/to/minian
+
+Results are printed and written to <output_dir>/unit_batch_benchmark.json.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+import pipeline
+from stage_manifest import MANIFEST_NAME, StageManifest, open_stage_array
+from stage_profile import scheduler_task_count
+
+BENCHMARK_NAME = "unit_batch_benchmark.json"
+# The benchmark replays this stage on the outputs of the stages before it
+REPLAY_STAGE = "second_temporal"
+
+
+def _replay_inputs(output_dir: str) -> dict:
+    """Open the latest stores of the inputs of REPLAY_STAGE from the manifest."""
+    manifest = StageManifest(os.path.join(output_dir, MANIFEST_NAME))
+    paths = {}
+    for stage in pipeline.PIPELINE_STAGES:
+        if stage.name == REPLAY_STAGE:
+            break
+        for var, entry in manifest.stages.get(stage.name, {}).get("outputs", {}).items():
+            paths[var] = entry["path"]
+    wanted = ("Y_fm_chk", "A", "b", "f", "C", "C_chk")
+    missing = [var for var in wanted if var not in paths or not os.path.exists(paths[var])]
+    if missing:
+        raise FileNotFoundError(
+            f"Stores of {missing} not found; rerun the session with keep_intermediate=True"
+        )
+    return {var: open_stage_array(paths[var]) for var in wanted}
+
+
+def run_benchmark(output_dir: str, batches: list[int], n_workers: int | None = None) -> list[dict]:
+    """Time the temporal update for every unit batch size in `batches`."""
+    from minian.cnmf import compute_trace, update_temporal
+    from minian.utilities import save_minian
+
+    output_dir = os.path.abspath(output_dir)
+    inputs = _replay_inputs(output_dir)
+    param = pipeline.default_params()["param_second_temporal"]
+    n_units = inputs["A"].sizes["unit_id"]
+    scratch = os.path.join(output_dir, "unit_batch_benchmark")
+
+    results = []
+    cluster, client = pipeline.start_cluster(n_workers)
+    try:
+        for batch in batches:
+            shutil.rmtree(scratch, ignore_errors=True)
+            os.makedirs(scratch)
+            os.environ["MINIAN_INTERMEDIATE"] = scratch
+            chunks = {"unit_id": batch, "frame": -1}
+
+            tasks_before = client.run_on_scheduler(scheduler_task_count)
+            start = time.time()
+            YrA = compute_trace(
+                inputs["Y_fm_chk"], inputs["A"], inputs["b"], inputs["C_chk"], inputs["f"]
+            ).rename("YrA")
+            YrA = save_minian(YrA, scratch, overwrite=True, chunks=chunks)
+            C, S, b0, c0, g, mask = update_temporal(inputs["A"], inputs["C"], YrA=YrA, **param)
+            for arr, name in ((C, "C"), (S, "S"), (b0, "b0"), (c0, "c0")):
+                save_minian(arr.rename(name).chunk(chunks), scratch, overwrite=True)
+            wall = time.time() - start
+            tasks = client.run_on_scheduler(scheduler_task_count) - tasks_before
+
+            results.append(
+                {
+                    "unit_batch": batch,
+                    "units": int(n_units),
+                    "unit_chunks": -(-n_units // batch),
+                    "wall_time_s": round(wall, 2),
+                    "tasks": int(tasks),
+                }
+            )
+            print(f"[benchmark] unit_batch={batch}: {wall:.1f}s, {tasks} tasks")
+            client.restart()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+        client.close()
+        cluster.close()
+
+    base = next((r for r in results if r["unit_batch"] == 1), None)
+    if base is not None:
+        for r in results:
+            r["speedup_vs_batch_1"] = round(base["wall_time_s"] / r["wall_time_s"], 2)
+            r["task_ratio_vs_batch_1"] = round(r["tasks"] / max(base["tasks"], 1), 3)
+
+    with open(os.path.join(output_dir, BENCHMARK_NAME), "w") as fh:
+        json.dump(results, fh, indent=2)
+    print(f"[benchmark] Results written to {os.path.join(output_dir, BENCHMARK_NAME)}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark unit batching of the temporal update.")
+    parser.add_argument("output_dir", help="run_pipeline output folder (run with keep_intermediate=True)")
+    parser.add_argument("--batches", nargs="+", type=int, default=[1, 8, 32, 128])
+    parser.add_argument("--n-workers", type=int, default=None)
+    parser.add_argument("--minian-path", default=".", help="folder containing the minian package")
+    args = parser.parse_args()
+
+    sys.path.append(args.minian_path)
+    pipeline.MINIAN_PATH = args.minian_path
+    run_benchmark(args.output_dir, args.batches, args.n_workers)
@@ -0,0 +1,216 @@
+"""
+Cross-session cell registration
+-------------------------------
+Tracks the same neurons across the outputs of several run_pipeline sessions
+(e.g. T1, T2, PostEx) from their footprints (`A_sparse` if present, else
+`A.zarr`) and `max_proj.zarr`:
+
+    1. every session's field of view is aligned to the first session by a rigid
+       translation of its max projection (phase correlation)
+    2. footprints are converted to one sparse (unit x pixel) matrix per session,
+       already shifted into the reference frame, with their weighted centroids
+    3. sessions are added one at a time: a KD-tree on the centroids of the cells
+       found so far gives candidate pairs within `max_dist` pixels, their footprint
+       overlap is computed for all candidates at once on the sparse matrices, and
+       pairs are accepted greedily from the highest overlap down
+
+No dense unit x unit comparison is made, so the cost grows with the number of
+nearby candidates rather than with (units x sessions)^2.
+
+Usage
+-----
+    from cell_registration import register_sessions
+    table = register_sessions(
+        ["/scratch/s4750098/minian_outputs/24_T1",
+         "/scratch/s4750098/minian_outputs/24_T2",
+         "/scratch/s4750098/minian_outputs/24_PostEx"],
+        output_csv="/scratch/s4750098/minian_outputs/24_cells.csv",
+    )
+    # one row per cell, one column per session with its unit_id (empty if not found)
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from footprint_store import UNIT_BATCH, SparseFootprints, load_footprints
+from stage_manifest import open_stage_array
+
+
+def _minian_dir(path: str) -> str:
+    """Accept a run_pipeline output folder or its minian/ sub-folder."""
+    if os.path.isdir(os.path.join(path, "minian")):
+        return os.path.join(path, "minian")
+    return path
+
+
+def fov_shift(reference: np.ndarray, image: np.ndarray) -> tuple[int, int]:
+    """Integer (height, width) shift that moves `image` onto `reference`."""
+    ref = reference - reference.mean()
+    img = image - image.mean()
+    cross = np.fft.fft2(ref) * np.conj(np.fft.fft2(img))
+    cross /= np.abs(cross) + 1e-12
+    corr = np.fft.ifft2(cross).real
+    peak = np.array(np.unravel_index(np.argmax(corr), corr.shape))
+    # Peaks past the middle are negative shifts (wrap-around)
+    size = np.array(corr.shape)
+    peak[peak > size // 2] -= size[peak > size // 2]
+    return int(peak[0]), int(peak[1])
+
+
+def _entries(A):
+    """Yield (unit row, height index, width index, value) arrays of the footprints."""
+    if isinstance(A, SparseFootprints):
+        yield A.coo()
+        return
+    for start in range(0, A.sizes["unit_id"], UNIT_BATCH):
+        block = np.asarray(A.isel(unit_id=slice(start, start + UNIT_BATCH)).values)
+        u, h, w = np.nonzero(block)
+        yield u + start, h, w, block[u, h, w]
+
+
+def sparse_footprints(A: xr.DataArray | SparseFootprints, shift: tuple[int, int] = (0, 0)):
+    """
+    Sparse (unit x pixel) CSR matrix of `A`, translated by `shift` pixels.
+
+    Returns the matrix (rows L2-normalised), the unit_ids and the weighted
+    centroids (height, width) in pixels of the shifted frame.
+    """
+    from scipy import sparse
+
+    if isinstance(A, SparseFootprints):
+        n_units, height, width = A.shape
+        unit_ids = A.unit_ids
+    else:
+        A = A.transpose("unit_id", "height", "width")
+        n_units, height, width = A.shape
+        unit_ids = A.coords["unit_id"].values
+    dh, dw = shift
+    rows, cols, vals = [np.empty(0, int)], [np.empty(0, int)], [np.empty(0, np.float32)]
+    for u, h, w, v in _entries(A):
+        h, w = h + dh, w + dw
+        inside = (h >= 0) & (h < height) & (w >= 0) & (w < width)
+        rows.append(u[inside])
+        cols.append(h[inside] * width + w[inside])
+        vals.append(v[inside])
+    mat = sparse.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_units, height * width),
+    )
+
+    weight = np.asarray(mat.sum(axis=1)).ravel()
+    pix_h, pix_w = np.divmod(np.arange(height * width), width)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroids = np.stack([mat @ pix_h / weight, mat @ pix_w / weight], axis=1)
+    norm = np.sqrt(np.asarray(mat.multiply(mat).sum(axis=1)).ravel())
+    norm[norm == 0] = 1
+    mat = sparse.diags(1 / norm) @ mat
+    return mat.tocsr(), unit_ids, centroids
+
+
+def _pair_overlap(mat_a, idx_a: np.ndarray, mat_b, idx_b: np.ndarray) -> np.ndarray:
+    """Cosine similarity of footprint pairs (mat_a[idx_a[k]], mat_b[idx_b[k]]) for all k."""
+    return np.asarray(mat_a[idx_a].multiply(mat_b[idx_b]).sum(axis=1)).ravel()
+
+
+def register_sessions(
+    sessions: list[str],
+    names: list[str] | None = None,
+    max_dist: float = 5.0,
+    min_overlap: float = 0.5,
+    output_csv: str | None = None,
+) -> pd.DataFrame:
+    """
+    Match units across sessions and return the multi-session cell index table.
+
+    Parameters
+    ----------
+    sessions : list[str]
+        run_pipeline output folders (or their minian/ folders), in time order;
+        the first one is the reference field of view.
+    names : list[str] | None
+        Column names of the sessions (default: folder names).
+    max_dist : float
+        Largest centroid distance of a candidate pair, in (downsampled) pixels.
+    min_overlap : float
+        Smallest footprint cosine similarity of an accepted pair.
+    output_csv : str | None
+        Also write the table to this CSV file.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per cell ("cell_id" index), one column per session holding the
+        unit_id of that cell in the session (<NA> where it was not found), plus
+        "n_sessions".
+    """
+    from scipy.spatial import cKDTree
+
+    dirs = [_minian_dir(os.path.abspath(s)) for s in sessions]
+    if names is None:
+        names = [os.path.basename(os.path.dirname(d)) if d.endswith("minian") else os.path.basename(d) for d in dirs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Session names must be unique, got {names}")
+
+    reference = None
+    # Per cell: latest footprint (session matrix, row) and centroid
+    cell_units: list[dict[str, int]] = []
+    cell_rows: list[tuple[int, int]] = []
+    cell_centroids = np.empty((0, 2))
+    matrices = []
+
+    for s_idx, (name, d) in enumerate(zip(names, dirs)):
+        max_proj = open_stage_array(os.path.join(d, "max_proj.zarr")).transpose("height", "width").values
+        if reference is None:
+            reference = max_proj
+        shift = fov_shift(reference, max_proj)
+        mat, unit_ids, centroids = sparse_footprints(load_footprints(d), shift)
+        matrices.append(mat)
+        valid = np.isfinite(centroids).all(axis=1)
+        print(f"[register] {name}: {len(unit_ids)} units, FOV shift {shift}")
+
+        matched = np.zeros(len(unit_ids), dtype=bool)
+        if len(cell_rows) and valid.any():
+            tree = cKDTree(cell_centroids)
+            cand = tree.query_ball_point(centroids[valid], r=max_dist)
+            new_idx = np.repeat(np.flatnonzero(valid), [len(c) for c in cand])
+            cell_idx = np.fromiter((c for cs in cand for c in cs), dtype=int, count=len(new_idx))
+            if len(new_idx):
+                # Overlap against each cell's latest footprint, grouped by its session matrix
+                cell_sess = np.array([cell_rows[c][0] for c in cell_idx])
+                cell_row = np.array([cell_rows[c][1] for c in cell_idx])
+                score = np.zeros(len(new_idx))
+                for src in np.unique(cell_sess):
+                    sel = cell_sess == src
+                    score[sel] = _pair_overlap(mat, new_idx[sel], matrices[src], cell_row[sel])
+
+                # Greedy one-to-one assignment, best overlap first
+                taken_cells = set()
+                for k in np.argsort(-score):
+                    if score[k] < min_overlap:
+                        break
+                    u, c = new_idx[k], cell_idx[k]
+                    if matched[u] or c in taken_cells:
+                        continue
+                    matched[u] = True
+                    taken_cells.add(c)
+                    cell_units[c][name] = int(unit_ids[u])
+                    cell_rows[c] = (s_idx, int(u))
+                    cell_centroids[c] = centroids[u]
+
+        new_units = np.flatnonzero(~matched & valid)
+        for u in new_units:
+            cell_units.append({name: int(unit_ids[u])})
+            cell_rows.append((s_idx, int(u)))
+        cell_centroids = np.vstack([cell_centroids, centroids[new_units]])
+        print(f"[register] {name}: {int(matched.sum())} matched, {len(new_units)} new cells")
+
+    table = pd.DataFrame(cell_units, columns=names).astype("Int64")
+    table.index.name = "cell_id"
+    table["n_sessions"] = table[names].notna().sum(axis=1)
+    if output_csv is not None:
+        table.to_csv(output_csv)
+        print(f"[register] Cell index table written to {output_csv}")
+    return table
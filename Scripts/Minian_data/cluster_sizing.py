@@ -0,0 +1,231 @@
+"""
+Resource-aware Dask cluster sizing
+----------------------------------
+Works out how many workers, threads and how much memory per worker to give the
+LocalCluster in run_pipeline, from what the job is actually allowed to use:
+
+    cores  : SLURM_CPUS_PER_TASK / SLURM_CPUS_ON_NODE, cgroup CPU quota, CPU affinity
+    memory : SLURM_MEM_PER_NODE / SLURM_MEM_PER_CPU, cgroup memory limit, MemAvailable
+
+and from the size of the input movie (after downsampling), so a small session
+does not get more workers than it has chunks to process.
+
+Usage
+-----
+    from cluster_sizing import plan_cluster
+    plan = plan_cluster("/scratch/s4750098/session_001", pattern, downsample)
+    # {"n_workers": 6, "threads_per_worker": 2, "memory_limit": "9.8GiB", ...}
+"""
+
+import math
+import os
+import re
+
+GB = 1024**3
+
+# Minian's get_optimal_chk aims for chunks of about this size (float64)
+CHUNK_BYTES = 256 * 1024**2
+# A CNMF / preprocessing task holds its input chunk, its output and temporaries
+TASK_MEMORY_FACTOR = 4
+# Memory a worker process needs besides its tasks (interpreter, libraries, buffers)
+WORKER_BASE_BYTES = 1 * GB
+# Kept free for the scheduler, the main process and the page cache
+RESERVED_FRACTION = 0.10
+RESERVED_MIN_BYTES = 2 * GB
+
+
+# ---------------------------------------------------------------------------
+# Available resources
+# ---------------------------------------------------------------------------
+
+def _read_first_line(path: str) -> str | None:
+    try:
+        with open(path, "r") as fh:
+            return fh.readline().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_cpu_limit() -> float | None:
+    # cgroup v2: "max 100000" or "200000 100000"
+    line = _read_first_line("/sys/fs/cgroup/cpu.max")
+    if line:
+        quota, _, period = line.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period)
+        return None
+    # cgroup v1
+    quota = _read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def _cgroup_memory_limit() -> int | None:
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        line = _read_first_line(path)
+        if line and line != "max":
+            limit = int(line)
+            # cgroup v1 reports a huge number when unlimited
+            if limit < 1 << 60:
+                return limit
+    return None
+
+
+def _meminfo_available() -> int | None:
+    try:
+        with open("/proc/meminfo", "r") as fh:
+            for line in fh:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def available_cpus() -> int:
+    """Number of cores this job may use (smallest of SLURM, cgroup and affinity)."""
+    candidates = []
+    for var in ("SLURM_CPUS_PER_TASK", "SLURM_CPUS_ON_NODE"):
+        if os.getenv(var, "").isdigit():
+            candidates.append(int(os.environ[var]))
+            break
+    quota = _cgroup_cpu_limit()
+    if quota:
+        candidates.append(math.floor(quota))
+    try:
+        candidates.append(len(os.sched_getaffinity(0)))
+    except AttributeError:
+        candidates.append(os.cpu_count() or 1)
+    return max(min(candidates), 1)
+
+
+def _slurm_memory(cpus: int) -> int | None:
+    # SLURM reports memory in megabytes
+    if os.getenv("SLURM_MEM_PER_NODE", "").isdigit():
+        return int(os.environ["SLURM_MEM_PER_NODE"]) * 1024**2
+    if os.getenv("SLURM_MEM_PER_CPU", "").isdigit():
+        return int(os.environ["SLURM_MEM_PER_CPU"]) * 1024**2 * cpus
+    return None
+
+
+def available_memory(cpus: int | None = None) -> int:
+    """Bytes of memory this job may use (smallest of SLURM, cgroup and MemAvailable)."""
+    cpus = cpus or available_cpus()
+    candidates = [m for m in (_slurm_memory(cpus), _cgroup_memory_limit(), _meminfo_available()) if m]
+    if not candidates:
+        return 8 * GB
+    return min(candidates)
+
+
+# ---------------------------------------------------------------------------
+# Input size
+# ---------------------------------------------------------------------------
+
+def probe_videos(dpath: str, pattern: str) -> dict:
+    """
+    Read only the headers of the videos in `dpath` matching `pattern`.
+
+    Returns {"files": n, "frames": total frame count, "height": h, "width": w,
+    "bytes": total file size}. Frame count and size come from OpenCV; if it is
+    not available they are left as None.
+    """
+    files = sorted(f for f in os.listdir(dpath) if re.search(pattern, f))
+    info = {
+        "files": len(files),
+        "frames": None,
+        "height": None,
+        "width": None,
+        "bytes": sum(os.path.getsize(os.path.join(dpath, f)) for f in files),
+    }
+    try:
+        import cv2
+    except ImportError:
+        return info
+
+    frames = 0
+    for f in files:
+        cap = cv2.VideoCapture(os.path.join(dpath, f))
+        try:
+            frames += int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            info["height"] = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            info["width"] = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        finally:
+            cap.release()
+    info["frames"] = frames
+    return info
+
+
+def movie_bytes(video: dict, downsample: dict | None = None) -> int | None:
+    """Size of the loaded movie as float64 after `downsample`, or None if unknown."""
+    if not video.get("frames"):
+        return None
+    downsample = downsample or {}
+    frames = math.ceil(video["frames"] / downsample.get("frame", 1))
+    height = math.ceil(video["height"] / downsample.get("height", 1))
+    width = math.ceil(video["width"] / downsample.get("width", 1))
+    return frames * height * width * 8
+
+
+# ---------------------------------------------------------------------------
+# Plan
+# ---------------------------------------------------------------------------
+
+def plan_cluster(
+    dpath: str | None = None,
+    pattern: str | None = None,
+    downsample: dict | None = None,
+    cpus: int | None = None,
+    memory: int | None = None,
+) -> dict:
+    """
+    Pick n_workers, threads_per_worker and memory_limit for the LocalCluster.
+
+    Parameters
+    ----------
+    dpath, pattern, downsample : optional
+        Session folder, param_load_videos["pattern"] and ["downsample"]. When
+        given, the worker count is capped by the number of chunks in the movie.
+    cpus, memory : optional
+        Override the detected core count / memory in bytes.
+
+    Returns
+    -------
+    dict with n_workers, threads_per_worker, memory_limit (string for Dask) and
+    the inputs that led to it (cpus, memory_bytes, movie_bytes).
+    """
+    cpus = cpus or available_cpus()
+    memory = memory or available_memory(cpus)
+
+    usable_mem = memory - max(memory * RESERVED_FRACTION, RESERVED_MIN_BYTES)
+    # Small nodes: eat into the reserve for a 2 GiB worker, but never past the node
+    usable_mem = min(max(usable_mem, 2 * GB), memory * (1 - RESERVED_FRACTION))
+    # One core stays with the scheduler / main process on bigger machines
+    usable_cpus = cpus - 1 if cpus > 4 else cpus
+
+    # OMP/MKL are pinned to one thread, and much of CNMF holds the GIL, so
+    # processes scale better than threads; two threads still hide I/O waits.
+    threads = 2 if usable_cpus >= 8 else 1
+    per_worker = WORKER_BASE_BYTES + threads * TASK_MEMORY_FACTOR * CHUNK_BYTES
+
+    n_workers = max(min(usable_cpus // threads, int(usable_mem // per_worker)), 1)
+
+    size = None
+    if dpath is not None and pattern is not None:
+        size = movie_bytes(probe_videos(dpath, pattern), downsample)
+        if size:
+            n_chunks = math.ceil(size / CHUNK_BYTES)
+            n_workers = max(min(n_workers, math.ceil(n_chunks / threads)), 1)
+
+    # Hand all usable memory to the workers so they spill as late as possible
+    memory_limit = usable_mem / n_workers
+    return {
+        "n_workers": int(n_workers),
+        "threads_per_worker": int(threads),
+        # GiB: Dask reads "GB" as 10**9 bytes
+        "memory_limit": f"{memory_limit / GB:.1f}GiB",
+        "cpus": int(cpus),
+        "memory_bytes": int(memory),
+        "movie_bytes": size,
+    }
@@ -0,0 +1,152 @@
+"""
+Coarse-to-fine motion estimation
+--------------------------------
+Minian's estimate_motion aligns every full-resolution frame. For miniscope
+sessions the rigid motion is smooth enough to be found on a much smaller movie:
+
+    1. coarse: estimate_motion on the movie downsampled `spatial_factor` times in
+       height/width and averaged over bins of `temporal_bin` frames; the shifts
+       are scaled back to full-resolution pixels and interpolated to every frame
+    2. fine: every frame, corrected by its coarse shift, is matched against one
+       template by phase correlation, searching only `refine_radius` pixels
+       around zero; the residual is added to the coarse shift
+
+The result has the same layout as estimate_motion (frame x shift_dim, name
+"motion"), so apply_transform and motion.zarr are unchanged. compare_motion
+reports how far the result is from a full-resolution estimate_motion run.
+"""
+
+import time
+
+import numpy as np
+import xarray as xr
+
+# Frames averaged into the fine-stage template (evenly spaced over the movie)
+TEMPLATE_FRAMES = 500
+
+
+def _parabolic(values: np.ndarray, peak: int) -> float:
+    """Sub-pixel offset of the maximum at `peak` from a parabola through its neighbours."""
+    if peak == 0 or peak == len(values) - 1:
+        return 0.0
+    left, centre, right = values[peak - 1], values[peak], values[peak + 1]
+    denom = left - 2 * centre + right
+    return 0.0 if denom == 0 else 0.5 * (left - right) / denom
+
+
+def _refine_block(block: np.ndarray, template_fft: np.ndarray, radius: int) -> np.ndarray:
+    """Residual (height, width) shift of every frame in `block` against the template."""
+    h, w = block.shape[1:]
+    cy, cx = h // 2, w // 2
+    out = np.zeros((len(block), 2))
+    for i, fm in enumerate(block):
+        cross = template_fft * np.conj(np.fft.fft2(fm))
+        cross /= np.abs(cross) + 1e-12
+        corr = np.fft.fftshift(np.fft.ifft2(cross).real)
+        win = corr[cy - radius : cy + radius + 1, cx - radius : cx + radius + 1]
+        py, px = np.unravel_index(np.argmax(win), win.shape)
+        out[i, 0] = py - radius + _parabolic(win[:, px], py)
+        out[i, 1] = px - radius + _parabolic(win[py, :], px)
+    return out
+
+
+def estimate_motion_c2f(
+    varr: xr.DataArray,
+    spatial_factor: int = 2,
+    temporal_bin: int = 5,
+    refine_radius: int | None = None,
+    **param_estimate_motion,
+) -> xr.DataArray:
+    """
+    Coarse-to-fine rigid motion estimate of `varr`.
+
+    Parameters
+    ----------
+    varr : xr.DataArray
+        Pre-processed movie (frame, height, width).
+    spatial_factor : int
+        Height/width downsampling of the coarse stage.
+    temporal_bin : int
+        Frames averaged per coarse time point.
+    refine_radius : int | None
+        Search radius of the fine stage in pixels (default spatial_factor + 2).
+    **param_estimate_motion
+        Passed on to Minian's estimate_motion for the coarse stage.
+
+    Returns
+    -------
+    xr.DataArray
+        Shifts (frame, shift_dim) in full-resolution pixels, named "motion".
+    """
+    from minian.motion_correction import apply_transform, estimate_motion
+
+    varr = varr.transpose("frame", "height", "width")
+    n_frames = varr.sizes["frame"]
+    radius = int(refine_radius if refine_radius is not None else spatial_factor + 2)
+
+    # Coarse: small, binned movie; bins must not straddle dask chunks
+    frame_chk = max(varr.data.chunksize[0] // temporal_bin, 1) * temporal_bin
+    small = (
+        varr.astype(float)
+        .chunk({"frame": frame_chk})
+        .coarsen(height=spatial_factor, width=spatial_factor, frame=temporal_bin, boundary="trim")
+        .mean()
+    )
+    coarse = estimate_motion(small, **param_estimate_motion).compute()
+    centres = np.arange(coarse.sizes["frame"]) * temporal_bin + (temporal_bin - 1) / 2
+    positions = np.arange(n_frames)
+    coarse_full = np.stack(
+        [
+            np.interp(positions, centres, coarse.sel(shift_dim=dim).values) * spatial_factor
+            for dim in ("height", "width")
+        ],
+        axis=1,
+    )
+    motion = xr.DataArray(
+        coarse_full,
+        dims=["frame", "shift_dim"],
+        coords={"frame": varr.coords["frame"].values, "shift_dim": ["height", "width"]},
+        name="motion",
+    )
+
+    # Fine: residual against one template of the coarse-corrected movie
+    corrected = apply_transform(varr, motion, fill=0).astype(float)
+    step = max(n_frames // TEMPLATE_FRAMES, 1)
+    template = corrected.isel(frame=slice(None, None, step)).mean("frame").compute()
+    template_fft = np.fft.fft2(template.transpose("height", "width").values)
+    residual = corrected.data.map_blocks(
+        _refine_block,
+        template_fft=template_fft,
+        radius=radius,
+        drop_axis=[1, 2],
+        new_axis=[1],
+        chunks=(corrected.data.chunks[0], (2,)),
+        dtype=float,
+    ).compute()
+    return (motion + residual).rename("motion")
+
+
+def compare_motion(motion: xr.DataArray, baseline: xr.DataArray) -> dict:
+    """
+    Per-dimension difference between two motion estimates, in pixels.
+
+    Both estimates are relative to their own template, so the median offset
+    between them is removed before comparing.
+    """
+    report = {}
+    for dim in ("height", "width"):
+        diff = motion.sel(shift_dim=dim).values - baseline.sel(shift_dim=dim).values
+        diff = diff - np.median(diff)
+        report[dim] = {
+            "mean_abs_px": float(np.mean(np.abs(diff))),
+            "max_abs_px": float(np.max(np.abs(diff))),
+            "rms_px": float(np.sqrt(np.mean(diff**2))),
+        }
+    return report
+
+
+def timed(fn, *args, **kwargs) -> tuple:
+    """Call fn and return (computed result, seconds)."""
+    start = time.time()
+    result = fn(*args, **kwargs).compute()
+    return result, time.time() - start
@@ -0,0 +1,140 @@
+"""
+Bounded-memory dual-layout store for the motion-corrected movie
+---------------------------------------------------------------
+CNMF needs the motion-corrected movie twice: frame-chunked (`Y_fm_chk`, whole
+frames per chunk) and pixel-chunked (`Y_hw_chk`, every frame of a spatial tile
+per chunk). Writing `Y_hw_chk` with save_minian(..., chunks=...) asks Dask to
+transpose the whole movie in one graph, which is the largest memory spike of a
+run. Here the two layouts are written in two explicit passes instead:
+
+    1. one pass over the motion-corrected movie writes `Y_fm_chk` and, from the
+       same computed chunks, a split copy chunked (frame chunk, tile), one store
+       per row of tiles; splitting a frame chunk into tiles needs no data from
+       other chunks
+    2. the split copy is consolidated tile by tile into `Y_hw_chk`; a task holds
+       exactly one output chunk, and only as many tiles run at once as fit in the
+       memory budget. Each row's split store is deleted once its tiles are
+       consolidated, so scratch use peaks at about twice the movie (plus one
+       row of tiles) instead of three times
+
+Both stores have the same layout and names as save_minian writes, so they are
+reopened by the stage runner like any other intermediate array.
+"""
+
+import os
+import shutil
+
+import numpy as np
+import xarray as xr
+
+from intermediate_store import compressor_encoding
+
+# Part of a worker's memory limit the consolidation pass may use
+BUDGET_FRACTION = 0.25
+DEFAULT_BUDGET_BYTES = 2 * 1024**3
+
+
+def _budget_bytes(memory_budget) -> int:
+    """Memory budget in bytes: explicit value, or a share of the cluster memory."""
+    if memory_budget is not None:
+        from dask.utils import parse_bytes
+
+        return int(parse_bytes(memory_budget)) if isinstance(memory_budget, str) else int(memory_budget)
+    try:
+        from dask.distributed import get_client
+
+        # n_workers=-1: by default only the first 5 workers are reported
+        workers = get_client().scheduler_info(n_workers=-1)["workers"].values()
+        total = sum(w.get("memory_limit", 0) for w in workers)
+    except (ValueError, KeyError):
+        total = 0
+    return int(total * BUDGET_FRACTION) or DEFAULT_BUDGET_BYTES
+
+
+def _to_zarr(arr: xr.DataArray, path: str, compressor=None, compute: bool = True):
+    arr.encoding = compressor_encoding(compressor)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    return arr.to_dataset().to_zarr(path, mode="w", compute=compute)
+
+
+def write_dual_layout(
+    Y: xr.DataArray,
+    fm_path: str,
+    hw_path: str,
+    hw_chunks: dict[str, int],
+    memory_budget: int | str | None = None,
+    compressor=None,
+) -> None:
+    """
+    Write `Y` frame-chunked to `fm_path` and pixel-chunked to `hw_path`.
+
+    Parameters
+    ----------
+    Y : xr.DataArray
+        Motion-corrected movie (frame, height, width), chunked along frames only.
+    fm_path, hw_path : str
+        Zarr stores for the frame-chunked and pixel-chunked layouts; the array
+        names are taken from the store names (`Y_fm_chk.zarr` -> "Y_fm_chk").
+    hw_chunks : dict
+        Tile size {"height": ..., "width": ...} of the pixel-chunked layout.
+    memory_budget : int | str | None
+        Bytes the consolidation pass may hold at once across the cluster, e.g.
+        "4GB" (default: a quarter of the total worker memory limit).
+    compressor : codec | None
+        Compressor of both stores, see intermediate_store.make_compressor
+        (default: zarr default).
+    """
+    import dask
+    import dask.array as darr
+    import zarr
+
+    fm_name = os.path.basename(fm_path)[: -len(".zarr")]
+    hw_name = os.path.basename(hw_path)[: -len(".zarr")]
+    Y = Y.transpose("frame", "height", "width")
+    ch, cw = hw_chunks["height"], hw_chunks["width"]
+    n_frames, height, width = Y.shape
+    rows = [slice(h, min(h + ch, height)) for h in range(0, height, ch)]
+    split_paths = [f"{hw_path[: -len('.zarr')]}_split{i}.zarr" for i in range(len(rows))]
+
+    # Pass 1: both the frame-chunked store and the split copy from one computation
+    print("[layout] Writing frame-chunked and split layouts in one pass ...")
+    dask.compute(
+        _to_zarr(Y.rename(fm_name), fm_path, compressor, compute=False),
+        *[
+            _to_zarr(
+                Y[:, hs, :].chunk({"height": ch, "width": cw}).rename(hw_name), path, compressor, compute=False
+            )
+            for hs, path in zip(rows, split_paths)
+        ],
+    )
+
+    # Pass 2: consolidate every tile over all frames, a budget's worth of tiles at a time
+    fm = xr.open_zarr(fm_path)[fm_name]
+    _to_zarr(
+        fm.chunk({"frame": -1, "height": ch, "width": cw}).rename(hw_name), hw_path, compressor, compute=False
+    )
+    target = zarr.open_group(hw_path, mode="r+")[hw_name]
+
+    splits = [xr.open_zarr(path)[hw_name] for path in split_paths]
+    tiles = [(i, slice(w, min(w + cw, width))) for i in range(len(rows)) for w in range(0, width, cw)]
+    tile_bytes = n_frames * ch * cw * np.dtype(Y.dtype).itemsize
+    per_batch = max(int(_budget_bytes(memory_budget) // tile_bytes), 1)
+    print(
+        f"[layout] Consolidating {len(tiles)} tiles of {tile_bytes / 1024**2:.0f} MB, "
+        f"{per_batch} at a time ..."
+    )
+    done = 0
+    for start in range(0, len(tiles), per_batch):
+        batch = tiles[start : start + per_batch]
+        darr.store(
+            [splits[i].data[:, :, ws].rechunk({0: -1}) for i, ws in batch],
+            [target] * len(batch),
+            regions=[(slice(None), rows[i], ws) for i, ws in batch],
+            lock=False,
+        )
+        # Rows whose tiles are all consolidated are no longer needed
+        finished = batch[-1][0] + (batch[-1][1].stop == width)
+        for path in split_paths[done:finished]:
+            shutil.rmtree(path)
+        done = max(done, finished)
@@ -0,0 +1,208 @@
+"""
+Sparse on-disk format for the spatial footprints A
+--------------------------------------------------
+A is a dense unit_id x height x width array, but every footprint covers only a
+small patch of the field of view. `save_sparse_footprints` stores it as CSR with
+one row per unit, where each row only holds the pixels inside that unit's
+bounding box:
+
+    A_sparse/
+        unit_id.npy   (n_units,)         unit ids, in the order of A
+        bbox.npy      (n_units, 4)       h0, h1, w0, w1 (index space, end exclusive)
+        indptr.npy    (n_units + 1,)     row pointers into indices / data
+        indices.npy   (nnz,)             pixel index inside the bbox (row-major)
+        data.npy      (nnz,)             footprint weights, in the dtype of A
+        height.npy, width.npy            coordinates of the full frame
+        meta.json                        format, shape, dtype of A
+
+The arrays are plain .npy files opened with mmap, so `SparseFootprints` reads a
+single footprint by touching only its slice of indices / data.
+
+Usage
+-----
+    from footprint_store import SparseFootprints
+    A = SparseFootprints("/scratch/s4750098/minian_outputs/24_T2/minian/A_sparse")
+    patch = A.footprint(12)               # DataArray over the unit's bounding box
+    full = A.footprint(12, dense=True)    # same, on the full frame
+    csr = A.to_scipy()                    # unit x pixel matrix for analyses
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import xarray as xr
+
+from stage_manifest import open_stage_array
+
+SPARSE_A_NAME = "A_sparse"
+FORMAT = "csr-bbox-v1"
+# Footprints are read this many units at a time from a dense A
+UNIT_BATCH = 64
+
+
+def save_sparse_footprints(A: xr.DataArray, path: str) -> str:
+    """
+    Write `A` (unit_id, height, width) to `path` in the sparse format.
+
+    The dense array is read UNIT_BATCH units at a time, so it never has to fit
+    in memory. Returns `path`.
+    """
+    A = A.transpose("unit_id", "height", "width")
+    n_units, height, width = A.shape
+    bbox = np.zeros((n_units, 4), dtype=np.int32)
+    indptr = np.zeros(n_units + 1, dtype=np.int64)
+    indices, data = [], []
+
+    for start in range(0, n_units, UNIT_BATCH):
+        block = np.asarray(A.isel(unit_id=slice(start, start + UNIT_BATCH)).values)
+        for i, fp in enumerate(block):
+            unit = start + i
+            hs, ws = np.nonzero(fp)
+            if len(hs) == 0:
+                indptr[unit + 1] = indptr[unit]
+                continue
+            h0, h1, w0, w1 = hs.min(), hs.max() + 1, ws.min(), ws.max() + 1
+            bbox[unit] = (h0, h1, w0, w1)
+            indices.append(((hs - h0) * (w1 - w0) + (ws - w0)).astype(np.int32))
+            data.append(fp[hs, ws])
+            indptr[unit + 1] = indptr[unit] + len(hs)
+
+    tmp_path = path.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    arrays = {
+        "unit_id": A.coords["unit_id"].values,
+        "bbox": bbox,
+        "indptr": indptr,
+        "indices": np.concatenate(indices) if indices else np.zeros(0, np.int32),
+        "data": np.concatenate(data) if data else np.zeros(0, A.dtype),
+        "height": A.coords["height"].values,
+        "width": A.coords["width"].values,
+    }
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), arr)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as fh:
+        json.dump(
+            {"format": FORMAT, "shape": [n_units, height, width], "dtype": str(A.dtype)},
+            fh,
+            indent=2,
+        )
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+    dense_mb = n_units * height * width * np.dtype(A.dtype).itemsize / 1024**2
+    sparse_mb = sum(a.nbytes for a in arrays.values()) / 1024**2
+    print(f"[footprints] Sparse A written to {path} ({sparse_mb:.1f} MB, dense {dense_mb:.1f} MB)")
+    return path
+
+
+class SparseFootprints:
+    """Read-only access to footprints written by save_sparse_footprints."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as fh:
+            self.meta = json.load(fh)
+        if self.meta.get("format") != FORMAT:
+            raise ValueError(f"{path} is not a {FORMAT} footprint store")
+
+        def load(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+        self.unit_ids = np.asarray(load("unit_id"))
+        self.bbox = np.asarray(load("bbox"))
+        self.indptr = np.asarray(load("indptr"))
+        self.indices = load("indices")
+        self.data = load("data")
+        self.height = np.asarray(load("height"))
+        self.width = np.asarray(load("width"))
+        self._row = {int(uid): i for i, uid in enumerate(self.unit_ids)}
+
+    def __len__(self) -> int:
+        return len(self.unit_ids)
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        return tuple(self.meta["shape"])
+
+    def _patch(self, row: int) -> np.ndarray:
+        h0, h1, w0, w1 = self.bbox[row]
+        patch = np.zeros((h1 - h0) * (w1 - w0), dtype=self.data.dtype)
+        lo, hi = self.indptr[row], self.indptr[row + 1]
+        patch[self.indices[lo:hi]] = self.data[lo:hi]
+        return patch.reshape(h1 - h0, w1 - w0)
+
+    def footprint(self, unit_id: int, dense: bool = False) -> xr.DataArray:
+        """
+        Footprint of one unit, over its bounding box (default) or the full frame.
+        Only that unit's entries are read from disk.
+        """
+        row = self._row[int(unit_id)]
+        h0, h1, w0, w1 = self.bbox[row]
+        patch = self._patch(row)
+        if dense:
+            full = np.zeros(self.shape[1:], dtype=self.data.dtype)
+            full[h0:h1, w0:w1] = patch
+            patch, h0, h1, w0, w1 = full, 0, self.shape[1], 0, self.shape[2]
+        return xr.DataArray(
+            patch,
+            dims=["height", "width"],
+            coords={"height": self.height[h0:h1], "width": self.width[w0:w1], "unit_id": int(unit_id)},
+            name="A",
+        )
+
+    def coo(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """All entries as (row, height index, width index, value) in frame index space."""
+        rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        box_w = (self.bbox[:, 3] - self.bbox[:, 2])[rows]
+        local_h, local_w = np.divmod(np.asarray(self.indices), np.maximum(box_w, 1))
+        return (
+            rows,
+            local_h + self.bbox[rows, 0],
+            local_w + self.bbox[rows, 2],
+            np.asarray(self.data),
+        )
+
+    def to_scipy(self):
+        """scipy.sparse CSR matrix (unit x height*width) of all footprints."""
+        from scipy import sparse
+
+        rows, hs, ws, vals = self.coo()
+        width = self.shape[2]
+        return sparse.csr_matrix((vals, (rows, hs * width + ws)), shape=(len(self), self.shape[1] * width))
+
+    def to_dense(self, unit_ids=None) -> xr.DataArray:
+        """Dense (unit_id, height, width) DataArray, like the original A."""
+        unit_ids = self.unit_ids if unit_ids is None else np.asarray(unit_ids)
+        out = np.zeros((len(unit_ids),) + tuple(self.shape[1:]), dtype=self.data.dtype)
+        for i, uid in enumerate(unit_ids):
+            row = self._row[int(uid)]
+            h0, h1, w0, w1 = self.bbox[row]
+            out[i, h0:h1, w0:w1] = self._patch(row)
+        return xr.DataArray(
+            out,
+            dims=["unit_id", "height", "width"],
+            coords={"unit_id": unit_ids, "height": self.height, "width": self.width},
+            name="A",
+        )
+
+
+def load_footprints(path: str):
+    """
+    Footprints from a minian output folder, an A.zarr or an A_sparse folder.
+
+    Returns a SparseFootprints when the sparse format is available, else the
+    (lazy) dense DataArray.
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(os.path.join(path, "minian")):
+        path = os.path.join(path, "minian")
+    if os.path.isdir(os.path.join(path, SPARSE_A_NAME)):
+        return SparseFootprints(os.path.join(path, SPARSE_A_NAME))
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return SparseFootprints(path)
+    if os.path.isdir(os.path.join(path, "A.zarr")):
+        path = os.path.join(path, "A.zarr")
+    return open_stage_array(path)
@@ -0,0 +1,100 @@
+"""
+Fused single-pass pre-processing
+--------------------------------
+Minian's pre-processing reads the whole movie once for the glow-removal
+min-projection and once more for denoise + background removal. Here the min
+subtraction, denoise and background removal are applied to each frame chunk by
+one function, so `varr_ref` is written in a single pass over `varr`. When the
+decoded-video cache provides the min-projection (see video_ingest.py), that
+is the only read of the raw movie.
+
+The per-frame operations are the same OpenCV calls Minian's denoise and
+remove_background make, with the same dtype handling, so `varr_ref` is unchanged.
+Other denoise / background methods fall back to Minian's functions.
+"""
+
+import numpy as np
+import xarray as xr
+
+# Denoise methods that map onto a single OpenCV call per frame
+_DENOISE_FUNCS = {
+    "gaussian": "GaussianBlur",
+    "median": "medianBlur",
+    "bilateral": "bilateralFilter",
+}
+_BACKGROUND_METHODS = ("tophat", "uniform")
+
+
+def fused_supported(param_denoise: dict, param_background_removal: dict) -> bool:
+    """True if the denoise and background settings can run in the fused path."""
+    return (
+        param_denoise.get("method") in _DENOISE_FUNCS
+        and param_background_removal.get("method") in _BACKGROUND_METHODS
+    )
+
+
+def _process_block(
+    block: np.ndarray,
+    varr_min: np.ndarray,
+    denoise_method: str,
+    denoise_kwargs: dict,
+    bg_method: str,
+    wnd: int,
+) -> np.ndarray:
+    """Glow removal, denoise and background removal of one (frame, height, width) chunk."""
+    import cv2
+    from scipy.ndimage import uniform_filter
+    from skimage.morphology import disk
+
+    denoise_func = getattr(cv2, _DENOISE_FUNCS[denoise_method])
+    selem = disk(wnd)
+    out = np.empty_like(block)
+    for i, fm in enumerate(block):
+        fm = (fm - varr_min).astype(block.dtype)
+        fm = denoise_func(fm, **denoise_kwargs).astype(block.dtype)
+        if bg_method == "tophat":
+            fm = cv2.morphologyEx(fm, cv2.MORPH_TOPHAT, selem)
+        else:
+            fm = fm - uniform_filter(fm, wnd)
+        out[i] = fm
+    return out
+
+
+def fused_preprocess(
+    varr: xr.DataArray,
+    varr_min: xr.DataArray,
+    param_denoise: dict,
+    param_background_removal: dict,
+) -> xr.DataArray:
+    """
+    Lazily apply glow removal, denoise and background removal chunk by chunk.
+
+    Parameters
+    ----------
+    varr : xr.DataArray
+        Movie (frame, height, width), already subset.
+    varr_min : xr.DataArray
+        Min-projection of `varr` over frames (height, width).
+    param_denoise, param_background_removal : dict
+        Same settings as for Minian's denoise / remove_background.
+
+    Returns
+    -------
+    xr.DataArray
+        Pre-processed movie, chunked like `varr` along frames.
+    """
+    varr = varr.transpose("frame", "height", "width").chunk({"height": -1, "width": -1})
+    varr_min = np.asarray(varr_min.transpose("height", "width").values, dtype=varr.dtype)
+    denoise_kwargs = dict(param_denoise)
+    denoise_method = denoise_kwargs.pop("method")
+
+    data = varr.data.map_blocks(
+        _process_block,
+        dtype=varr.dtype,
+        varr_min=varr_min,
+        denoise_method=denoise_method,
+        denoise_kwargs=denoise_kwargs,
+        bg_method=param_background_removal["method"],
+        wnd=param_background_removal["wnd"],
+    )
+    return varr.copy(data=data)
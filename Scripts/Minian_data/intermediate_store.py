@@ -0,0 +1,175 @@
+"""
+Managed intermediate zarr store for run_pipeline
+------------------------------------------------
+One store per session (by default `<output_dir>/minian_intermediate`) with one
+sub-folder per pipeline stage. After every stage the runner tells the store
+which arrays are still needed downstream; everything else (superseded `C`/`C_chk`
+versions, `varr` once the final video is written, Minian temp folders, ...) is
+deleted straight away instead of piling up on /scratch.
+
+The store also applies an optional compressor to every intermediate array and
+keeps track of the scratch space in use and its peak. Finished arrays can leave
+the store through promote_store (rename / hard-link instead of a rewrite).
+"""
+
+import errno
+import os
+import shutil
+
+from stage_profile import dir_size
+
+
+def zarr_format() -> int:
+    """Format of newly written stores: zarr's configured default (3 from zarr 3 on)."""
+    import zarr
+
+    if int(zarr.__version__.split(".")[0]) < 3:
+        return 2
+    return int(zarr.config.get("default_zarr_format"))
+
+
+def make_compressor(spec):
+    """
+    Build a compressor for the zarr format new stores are written in.
+
+    spec : None | str | codec
+        None keeps the zarr default. A string "<cname>[:<clevel>]" (e.g. "zstd",
+        "zstd:5", "lz4:1") gives a Blosc compressor with byte shuffle: a
+        zarr.codecs.BloscCodec for zarr format 3, a numcodecs Blosc for format 2.
+        A codec instance is returned unchanged and must suit that format.
+    """
+    if spec is None or not isinstance(spec, str):
+        return spec
+    cname, _, level = spec.partition(":")
+    if zarr_format() >= 3:
+        from zarr.codecs import BloscCodec
+
+        return BloscCodec(cname=cname, clevel=int(level or 3), shuffle="shuffle")
+    from numcodecs import Blosc
+
+    return Blosc(cname=cname, clevel=int(level or 3), shuffle=Blosc.SHUFFLE)
+
+
+def compressor_encoding(compressor) -> dict:
+    """
+    The to_zarr encoding entry for `compressor`: "compressors" with zarr-python 3,
+    whatever the format (xarray silently ignores "compressor" there), and
+    "compressor" with zarr-python 2.
+    """
+    import zarr
+
+    if compressor is None:
+        return {}
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        return {"compressors": (compressor,)}
+    return {"compressor": compressor}
+
+
+def promote_store(src: str, dst: str, link: bool = False) -> str:
+    """
+    Move the zarr store `src` to `dst` without rewriting its chunks.
+
+    A rename (or, with link=True, a tree of hard links that leaves `src` in
+    place) when both are on the same filesystem; a file-by-file streaming copy
+    otherwise. Returns how it was done: "rename", "link" or "copy".
+    """
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        if not link:
+            os.rename(src, dst)
+            return "rename"
+        shutil.copytree(src, dst, copy_function=os.link)
+        return "link"
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    shutil.rmtree(dst, ignore_errors=True)
+    shutil.copytree(src, dst)
+    if not link:
+        shutil.rmtree(src)
+    return "copy"
+
+
+class IntermediateStore:
+    """
+    Parameters
+    ----------
+    root : str
+        Folder holding the intermediate zarr stores of one session.
+    compressor : None | str | codec
+        See make_compressor.
+    keep : bool
+        Keep every intermediate array (no deletion, no cleanup at the end).
+        Useful when iterating on late-stage parameters of the same session.
+    """
+
+    def __init__(self, root: str, compressor=None, keep: bool = False):
+        self.root = os.path.abspath(root)
+        self.compressor = make_compressor(compressor)
+        self.keep = keep
+        os.makedirs(self.root, exist_ok=True)
+        self.sizes: dict[str, int] = {}
+        self.usage = dir_size(self.root)
+        self.peak = self.usage
+
+    def stage_dir(self, stage_name: str) -> str:
+        return os.path.join(self.root, stage_name)
+
+    def prepare(self, arr):
+        """Attach the configured compressor to `arr` before it is written."""
+        if self.compressor is not None:
+            encoding = {k: v for k, v in arr.encoding.items() if k not in ("compressor", "compressors")}
+            arr.encoding = {**encoding, **compressor_encoding(self.compressor)}
+        return arr
+
+    def added(self, path: str) -> None:
+        """Account for a store that was just written (or overwritten)."""
+        path = os.path.normpath(path)
+        size = dir_size(path)
+        self.usage += size - self.sizes.get(path, 0)
+        self.sizes[path] = size
+        self.peak = max(self.peak, self.usage)
+
+    def moved_out(self, path: str) -> None:
+        """Account for a store that was moved out of the intermediate store."""
+        path = os.path.normpath(path)
+        self.usage = max(self.usage - self.sizes.pop(path, 0), 0)
+
+    def release(self, keep_paths: set[str]) -> None:
+        """Delete every store under root except `keep_paths`."""
+        if self.keep or not os.path.isdir(self.root):
+            return
+        keep_paths = {os.path.normpath(p) for p in keep_paths}
+        freed = 0
+        for stage_entry in os.listdir(self.root):
+            stage_path = os.path.join(self.root, stage_entry)
+            if not os.path.isdir(stage_path):
+                freed += self._remove(stage_path)
+                continue
+            for entry in os.listdir(stage_path):
+                path = os.path.normpath(os.path.join(stage_path, entry))
+                if path not in keep_paths:
+                    freed += self._remove(path)
+            if not os.listdir(stage_path):
+                os.rmdir(stage_path)
+        if freed:
+            print(f"[store] Released {freed / 1024**3:.2f} GB of intermediate arrays")
+        self.usage = max(self.usage - freed, 0)
+
+    def cleanup(self) -> None:
+        """Remove the whole store once the session is finished."""
+        if self.keep:
+            return
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.usage = 0
+
+    def _remove(self, path: str) -> int:
+        self.sizes.pop(path, None)
+        size = dir_size(path)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        return size
@@ -0,0 +1,168 @@
+"""
+Several sessions at once on one node
+------------------------------------
+A single run_pipeline call leaves most of a big node idle during its serial
+phases (decoding, saving, single-threaded CNMF steps). run_sessions() starts one
+Dask cluster sized for the whole node and runs several sessions on it at once:
+
+    1. every session runs in its own process (Minian steers its temporary
+       stores through the MINIAN_INTERMEDIATE environment variable), with its
+       own output folder <output_root>/<session name>
+    2. memory admission: the cluster is started by pipeline.start_cluster, so
+       every worker has one "MEM" resource and the Minian TaskAnnotation plugin
+       routes Minian's memory-hungry tasks through it; at most one such task
+       runs per worker, whichever session it belongs to
+    3. interleaving: every stage is "io" or "compute" (Stage.kind), and at most
+       `io_slots` I/O stages and `compute_slots` compute stages run at a time
+       across all sessions (cluster-wide semaphores, see stage_runner.slot_gate),
+       so one session decodes or saves while the others compute
+
+A failing session is reported and does not stop the others.
+
+Usage
+-----
+    import multi_session
+    multi_session.pipeline.MINIAN_PATH = "/path/to/minian"
+    multi_session.run_sessions(
+        ["/scratch/s4750098/24_T1", "/scratch/s4750098/24_T2", "/scratch/s4750098/24_PostEx"],
+        output_root="/scratch/s4750098/minian_outputs",
+        max_concurrent=3,
+        compute_only=True,
+    )
+"""
+
+import json
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pipeline
+from cluster_sizing import plan_cluster
+
+SUMMARY_NAME = "multi_session_summary.json"
+
+
+def _run_session(kwargs: dict) -> float:
+    """Process-pool entry point: run one session on the shared cluster."""
+    import pipeline as _pipeline
+
+    _pipeline.MINIAN_PATH = kwargs.pop("minian_path")
+    start = time.time()
+    _pipeline.run_pipeline(**kwargs)
+    return time.time() - start
+
+
+def run_sessions(
+    sessions: list[str],
+    output_root: str,
+    params: dict | None = None,
+    max_concurrent: int = 3,
+    io_slots: int = 1,
+    compute_slots: int | None = None,
+    cluster_size: str | dict = "auto",
+    **pipeline_kwargs,
+) -> dict[str, dict]:
+    """
+    Run run_pipeline on several sessions concurrently on one shared cluster.
+
+    Parameters
+    ----------
+    sessions : list[str]
+        Session folders with the raw .avi videos. Their folder names must be
+        unique; they name the output folders.
+    output_root : str
+        Folder that receives one output folder per session.
+    params : dict | None
+        Parameter overrides applied to every session.
+    max_concurrent : int
+        Number of sessions in flight at the same time.
+    io_slots, compute_slots : int
+        Stages of each kind running at once across all sessions. compute_slots
+        defaults to max_concurrent - io_slots (at least 1).
+    cluster_size : "auto" | dict
+        "auto" sizes the cluster for the whole node (cluster_sizing.plan_cluster
+        without a movie); a dict is passed on to pipeline.start_cluster.
+    **pipeline_kwargs
+        Further run_pipeline arguments for every session (compute_only, resume, ...).
+
+    Returns
+    -------
+    dict
+        Session name -> {"dpath", "output_dir", "status", "runtime_s", "error"}.
+    """
+    output_root = os.path.abspath(output_root)
+    dpaths = [os.path.abspath(s) for s in sessions]
+    names = [os.path.basename(d) for d in dpaths]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Session folder names must be unique, got {names}")
+    for key in ("client", "output_dir", "intpath", "cluster_size", "stage_slots"):
+        if key in pipeline_kwargs:
+            raise ValueError(f"run_sessions sets '{key}' for every session itself")
+
+    if compute_slots is None:
+        compute_slots = max(max_concurrent - io_slots, 1)
+    stage_slots = {"io": io_slots, "compute": compute_slots}
+
+    if cluster_size == "auto":
+        plan = plan_cluster()
+        print(f"[multi] Node-wide cluster plan: {plan}")
+        cluster_kwargs = {k: plan[k] for k in ("n_workers", "threads_per_worker", "memory_limit")}
+    else:
+        cluster_kwargs = dict(cluster_size or {})
+
+    results: dict[str, dict] = {}
+    start = time.time()
+    cluster, client = pipeline.start_cluster(**cluster_kwargs)
+    try:
+        print(
+            f"[multi] Running {len(dpaths)} session(s), {max_concurrent} at a time "
+            f"(stage slots: {stage_slots}) ..."
+        )
+        with ProcessPoolExecutor(
+            max_workers=max_concurrent, mp_context=mp.get_context("spawn")
+        ) as pool:
+            futures = {}
+            for name, dpath in zip(names, dpaths):
+                output_dir = os.path.join(output_root, name)
+                job = {
+                    **pipeline_kwargs,
+                    "minian_path": pipeline.MINIAN_PATH,
+                    "dpath": dpath,
+                    "output_dir": output_dir,
+                    "params": params,
+                    "client": cluster.scheduler_address,
+                    "intpath": os.path.join(output_dir, "minian_intermediate"),
+                    "stage_slots": stage_slots,
+                }
+                futures[pool.submit(_run_session, job)] = (name, dpath, output_dir)
+
+            for future in as_completed(futures):
+                name, dpath, output_dir = futures[future]
+                entry = {"dpath": dpath, "output_dir": output_dir}
+                try:
+                    runtime = future.result()
+                    results[name] = {**entry, "status": "ok", "runtime_s": round(runtime, 1), "error": None}
+                    print(f"[multi] Session '{name}' done in {runtime / 60:.2f} min")
+                except Exception as exc:
+                    results[name] = {**entry, "status": "failed", "runtime_s": None, "error": str(exc)}
+                    print(f"[multi] ERROR: session '{name}' failed: {exc}")
+    finally:
+        client.close()
+        cluster.close()
+
+    wall = time.time() - start
+    summary = {
+        "cluster": cluster_kwargs,
+        "max_concurrent": max_concurrent,
+        "stage_slots": stage_slots,
+        "wall_time_s": round(wall, 1),
+        # Sum of the session runtimes over the wall time: the overlap achieved
+        "concurrency": round(sum(r["runtime_s"] or 0 for r in results.values()) / max(wall, 1e-9), 2),
+        "sessions": {name: results.get(name, {}) for name in names},
+    }
+    os.makedirs(output_root, exist_ok=True)
+    with open(os.path.join(output_root, SUMMARY_NAME), "w") as fh:
+        json.dump(summary, fh, indent=2, default=repr)
+    print(f"[multi] {len(results)} session(s) in {wall / 60:.2f} min; summary written to {os.path.join(output_root, SUMMARY_NAME)}")
+    return results
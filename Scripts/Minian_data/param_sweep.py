@@ -0,0 +1,201 @@
+"""
+Shared-upstream CNMF parameter sweep
+------------------------------------
+Runs several CNMF parameter sets against one session while computing the
+expensive, parameter-independent part of the pipeline only once:
+
+    1. video load, glow/denoise/background removal, motion correction,
+       initialization and the spatial noise estimate run once into <output_root>/shared
+    2. every variant gets its own output folder <output_root>/<variant name>;
+       its stage manifest is seeded with the shared upstream stages, so
+       run_pipeline skips straight to the first spatial update
+    3. variants run concurrently (one process each, because Minian steers its
+       temporary stores through the MINIAN_INTERMEDIATE environment variable)
+       on the single Dask cluster started here
+
+Usage
+-----
+    import param_sweep
+    param_sweep.pipeline.MINIAN_PATH = "/path/to/minian"
+    param_sweep.run_sweep(
+        "/scratch/s4750098/session_001",
+        [
+            {"name": "penal_0.05", "param_first_spatial": {"dl_wnd": 25, "sparse_penal": 0.05, "size_thres": (20, None)}},
+            {"name": "merge_0.8", "param_first_merge": {"thres_corr": 0.8}},
+        ],
+        output_root="/scratch/s4750098/sweeps/session_001",
+    )
+"""
+
+import json
+import multiprocessing as mp
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pipeline
+from stage_manifest import MANIFEST_NAME, StageManifest
+
+# Last stage that is shared between all variants of a sweep
+UPSTREAM_LAST = "spatial_noise"
+# Last CNMF stage; the stages after it (final save, rendering, post-processing)
+# run in every variant with the base parameters
+CNMF_LAST = "second_temporal"
+SUMMARY_NAME = "sweep_summary.json"
+
+
+def _split_stages() -> tuple[list, list]:
+    names = [stage.name for stage in pipeline.PIPELINE_STAGES]
+    cut = names.index(UPSTREAM_LAST) + 1
+    return pipeline.PIPELINE_STAGES[:cut], pipeline.PIPELINE_STAGES[cut:]
+
+
+def sweepable_params() -> set[str]:
+    """
+    Parameter names a sweep variant is allowed to override: those of the CNMF
+    stages between the shared checkpoint (UPSTREAM_LAST) and CNMF_LAST that
+    no shared stage reads (e.g. not unit_batch).
+    """
+    upstream, downstream = _split_stages()
+    names = [stage.name for stage in downstream]
+    cnmf = downstream[: names.index(CNMF_LAST) + 1]
+    shared = {key for stage in upstream for key in stage.params}
+    return {key for stage in cnmf for key in stage.params} - shared
+
+
+def _seed_manifest(shared_dir: str, variant_dir: str, upstream_names: list[str]) -> None:
+    """Copy the shared upstream stage records (and small final arrays) into a variant."""
+    shared = StageManifest(os.path.join(shared_dir, MANIFEST_NAME))
+    variant = StageManifest(os.path.join(variant_dir, MANIFEST_NAME))
+    for name in upstream_names:
+        variant.stages[name] = shared.stages[name]
+    variant.save()
+
+    # motion.zarr and max_proj.zarr belong in every variant's minian folder
+    src_minian = os.path.join(shared_dir, "minian")
+    dst_minian = os.path.join(variant_dir, "minian")
+    os.makedirs(dst_minian, exist_ok=True)
+    for store in ("motion.zarr", "max_proj.zarr"):
+        src, dst = os.path.join(src_minian, store), os.path.join(dst_minian, store)
+        if os.path.exists(src) and not os.path.exists(dst):
+            shutil.copytree(src, dst)
+
+
+def _run_variant(kwargs: dict) -> float:
+    """Process-pool entry point: run the CNMF part of one variant."""
+    import pipeline as _pipeline
+
+    _pipeline.MINIAN_PATH = kwargs.pop("minian_path")
+    start = time.time()
+    _pipeline.run_pipeline(**kwargs)
+    return time.time() - start
+
+
+def run_sweep(
+    dpath: str,
+    variants: list[dict],
+    output_root: str,
+    base_params: dict | None = None,
+    max_concurrent: int = 2,
+    n_workers: int | None = None,
+) -> dict[str, dict]:
+    """
+    Run a list of CNMF parameter sets on one session with shared upstream stages.
+
+    Parameters
+    ----------
+    dpath : str
+        Session folder with the raw .avi videos.
+    variants : list[dict]
+        Parameter overrides per variant (keys from sweepable_params()). An optional
+        "name" key sets the variant's output folder name.
+    output_root : str
+        Folder that receives "shared/" and one folder per variant.
+    base_params : dict | None
+        Overrides applied to every run, including the shared upstream part.
+    max_concurrent : int
+        Number of variants running at the same time on the cluster.
+    n_workers : int | None
+        Dask worker count (default: MINIAN_NWORKERS or 4).
+
+    Returns
+    -------
+    dict
+        Variant name -> {"output_dir", "status", "runtime_s", "error"}.
+    """
+    output_root = os.path.abspath(output_root)
+    base_params = dict(base_params or {})
+    allowed = sweepable_params()
+
+    named: list[tuple[str, dict]] = []
+    for i, variant in enumerate(variants):
+        overrides = dict(variant)
+        name = str(overrides.pop("name", f"variant_{i:02d}"))
+        unknown = set(overrides) - allowed
+        if unknown:
+            raise ValueError(
+                f"Variant '{name}' overrides parameters outside the swept CNMF stages "
+                f"{sorted(unknown)}; a sweep may only change {sorted(allowed)}"
+            )
+        named.append((name, {**base_params, **overrides}))
+    if len({name for name, _ in named}) != len(named):
+        raise ValueError("Variant names must be unique")
+
+    upstream, _ = _split_stages()
+    upstream_names = [stage.name for stage in upstream]
+    shared_dir = os.path.join(output_root, "shared")
+
+    results: dict[str, dict] = {}
+    cluster, client = pipeline.start_cluster(n_workers)
+    try:
+        print(f"[sweep] Computing shared upstream stages into {shared_dir} ...")
+        pipeline.run_pipeline(
+            dpath,
+            shared_dir,
+            params=base_params,
+            client=cluster.scheduler_address,
+            intpath=os.path.join(shared_dir, "minian_intermediate"),
+            stop_after=UPSTREAM_LAST,
+        )
+
+        print(f"[sweep] Running {len(named)} variant(s), {max_concurrent} at a time ...")
+        with ProcessPoolExecutor(
+            max_workers=max_concurrent, mp_context=mp.get_context("spawn")
+        ) as pool:
+            futures = {}
+            for name, run_params in named:
+                variant_dir = os.path.join(output_root, name)
+                _seed_manifest(shared_dir, variant_dir, upstream_names)
+                job = {
+                    "minian_path": pipeline.MINIAN_PATH,
+                    "dpath": dpath,
+                    "output_dir": variant_dir,
+                    "params": run_params,
+                    "client": cluster.scheduler_address,
+                    "intpath": os.path.join(variant_dir, "minian_intermediate"),
+                }
+                futures[pool.submit(_run_variant, job)] = (name, variant_dir)
+
+            for future in as_completed(futures):
+                name, variant_dir = futures[future]
+                try:
+                    runtime = future.result()
+                    results[name] = {"output_dir": variant_dir, "status": "ok", "runtime_s": round(runtime, 1), "error": None}
+                    print(f"[sweep] Variant '{name}' done in {runtime / 60:.2f} min")
+                except Exception as exc:
+                    results[name] = {"output_dir": variant_dir, "status": "failed", "runtime_s": None, "error": str(exc)}
+                    print(f"[sweep] ERROR: variant '{name}' failed: {exc}")
+    finally:
+        client.close()
+        cluster.close()
+
+    summary = {
+        "dpath": os.path.abspath(dpath),
+        "base_params": base_params,
+        "variants": {name: {"params": p, **results.get(name, {})} for name, p in named},
+    }
+    with open(os.path.join(output_root, SUMMARY_NAME), "w") as fh:
+        json.dump(summary, fh, indent=2, default=repr)
+    print(f"[sweep] Summary written to {os.path.join(output_root, SUMMARY_NAME)}")
+    return results
@@ -16,27 +16,95 @@ Usage
     from Scripts.Minian_data.pipeline import run_pipeline
     run_pipeline("/scratch/s4750098/session_001")
 
+    # CNMF parameter sweep sharing the pre-processing / motion / init stages
+    # (see param_sweep.py)
+    from param_sweep import run_sweep
+
+    # Track cells across sessions (T1 / T2 / PostEx) from their outputs
+    # (see cell_registration.py)
+    from cell_registration import register_sessions
+
 Requirements
 ------------
     - minian installed / available on sys.path (minian_path below)
     - dask, holoviews, xarray, numpy installed
     - Scripts convert_to_csv.py, plotting.py, map.py in the same folder as this file
+
+Checkpoint / resume
+-------------------
+Every completed stage is recorded in `<output_dir>/stage_manifest.json` with a
+hash of its parameters. Rerunning on the same session reopens the saved zarr
+stores and continues from the first missing or stale stage. Pass resume=False
+to start over.
+
+Profiling
+---------
+Wall time, peak worker RSS, worker I/O, bytes written through save_minian and
+the Dask task count of every stage are written to
+`<output_dir>/pipeline_profile.json`.
+
+Intermediate store
+------------------
+Intermediate arrays live in a per-session folder (`<output_dir>/minian_intermediate`
+by default). Each array is deleted as soon as no later stage needs it, and the
+folder is removed when the session completes; keep_intermediate=True keeps all.
+The final A, C, S, c0, b0, b and f are not re-saved: their intermediate stores
+are renamed into `minian/` (hard-linked with keep_intermediate=True, copied
+only when the two folders are on different filesystems).
+
+Video ingest
+------------
+The raw videos are decoded in parallel into a cached `varr.zarr`
+(`<output_dir>/video_cache` or MINIAN_VIDEO_CACHE, see video_ingest.py), keyed
+on the file contents and param_load_videos, so repeat runs skip decoding; the
+cache is capped at param_ingest["cache_max_bytes"] (MINIAN_VIDEO_CACHE_MAX). The
+min-projection for glow removal is collected while decoding, and glow removal,
+denoise and background removal then run as one pass per frame chunk
+(fused_preprocessing.py).
+
+Fixed footprints
+----------------
+run_pipeline(..., footprints="<earlier session>/minian/A.zarr") re-extracts
+traces for a follow-up session (T1 -> T2 -> PostEx) from footprints registered
+to its max projection, skipping seed detection, initialization and the spatial
+updates.
+
+Pre-flight estimate
+-------------------
+run_pipeline(..., dry_run=True) (or `python preflight.py <dpath>`) reads only
+the video headers and predicts runtime, memory and scratch per stage from the
+profiles of earlier runs, with a recommended worker count and memory limit.
+
+Preview mode
+------------
+run_pipeline(..., preview=True) runs the whole chain on a few minutes of
+strongly downsampled video into <output_dir>/preview and writes a QA bundle
+(seed / unit counts, footprints over the max projection) to judge whether the
+parameters are worth a full run (see preview.py).
+
+Several sessions on one node
+----------------------------
+multi_session.run_sessions() runs several sessions at once on one shared
+cluster, with a limited number of I/O-heavy and compute-heavy stages running at
+the same time so the sessions' phases interleave (see multi_session.py).
+
+Compute-only mode
+-----------------
+run_pipeline(..., compute_only=True) skips holoviews and every MP4 / figure and
+leaves a render job behind; `python render.py <output_dir>` produces the videos
+later from the saved zarr arrays.
 """
 
-import itertools as itt
-import importlib.util
+import functools
+import json
 import os
 import sys
 import shutil as _shutil
 import time
 
-import holoviews as hv
 import numpy as np
 import xarray as xr
 from dask.distributed import Client, LocalCluster
-from holoviews.operation.datashader import datashade, regrid
-from holoviews.util import Dynamic
-from IPython.core.display import display
 
 # ---------------------------------------------------------------------------
 # PATH TO MINIAN CODEBASE
@@ -45,519 +113,1052 @@ from IPython.core.display import display
 # ---------------------------------------------------------------------------
 MINIAN_PATH = "."
 
+# Make the helper modules next to this file importable, also when this file is
+# loaded through importlib from low_level_loop.py.
+_THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+if _THIS_DIR not in sys.path:
+    sys.path.insert(0, _THIS_DIR)
+
+from cluster_sizing import plan_cluster  # noqa: E402
+from intermediate_store import IntermediateStore  # noqa: E402
+from coarse_to_fine import compare_motion, estimate_motion_c2f, timed  # noqa: E402
+from dual_layout import write_dual_layout  # noqa: E402
+from footprint_store import SPARSE_A_NAME, SparseFootprints, load_footprints, save_sparse_footprints  # noqa: E402
+from fused_preprocessing import fused_preprocess, fused_supported  # noqa: E402
+from video_ingest import ingest_supported, ingest_videos, load_min_projection  # noqa: E402
+from preflight import estimate, print_estimate  # noqa: E402
+from postprocess import postprocess  # noqa: E402
+from preview import DEFAULT_PREVIEW, preview_params, write_qa_bundle  # noqa: E402
+from render import render_cnmf_video, render_mc_video, spawn_renderer, write_render_job  # noqa: E402
+from stage_manifest import MANIFEST_NAME, StageManifest, param_hash, store_mtime  # noqa: E402
+from stage_profile import PROFILE_NAME, StageProfiler, TaskCounter  # noqa: E402
+from stage_runner import Stage, StageContext, run_stages, slot_gate  # noqa: E402
+
+
 
-def run_pipeline(dpath: str, output_dir: str | None = None) -> None:
+
+def default_params() -> dict:
     """
-    Run the full Minian CNMF pipeline on a single session folder.
+    Return the default Minian parameters used by run_pipeline.
 
-    Parameters
-    ----------
-    dpath : str
-        Path to the local folder that contains the raw .avi videos.
-        When called from low_level_loop.py this is the /scratch download path.
-    output_dir : str | None
-        Output folder where minian arrays, videos, CSVs, and figures are saved.
-        If None, outputs are written inside dpath (original behavior).
+    The keys mirror the parameter names of the original Minian notebook, so a
+    caller can override a single step with e.g.
+    ``run_pipeline(..., params={"param_first_spatial": {...}})``.
     """
+    return {
+        "subset": dict(frame=slice(0, None)),
+        "subset_mc": None,
+        # Pre-processing
+        "param_load_videos": {
+            "pattern": r"^msCam([1-9]|1[0-9]|2[0-8])\.avi$",
+            "dtype": np.uint8,
+            "downsample": dict(frame=1, height=6, width=6),
+            "downsample_strategy": "subset",
+        },
+        # Parallel decode into the cached varr.zarr (see video_ingest.py); not hashed,
+        # cache_dir defaults to <output_dir>/video_cache, n_procs to the core count;
+        # least recently used cache entries are removed above cache_max_bytes (None: no cap)
+        "param_ingest": {
+            "cache_dir": os.getenv("MINIAN_VIDEO_CACHE"),
+            "n_procs": None,
+            "cache_max_bytes": os.getenv("MINIAN_VIDEO_CACHE_MAX", "50GB"),
+        },
+        # Decode only the first max_files videos / frames_per_file frames (None: all)
+        "param_video_subset": {"max_files": None, "frames_per_file": None},
+        "param_denoise": {"method": "median", "ksize": 7},
+        "param_background_removal": {"method": "tophat", "wnd": 15},
+        # Motion correction
+        "param_estimate_motion": {"dim": "frame"},
+        # "full" (Minian's estimate_motion) or "coarse_to_fine" (see coarse_to_fine.py);
+        # compare_baseline also runs "full" and writes the speedup and shift
+        # difference to <output_dir>/motion_report.json
+        "param_motion_mode": {
+            "method": "full",
+            "spatial_factor": 2,
+            "temporal_bin": 5,
+            "refine_radius": None,
+            "compare_baseline": False,
+        },
+        # Memory the Y_fm_chk -> Y_hw_chk consolidation may use at once, e.g. "4GB"
+        # (None: a quarter of the cluster memory); not hashed, see dual_layout.py
+        "param_rechunk": {"memory_budget": os.getenv("MINIAN_RECHUNK_BUDGET")},
+        # Initialization
+        "param_seeds_init": {
+            "wnd_size": 1000,
+            "method": "rolling",
+            "stp_size": 500,
+            "max_wnd": 25,
+            "diff_thres": 3,
+        },
+        "param_pnr_refine": {"noise_freq": 0.06, "thres": 0.9},
+        "param_ks_refine": {"sig": 0.05},
+        "param_seeds_merge": {"thres_dist": 7, "thres_corr": 0.8, "noise_freq": 0.06},
+        "param_initialize": {"thres_corr": 0.8, "wnd": 15, "noise_freq": 0.1},
+        "param_init_merge": {"thres_corr": 0.9},
+        # CNMF
+        "param_get_noise": {"noise_range": (0.06, 0.5)},
+        "param_first_spatial": {
+            "dl_wnd": 25,
+            "sparse_penal": 0.01,
+            "size_thres": (20, None),
+        },
+        "param_first_temporal": {
+            "noise_freq": 0.06,
+            "sparse_penal": 1,
+            "p": 1,
+            "add_lag": 20,
+            "jac_thres": 0.2,
+        },
+        "param_first_merge": {"thres_corr": 0.9},
+        "param_second_spatial": {
+            "dl_wnd": 15,
+            "sparse_penal": 0.001,
+            "size_thres": (15, None),
+        },
+        "param_second_temporal": {
+            "noise_freq": 0.06,
+            "sparse_penal": 1,
+            "p": 1,
+            "add_lag": 20,
+            "jac_thres": 0.4,
+        },
+        # Units per chunk of C_init, YrA, C, S, b0, c0: 1 is Minian's layout;
+        # larger blocks mean fewer tasks / zarr chunks (see benchmark_unit_batch.py)
+        "unit_batch": 1,
+        # Final footprints: "dense" (A.zarr, what Minian's tools read), "sparse"
+        # (A_sparse, see footprint_store.py; same values and dtype, far smaller)
+        # or "both" (writes A twice)
+        "param_footprint_format": "dense",
+        # Exports / binarization of the final C (see postprocess.py); "parquet"
+        # needs pyarrow or fastparquet and is skipped otherwise
+        "param_postprocessing": {
+            "sampling_frequency": 30,
+            "z_threshold": 2.0,
+            "formats": ("csv", "parquet"),
+        },
+    }
 
-    pipeline_start = time.time()
 
-    # -----------------------------------------------------------------------
-    # Add minian to path and import
-    # -----------------------------------------------------------------------
-    sys.path.append(MINIAN_PATH)
-    from minian.cnmf import (
-        compute_AtC,
-        compute_trace,
-        get_noise_fft,
-        smooth_sig,
-        unit_merge,
-        update_spatial,
-        update_temporal,
-        update_background,
+# ===========================================================================
+# STAGES
+# Each stage takes (ctx, state) and returns the state entries it produced.
+# Arrays must be saved through ctx.save / ctx.save_final so they can be
+# reopened on resume; plain values (e.g. chunk sizes) are stored as metadata.
+# ===========================================================================
+
+def _stage_ingest(ctx: StageContext, state: dict) -> dict:
+    from minian.utilities import get_optimal_chk, load_videos
+
+    p = ctx.params
+    param_load_videos = p["param_load_videos"]
+    video_subset = {k: v for k, v in p["param_video_subset"].items() if v is not None}
+
+    if ingest_supported(param_load_videos):
+        print("[pipeline] Ingesting videos ...")
+        cache_root = p["param_ingest"].get("cache_dir") or os.path.join(ctx.output_dir, "video_cache")
+        store_path = ingest_videos(
+            ctx.dpath,
+            param_load_videos,
+            cache_root,
+            p["param_ingest"].get("n_procs"),
+            video_subset,
+            max_bytes=p["param_ingest"].get("cache_max_bytes"),
+        )
+        varr = ctx.adopt(store_path)
+        chk, _ = get_optimal_chk(varr, dtype=float)
+        # Min-projection collected while decoding, used for glow removal
+        varr_min = load_min_projection(store_path)
+        if varr_min is not None:
+            varr_min = ctx.save(
+                xr.DataArray(
+                    varr_min,
+                    dims=["height", "width"],
+                    coords={"height": varr.coords["height"], "width": varr.coords["width"]},
+                    name="varr_min",
+                )
+            )
+    else:
+        if video_subset:
+            raise ValueError("param_video_subset needs a downsample strategy supported by video_ingest")
+        print("[pipeline] Loading videos ...")
+        varr = load_videos(ctx.dpath, **param_load_videos)
+        chk, _ = get_optimal_chk(varr, dtype=float)
+        varr = ctx.save(varr.chunk({"frame": chk["frame"], "height": -1, "width": -1}).rename("varr"))
+        varr_min = None
+
+    chk = {dim: int(size) for dim, size in chk.items()}
+    return {"varr": varr, "chk": chk, "varr_min": varr_min}
+
+
+def _stage_preprocessing(ctx: StageContext, state: dict) -> dict:
+    from minian.preprocessing import denoise, remove_background
+
+    p = ctx.params
+    varr = state["varr"]
+
+    # Subset
+    varr_ref = varr.sel(p["subset"])
+
+    # Glow removal: reuse the min-projection from ingest unless frames were subset
+    if state.get("varr_min") is not None and varr_ref.sizes["frame"] == varr.sizes["frame"]:
+        varr_min = state["varr_min"].sel({d: s for d, s in p["subset"].items() if d != "frame"})
+    else:
+        print("[pipeline] Computing min projection ...")
+        varr_min = varr_ref.min("frame").compute()
+
+    if fused_supported(p["param_denoise"], p["param_background_removal"]):
+        # Single pass: glow removal, denoise and background removal per frame chunk
+        print("[pipeline] Glow removal / denoising / background removal (fused) ...")
+        varr_ref = fused_preprocess(
+            varr_ref, varr_min, p["param_denoise"], p["param_background_removal"]
+        )
+    else:
+        print("[pipeline] Glow removal ...")
+        varr_ref = varr_ref - varr_min
+
+        # Denoise
+        print("[pipeline] Denoising ...")
+        varr_ref = denoise(varr_ref, **p["param_denoise"])
+
+        # Background removal
+        print("[pipeline] Background removal ...")
+        varr_ref = remove_background(varr_ref, **p["param_background_removal"])
+
+    # Save pre-processed video
+    varr_ref = ctx.save(varr_ref.rename("varr_ref"))
+
+    return {"varr_ref": varr_ref}
+
+
+def _stage_motion_correction(ctx: StageContext, state: dict) -> dict:
+    from minian.motion_correction import apply_transform, estimate_motion
+
+    p = ctx.params
+    varr_ref, chk = state["varr_ref"], state["chk"]
+
+    varr_mc = varr_ref.sel(p["subset_mc"])
+    mode = p["param_motion_mode"]
+    motion_report = None
+    if mode["method"] == "coarse_to_fine":
+        print("[pipeline] Estimating motion (coarse-to-fine) ...")
+        motion, c2f_s = timed(
+            estimate_motion_c2f,
+            varr_mc,
+            spatial_factor=mode["spatial_factor"],
+            temporal_bin=mode["temporal_bin"],
+            refine_radius=mode["refine_radius"],
+            **p["param_estimate_motion"],
+        )
+        motion_report = {"mode": mode, "coarse_to_fine_s": round(c2f_s, 2)}
+        if mode.get("compare_baseline"):
+            print("[pipeline] Estimating motion (full-resolution baseline) ...")
+            baseline, full_s = timed(estimate_motion, varr_mc, **p["param_estimate_motion"])
+            motion_report.update(
+                full_resolution_s=round(full_s, 2),
+                speedup=round(full_s / c2f_s, 2),
+                shift_difference=compare_motion(motion, baseline),
+            )
+            print(
+                f"[pipeline] Coarse-to-fine motion: {motion_report['speedup']}x faster, "
+                f"max shift difference {max(d['max_abs_px'] for d in motion_report['shift_difference'].values()):.2f} px"
+            )
+        with open(os.path.join(ctx.output_dir, "motion_report.json"), "w") as fh:
+            json.dump(motion_report, fh, indent=2)
+    else:
+        print("[pipeline] Estimating motion ...")
+        motion = estimate_motion(varr_mc, **p["param_estimate_motion"])
+    motion = ctx.save_final(motion.rename("motion").chunk({"frame": chk["frame"]}))
+
+    print("[pipeline] Applying motion correction ...")
+    Y = apply_transform(varr_ref, motion, fill=0)
+
+    # Frame- and pixel-chunked layouts in bounded memory instead of one big rechunk
+    os.makedirs(ctx.dir, exist_ok=True)
+    fm_path = os.path.join(ctx.dir, "Y_fm_chk.zarr")
+    hw_path = os.path.join(ctx.dir, "Y_hw_chk.zarr")
+    write_dual_layout(
+        Y.astype(float),
+        fm_path,
+        hw_path,
+        {"height": chk["height"], "width": chk["width"]},
+        memory_budget=p["param_rechunk"]["memory_budget"],
+        compressor=ctx.store.compressor,
     )
+    Y_fm_chk = ctx.adopt(fm_path)
+    Y_hw_chk = ctx.adopt(hw_path)
+
+    # Make motion-correction comparison video (deferred in compute-only mode)
+    if not p.get("compute_only"):
+        render_mc_video(varr_ref, Y_fm_chk, ctx.output_dir)
+
+    return {"motion": motion, "Y_fm_chk": Y_fm_chk, "Y_hw_chk": Y_hw_chk, "motion_report": motion_report}
+
+
+def _stage_initialization(ctx: StageContext, state: dict) -> dict:
+    from minian.cnmf import unit_merge, update_background
     from minian.initialization import (
-        gmm_refine,
         initA,
         initC,
-        intensity_refine,
         ks_refine,
         pnr_refine,
         seeds_init,
         seeds_merge,
     )
-    from minian.motion_correction import apply_transform, estimate_motion
-    from minian.preprocessing import denoise, remove_background
-    from minian.utilities import (
-        TaskAnnotation,
-        get_optimal_chk,
-        load_videos,
-        open_minian,
-        save_minian,
-    )
-    from minian.visualization import (
-        CNMFViewer,
-        VArrayViewer,
-        generate_videos,
-        visualize_gmm_fit,
-        visualize_motion,
-        visualize_preprocess,
-        visualize_seeds,
-        visualize_spatial_update,
-        visualize_temporal_update,
-        write_video,
-    )
 
-    # -----------------------------------------------------------------------
-    # Parameters
-    # -----------------------------------------------------------------------
-    dpath = os.path.abspath(dpath)
-    output_dir = os.path.abspath(output_dir) if output_dir else dpath
-    os.makedirs(output_dir, exist_ok=True)
+    p = ctx.params
+    Y_fm_chk, Y_hw_chk, chk = state["Y_fm_chk"], state["Y_hw_chk"], state["chk"]
 
-    minian_ds_path = os.path.join(output_dir, "minian")
-    intpath = "./minian_intermediate"
-    subset = dict(frame=slice(0, None))
-    subset_mc = None
-    interactive = False  # set True only for interactive parameter exploration, Hábrok does not have built in GUI support so only locally runable with interactive
-    output_size = 100
-    n_workers = int(os.getenv("MINIAN_NWORKERS", 4))
+    print("[pipeline] Computing max projection ...")
+    max_proj = ctx.save_final(Y_fm_chk.max("frame").rename("max_proj")).compute()
 
-    param_save_minian = {
-        "dpath": minian_ds_path,
-        "meta_dict": dict(session=-1, animal=-2),
-        "overwrite": True,
-    }
+    print("[pipeline] Generating seeds ...")
+    seeds = seeds_init(Y_fm_chk, **p["param_seeds_init"])
 
-    # Pre-processing
-    param_load_videos = {
-        "pattern": r"^msCam([1-9]|1[0-9]|2[0-8])\.avi$",
-        "dtype": np.uint8,
-        "downsample": dict(frame=1, height=6, width=6),
-        "downsample_strategy": "subset",
-    }
-    param_denoise = {"method": "median", "ksize": 7}
-    param_background_removal = {"method": "tophat", "wnd": 15}
-
-    # Motion correction
-    param_estimate_motion = {"dim": "frame"}
-
-    # Initialization
-    param_seeds_init = {
-        "wnd_size": 1000,
-        "method": "rolling",
-        "stp_size": 500,
-        "max_wnd": 25,
-        "diff_thres": 3,
-    }
-    param_pnr_refine = {"noise_freq": 0.06, "thres": 0.9}
-    param_ks_refine = {"sig": 0.05}
-    param_seeds_merge = {"thres_dist": 7, "thres_corr": 0.8, "noise_freq": 0.06}
-    param_initialize = {"thres_corr": 0.8, "wnd": 15, "noise_freq": 0.1}
-    param_init_merge = {"thres_corr": 0.9}
-
-    # CNMF
-    param_get_noise = {"noise_range": (0.06, 0.5)}
-    param_first_spatial = {
-        "dl_wnd": 25,
-        "sparse_penal": 0.01,
-        "size_thres": (20, None),
-    }
-    param_first_temporal = {
-        "noise_freq": 0.06,
-        "sparse_penal": 1,
-        "p": 1,
-        "add_lag": 20,
-        "jac_thres": 0.2,
-    }
-    param_first_merge = {"thres_corr": 0.9}
-    param_second_spatial = {
-        "dl_wnd": 15,
-        "sparse_penal": 0.001,
-        "size_thres": (15, None),
+    print("[pipeline] PNR refine ...")
+    seeds, pnr, gmm = pnr_refine(Y_hw_chk, seeds, **p["param_pnr_refine"])
+
+    print("[pipeline] KS refine ...")
+    seeds = ks_refine(Y_hw_chk, seeds, **p["param_ks_refine"])
+
+    print("[pipeline] Merging seeds ...")
+    seeds_final = seeds[seeds["mask_ks"] & seeds["mask_pnr"]].reset_index(drop=True)
+    seeds_final = seeds_merge(Y_hw_chk, max_proj, seeds_final, **p["param_seeds_merge"])
+
+    print("[pipeline] Initialising spatial matrix ...")
+    A_init = initA(Y_hw_chk, seeds_final[seeds_final["mask_mrg"]], **p["param_initialize"])
+    A_init = ctx.save(A_init.rename("A_init"))
+
+    print("[pipeline] Initialising temporal matrix ...")
+    C_init = initC(Y_fm_chk, A_init)
+    C_init = ctx.save(C_init.rename("C_init"), chunks={"unit_id": ctx.params["unit_batch"], "frame": -1})
+
+    print("[pipeline] Merging units (init) ...")
+    A, C = unit_merge(A_init, C_init, **p["param_init_merge"])
+    A = ctx.save(A.rename("A"))
+    C = ctx.save(C.rename("C"))
+    C_chk = ctx.save(C.rename("C_chk"), chunks={"unit_id": -1, "frame": chk["frame"]})
+
+    print("[pipeline] Initialising background terms ...")
+    b, f = update_background(Y_fm_chk, A, C_chk)
+    f = ctx.save(f.rename("f"))
+    b = ctx.save(b.rename("b"))
+
+    seed_counts = {
+        "seeds": int(len(seeds)),
+        "pass_pnr": int(seeds["mask_pnr"].sum()),
+        "pass_ks": int(seeds["mask_ks"].sum()),
+        "pass_pnr_and_ks": int(len(seeds_final)),
+        "after_seeds_merge": int(seeds_final["mask_mrg"].sum()),
+        "units_init": int(A_init.sizes["unit_id"]),
     }
-    param_second_temporal = {
-        "noise_freq": 0.06,
-        "sparse_penal": 1,
-        "p": 1,
-        "add_lag": 20,
-        "jac_thres": 0.4,
+    return {
+        "max_proj": max_proj, "A": A, "C": C, "C_chk": C_chk, "b": b, "f": f,
+        "seed_counts": seed_counts,
+        f"units_after_{ctx.name}": int(A.sizes["unit_id"]),
     }
 
-    os.environ["OMP_NUM_THREADS"] = "1"
-    os.environ["MKL_NUM_THREADS"] = "1"
-    os.environ["OPENBLAS_NUM_THREADS"] = "1"
-    os.environ["MINIAN_INTERMEDIATE"] = intpath
 
-    # -----------------------------------------------------------------------
-    # Module initialisation
-    # -----------------------------------------------------------------------
-    hv.extension("bokeh", logo=False)
+def _stage_spatial_noise(ctx: StageContext, state: dict) -> dict:
+    from minian.cnmf import get_noise_fft
 
-    # -----------------------------------------------------------------------
-    # Start Dask cluster
-    # -----------------------------------------------------------------------
-    print("[pipeline] Starting Dask cluster ...")
-    cluster = LocalCluster(
-        n_workers=n_workers,
-        memory_limit="7GB",
-        resources={"MEM": 1},
-        threads_per_worker=4,
-        dashboard_address=":8787",
-        processes=True,
+    print("[pipeline] Estimating spatial noise ...")
+    sn_spatial = get_noise_fft(state["Y_hw_chk"], **ctx.params["param_get_noise"])
+    sn_spatial = ctx.save(sn_spatial.rename("sn_spatial"))
+    return {"sn_spatial": sn_spatial}
+
+
+def _stage_spatial_update(ctx: StageContext, state: dict, param_key: str, label: str) -> dict:
+    from minian.cnmf import update_background, update_spatial
+
+    Y_fm_chk, Y_hw_chk, chk = state["Y_fm_chk"], state["Y_hw_chk"], state["chk"]
+    A, C, C_chk = state["A"], state["C"], state["C_chk"]
+
+    print(f"[pipeline] {label} spatial update ...")
+    A_new, mask, norm_fac = update_spatial(
+        Y_hw_chk, A, C, state["sn_spatial"], **ctx.params[param_key]
     )
-    annt_plugin = TaskAnnotation()
-    cluster.scheduler.add_plugin(annt_plugin)
-    client = Client(cluster)
-    print(f"[pipeline] Dask dashboard: {client.dashboard_link}")
+    C_new = ctx.save((C.sel(unit_id=mask) * norm_fac).rename("C_new"))
+    C_chk_new = ctx.save((C_chk.sel(unit_id=mask) * norm_fac).rename("C_chk_new"))
+    b_new, f_new = update_background(Y_fm_chk, A_new, C_chk_new)
 
-    try:
+    A = ctx.save(A_new.rename("A"), chunks={"unit_id": 1, "height": -1, "width": -1})
+    b = ctx.save(b_new.rename("b"))
+    f = ctx.save(f_new.chunk({"frame": chk["frame"]}).rename("f"))
+    C = ctx.save(C_new.rename("C"))
+    C_chk = ctx.save(C_chk_new.rename("C_chk"))
 
-        # ===================================================================
-        # PRE-PROCESSING
-        # ===================================================================
-        print("[pipeline] Loading videos ...")
-        varr = load_videos(dpath, **param_load_videos)
-        chk, _ = get_optimal_chk(varr, dtype=float)
+    return {"A": A, "b": b, "f": f, "C": C, "C_chk": C_chk, f"units_after_{ctx.name}": int(A.sizes["unit_id"])}
 
-        varr = save_minian(
-            varr.chunk({"frame": chk["frame"], "height": -1, "width": -1}).rename("varr"),
-            intpath,
-            overwrite=True,
-        )
 
-        # Subset
-        varr_ref = varr.sel(subset)
+def _stage_temporal_update(ctx: StageContext, state: dict, param_key: str, label: str) -> dict:
+    from minian.cnmf import compute_trace, update_temporal
 
-        # Glow removal
-        print("[pipeline] Glow removal ...")
-        varr_min = varr_ref.min("frame").compute()
-        varr_ref = varr_ref - varr_min
+    Y_fm_chk, chk = state["Y_fm_chk"], state["chk"]
+    A, b, f, C, C_chk = state["A"], state["b"], state["f"], state["C"], state["C_chk"]
 
-        # Denoise
-        print("[pipeline] Denoising ...")
-        varr_ref = denoise(varr_ref, **param_denoise)
+    # Units per chunk of the per-unit traces (YrA, C, S, b0, c0)
+    ub = ctx.params["unit_batch"]
 
-        # Background removal
-        print("[pipeline] Background removal ...")
-        varr_ref = remove_background(varr_ref, **param_background_removal)
+    print(f"[pipeline] Computing trace ({label.lower()} temporal) ...")
+    YrA = ctx.save(
+        compute_trace(Y_fm_chk, A, b, C_chk, f).rename("YrA"),
+        chunks={"unit_id": ub, "frame": -1},
+    )
 
-        # Save pre-processed video
-        varr_ref = save_minian(varr_ref.rename("varr_ref"), dpath=intpath, overwrite=True)
+    print(f"[pipeline] {label} temporal update ...")
+    # Use a clean sub-directory for intermediate results so open_minian()
+    # only finds valid zarr stores during this step
+    intpath_orig = os.environ["MINIAN_INTERMEDIATE"]
+    tmp_path = os.path.join(ctx.dir, "_tmp_update_temporal")
+    if os.path.exists(tmp_path):
+        _shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    os.environ["MINIAN_INTERMEDIATE"] = tmp_path
 
-        # ===================================================================
-        # MOTION CORRECTION
-        # ===================================================================
-        print("[pipeline] Estimating motion ...")
-        motion = estimate_motion(varr_ref.sel(subset_mc), **param_estimate_motion)
-        motion = save_minian(
-            motion.rename("motion").chunk({"frame": chk["frame"]}), **param_save_minian
+    try:
+        C_new, S_new, b0_new, c0_new, g, mask = update_temporal(
+            A, C, YrA=YrA, **ctx.params[param_key]
         )
+    finally:
+        os.environ["MINIAN_INTERMEDIATE"] = intpath_orig
+
+    C = ctx.save(C_new.rename("C").chunk({"unit_id": ub, "frame": -1}))
+    C_chk = ctx.save(C.rename("C_chk"), chunks={"unit_id": -1, "frame": chk["frame"]})
+    S = ctx.save(S_new.rename("S").chunk({"unit_id": ub, "frame": -1}))
+    b0 = ctx.save(b0_new.rename("b0").chunk({"unit_id": ub, "frame": -1}))
+    c0 = ctx.save(c0_new.rename("c0").chunk({"unit_id": ub, "frame": -1}))
+    # Saved (rather than kept as a lazy selection) so it can be reopened on resume
+    A = ctx.save(A.sel(unit_id=C.coords["unit_id"].values).rename("A"))
+
+    return {
+        "A": A, "C": C, "C_chk": C_chk, "S": S, "b0": b0, "c0": c0,
+        f"units_after_{ctx.name}": int(A.sizes["unit_id"]),
+    }
 
-        print("[pipeline] Applying motion correction ...")
-        Y = apply_transform(varr_ref, motion, fill=0)
 
-        Y_fm_chk = save_minian(Y.astype(float).rename("Y_fm_chk"), intpath, overwrite=True)
-        Y_hw_chk = save_minian(
-            Y_fm_chk.rename("Y_hw_chk"),
-            intpath,
-            overwrite=True,
-            chunks={"frame": -1, "height": chk["height"], "width": chk["width"]},
-        )
+def _stage_first_merge(ctx: StageContext, state: dict) -> dict:
+    from minian.cnmf import unit_merge
 
-        # Make motion-correction comparison video
-        vid_arr = xr.concat([varr_ref, Y_fm_chk], "width").chunk({"width": -1})
-        write_video(vid_arr, "minian_mc.mp4", output_dir)
+    A, C, b0, c0, chk = state["A"], state["C"], state["b0"], state["c0"], state["chk"]
 
-        # ===================================================================
-        # INITIALIZATION
-        # ===================================================================
-        print("[pipeline] Computing max projection ...")
-        max_proj = save_minian(
-            Y_fm_chk.max("frame").rename("max_proj"), **param_save_minian
-        ).compute()
+    print("[pipeline] Merging units (first merge) ...")
+    A_mrg, C_mrg, [sig_mrg] = unit_merge(A, C, [C + b0 + c0], **ctx.params["param_first_merge"])
 
-        print("[pipeline] Generating seeds ...")
-        seeds = seeds_init(Y_fm_chk, **param_seeds_init)
+    A = ctx.save(A_mrg.rename("A_mrg"))
+    C = ctx.save(C_mrg.rename("C_mrg"))
+    C_chk = ctx.save(C.rename("C_mrg_chk"), chunks={"unit_id": -1, "frame": chk["frame"]})
+    sig = ctx.save(sig_mrg.rename("sig_mrg"))
 
-        print("[pipeline] PNR refine ...")
-        seeds, pnr, gmm = pnr_refine(Y_hw_chk, seeds, **param_pnr_refine)
+    return {"A": A, "C": C, "C_chk": C_chk, "sig": sig, f"units_after_{ctx.name}": int(A.sizes["unit_id"])}
 
-        print("[pipeline] KS refine ...")
-        seeds = ks_refine(Y_hw_chk, seeds, **param_ks_refine)
 
-        print("[pipeline] Merging seeds ...")
-        seeds_final = seeds[seeds["mask_ks"] & seeds["mask_pnr"]].reset_index(drop=True)
-        seeds_final = seeds_merge(Y_hw_chk, max_proj, seeds_final, **param_seeds_merge)
+def _stage_footprint_init(ctx: StageContext, state: dict) -> dict:
+    """Fixed-footprint mode: start from an existing A instead of seeds + initA."""
+    from minian.cnmf import update_background
+    from minian.initialization import initC
 
-        print("[pipeline] Initialising spatial matrix ...")
-        A_init = initA(Y_hw_chk, seeds_final[seeds_final["mask_mrg"]], **param_initialize)
-        A_init = save_minian(A_init.rename("A_init"), intpath, overwrite=True)
+    Y_fm_chk, chk = state["Y_fm_chk"], state["chk"]
 
-        print("[pipeline] Initialising temporal matrix ...")
-        C_init = initC(Y_fm_chk, A_init)
-        C_init = save_minian(
-            C_init.rename("C_init"), intpath, overwrite=True, chunks={"unit_id": 1, "frame": -1}
-        )
+    print("[pipeline] Computing max projection ...")
+    max_proj = ctx.save_final(Y_fm_chk.max("frame").rename("max_proj")).compute()
 
-        print("[pipeline] Merging units (init) ...")
-        A, C = unit_merge(A_init, C_init, **param_init_merge)
-        A = save_minian(A.rename("A"), intpath, overwrite=True)
-        C = save_minian(C.rename("C"), intpath, overwrite=True)
-        C_chk = save_minian(
-            C.rename("C_chk"),
-            intpath,
-            overwrite=True,
-            chunks={"unit_id": -1, "frame": chk["frame"]},
+    print(f"[pipeline] Loading footprints from {ctx.params['footprints']} ...")
+    A = load_footprints(ctx.params["footprints"])
+    if isinstance(A, SparseFootprints):
+        A = A.to_dense()
+    A = A.reset_coords(drop=True)
+    for dim in ("height", "width"):
+        if not np.array_equal(A.coords[dim].values, Y_fm_chk.coords[dim].values):
+            raise ValueError(
+                f"Footprints do not match this session's {dim} grid; register A to the "
+                "new session's max projection (same downsampling) first"
+            )
+    A = A.where(A.sum(["height", "width"]) > 0, drop=True).fillna(0)
+    A = ctx.save(A.rename("A"), chunks={"unit_id": 1, "height": -1, "width": -1})
+    print(f"[pipeline] {A.sizes['unit_id']} fixed footprints")
+
+    print("[pipeline] Initialising temporal matrix ...")
+    C = ctx.save(initC(Y_fm_chk, A).rename("C"), chunks={"unit_id": ctx.params["unit_batch"], "frame": -1})
+    C_chk = ctx.save(C.rename("C_chk"), chunks={"unit_id": -1, "frame": chk["frame"]})
+
+    print("[pipeline] Initialising background terms ...")
+    b, f = update_background(Y_fm_chk, A, C_chk)
+    f = ctx.save(f.chunk({"frame": chk["frame"]}).rename("f"))
+    b = ctx.save(b.rename("b"))
+
+    return {"max_proj": max_proj, "A": A, "C": C, "C_chk": C_chk, "b": b, "f": f}
+
+
+def _stage_finalize(ctx: StageContext, state: dict) -> dict:
+    print("[pipeline] Saving final results ...")
+    footprint_format = ctx.params["param_footprint_format"]
+    final = {}
+    for name in ("A", "C", "S", "c0", "b0", "b", "f"):
+        if name == "A" and footprint_format == "sparse":
+            # Dense A only lives in the intermediate store (for the video)
+            final[name] = ctx.save(state[name].rename(name))
+            continue
+        # Move the finished intermediate store instead of rewriting it
+        final[name] = ctx.promote_final(name)
+        if final[name] is None:
+            final[name] = ctx.save_final(state[name].rename(name))
+    if footprint_format in ("sparse", "both"):
+        save_sparse_footprints(
+            final["A"], os.path.join(ctx.param_save_minian["dpath"], SPARSE_A_NAME)
         )
+    return final
 
-        print("[pipeline] Initialising background terms ...")
-        b, f = update_background(Y_fm_chk, A, C_chk)
-        f = save_minian(f.rename("f"), intpath, overwrite=True)
-        b = save_minian(b.rename("b"), intpath, overwrite=True)
 
-        # ===================================================================
-        # CNMF
-        # ===================================================================
-
-        # --- Estimate spatial noise ---
-        print("[pipeline] Estimating spatial noise ...")
-        sn_spatial = get_noise_fft(Y_hw_chk, **param_get_noise)
-        sn_spatial = save_minian(sn_spatial.rename("sn_spatial"), intpath, overwrite=True)
-
-        # -------------------------------------------------------------------
-        # First spatial update
-        # -------------------------------------------------------------------
-        print("[pipeline] First spatial update ...")
-        A_new, mask, norm_fac = update_spatial(
-            Y_hw_chk, A, C, sn_spatial, **param_first_spatial
-        )
-        C_new = save_minian(
-            (C.sel(unit_id=mask) * norm_fac).rename("C_new"), intpath, overwrite=True
-        )
-        C_chk_new = save_minian(
-            (C_chk.sel(unit_id=mask) * norm_fac).rename("C_chk_new"), intpath, overwrite=True
-        )
-        b_new, f_new = update_background(Y_fm_chk, A_new, C_chk_new)
+def _stage_render(ctx: StageContext, state: dict) -> dict:
+    render_cnmf_video(
+        state["varr"].sel(ctx.params["subset"]),
+        state["Y_fm_chk"],
+        state["A"],
+        state["C_chk"],
+        ctx.output_dir,
+    )
+    return {}
+
+
+def _stage_render_handoff(ctx: StageContext, state: dict) -> dict:
+    """Compute-only mode: keep what the videos need for render.py and skip encoding."""
+    arrays = {role: ctx.var_paths[role] for role in ("varr", "varr_ref", "Y_fm_chk", "A", "C_chk")}
+    write_render_job(ctx.output_dir, arrays, ctx.params["subset"], movable_root=ctx.store.root)
+    return {}
+
+
+def _stage_qa_bundle(ctx: StageContext, state: dict) -> dict:
+    """Preview mode: seed / unit counts and the footprint overlay instead of videos."""
+    units = {k[len("units_after_"):]: v for k, v in state.items() if k.startswith("units_after_")}
+    summary = {
+        "preview": ctx.params.get("preview"),
+        "downsample": ctx.params["param_load_videos"]["downsample"],
+        "video_subset": ctx.params["param_video_subset"],
+        "frame_size": [int(state["max_proj"].sizes["height"]), int(state["max_proj"].sizes["width"])],
+        "seed_counts": state.get("seed_counts"),
+        "units_after_stage": units,
+        "final_units": int(state["A"].sizes["unit_id"]),
+    }
+    write_qa_bundle(ctx.output_dir, state["max_proj"], state["A"], summary)
+    return {}
+
+
+def _stage_postprocessing(ctx: StageContext, state: dict) -> dict:
+    """Export, binarize and plot the final C straight from memory (see postprocess.py)."""
+    _script_dir = os.path.join(_THIS_DIR, "scripts")
+    param = ctx.params["param_postprocessing"]
+    postprocess(
+        state["C"],
+        ctx.param_save_minian["dpath"],
+        ctx.output_dir,
+        sampling_frequency=param["sampling_frequency"],
+        z_threshold=param["z_threshold"],
+        formats=tuple(param["formats"]),
+        figure=not ctx.params.get("compute_only"),
+    )
 
-        A = save_minian(
-            A_new.rename("A"),
-            intpath,
-            overwrite=True,
-            chunks={"unit_id": 1, "height": -1, "width": -1},
+    map_path = os.path.join(_script_dir, "map.py")
+    if not os.path.exists(map_path):
+        print(f"[pipeline] INFO: map.py not found at {map_path}; skipping.")
+
+    return {}
+
+
+_SPATIAL_INPUTS = ("Y_fm_chk", "Y_hw_chk", "chk", "A", "C", "C_chk", "sn_spatial")
+_TEMPORAL_INPUTS = ("Y_fm_chk", "chk", "A", "b", "f", "C", "C_chk")
+
+_FINAL_STAGE = Stage(
+    "finalize",
+    _stage_finalize,
+    params=("param_footprint_format",),
+    inputs=("A", "C", "S", "c0", "b0", "b", "f"),
+    kind="io",
+)
+
+_CORE_STAGES = [
+    Stage(
+        "ingest",
+        _stage_ingest,
+        params=("param_load_videos", "param_video_subset"),
+        kind="io",
+    ),
+    Stage(
+        "preprocessing",
+        _stage_preprocessing,
+        params=("subset", "param_denoise", "param_background_removal"),
+        inputs=("varr", "varr_min"),
+    ),
+    Stage(
+        "motion_correction",
+        _stage_motion_correction,
+        params=("subset_mc", "param_estimate_motion", "param_motion_mode"),
+        inputs=("varr_ref", "chk"),
+    ),
+    Stage(
+        "initialization",
+        _stage_initialization,
+        params=(
+            "param_seeds_init",
+            "param_pnr_refine",
+            "param_ks_refine",
+            "param_seeds_merge",
+            "param_initialize",
+            "param_init_merge",
+            "unit_batch",
+        ),
+        inputs=("Y_fm_chk", "Y_hw_chk", "chk"),
+    ),
+    Stage(
+        "spatial_noise",
+        _stage_spatial_noise,
+        params=("param_get_noise",),
+        inputs=("Y_hw_chk",),
+    ),
+    Stage(
+        "first_spatial",
+        functools.partial(_stage_spatial_update, param_key="param_first_spatial", label="First"),
+        params=("param_first_spatial",),
+        inputs=_SPATIAL_INPUTS,
+    ),
+    Stage(
+        "first_temporal",
+        functools.partial(_stage_temporal_update, param_key="param_first_temporal", label="First"),
+        params=("param_first_temporal", "unit_batch"),
+        inputs=_TEMPORAL_INPUTS,
+    ),
+    Stage(
+        "first_merge",
+        _stage_first_merge,
+        params=("param_first_merge",),
+        inputs=("A", "C", "b0", "c0", "chk"),
+    ),
+    Stage(
+        "second_spatial",
+        functools.partial(_stage_spatial_update, param_key="param_second_spatial", label="Second"),
+        params=("param_second_spatial",),
+        inputs=_SPATIAL_INPUTS,
+    ),
+    Stage(
+        "second_temporal",
+        functools.partial(_stage_temporal_update, param_key="param_second_temporal", label="Second"),
+        params=("param_second_temporal", "unit_batch"),
+        inputs=_TEMPORAL_INPUTS,
+    ),
+    _FINAL_STAGE,
+]
+
+# Fixed-footprint mode: pre-processing and motion correction as above, then only
+# the background and temporal updates on a given A
+_FIXED_FOOTPRINT_STAGES = [
+    *_CORE_STAGES[:3],
+    Stage(
+        "footprint_init",
+        _stage_footprint_init,
+        params=("footprints", "footprints_mtime", "unit_batch"),
+        inputs=("Y_fm_chk", "chk"),
+    ),
+    Stage(
+        "fixed_temporal",
+        functools.partial(_stage_temporal_update, param_key="param_second_temporal", label="Fixed-footprint"),
+        params=("param_second_temporal", "unit_batch"),
+        inputs=_TEMPORAL_INPUTS,
+    ),
+    _FINAL_STAGE,
+]
+
+
+def pipeline_stages(
+    compute_only: bool = False, fixed_footprints: bool = False, preview: bool = False
+) -> list[Stage]:
+    """
+    Stage list of run_pipeline. In compute-only mode the final video is not
+    rendered; the arrays it needs are handed off to render.py instead. With
+    fixed_footprints the seed / initialization / spatial stages are replaced by
+    trace extraction on the footprints given to run_pipeline. A preview run
+    writes a QA bundle instead of any video.
+    """
+    if preview:
+        render_stage = Stage(
+            "qa_bundle",
+            _stage_qa_bundle,
+            inputs=("max_proj", "A"),
+            kind="io",
         )
-        b = save_minian(b_new.rename("b"), intpath, overwrite=True)
-        f = save_minian(
-            f_new.chunk({"frame": chk["frame"]}).rename("f"), intpath, overwrite=True
+    elif compute_only:
+        render_stage = Stage(
+            "render_handoff",
+            _stage_render_handoff,
+            params=("subset",),
+            inputs=("varr", "varr_ref", "Y_fm_chk", "A", "C_chk"),
+            kind="io",
         )
-        C = save_minian(C_new.rename("C"), intpath, overwrite=True)
-        C_chk = save_minian(C_chk_new.rename("C_chk"), intpath, overwrite=True)
-
-        # -------------------------------------------------------------------
-        # First temporal update
-        # -------------------------------------------------------------------
-        print("[pipeline] Computing trace (1st temporal) ...")
-        YrA = save_minian(
-            compute_trace(Y_fm_chk, A, b, C_chk, f).rename("YrA"),
-            intpath,
-            overwrite=True,
-            chunks={"unit_id": 1, "frame": -1},
+    else:
+        render_stage = Stage(
+            "render",
+            _stage_render,
+            params=("subset",),
+            inputs=("varr", "Y_fm_chk", "A", "C_chk"),
         )
+    return [
+        *(_FIXED_FOOTPRINT_STAGES if fixed_footprints else _CORE_STAGES),
+        render_stage,
+        Stage(
+            "postprocessing",
+            _stage_postprocessing,
+            params=("param_postprocessing",),
+            inputs=("C",),
+            checkpoint=False,
+            kind="io",
+        ),
+    ]
+
+
+PIPELINE_STAGES = pipeline_stages()
+
+
+def start_cluster(
+    n_workers: int | None = None,
+    dashboard_address: str | None = None,
+    threads_per_worker: int = 4,
+    memory_limit: str = "7GB",
+) -> tuple[LocalCluster, Client]:
+    """
+    Start the LocalCluster used by run_pipeline, with the Minian TaskAnnotation
+    plugin and the stage task counter registered on its scheduler.
 
-        print("[pipeline] First temporal update ...")
-        # Use a clean sub-directory for intermediate results so open_minian()
-        # only finds valid zarr stores during this step
-        _intpath_orig = intpath
-        intpath = os.path.join(_intpath_orig, "_tmp_update_temporal")
-        if os.path.exists(intpath):
-            _shutil.rmtree(intpath)
-        os.makedirs(intpath)
-        os.environ["MINIAN_INTERMEDIATE"] = intpath
-
-        try:
-            C_new, S_new, b0_new, c0_new, g, mask = update_temporal(
-                A, C, YrA=YrA, **param_first_temporal
-            )
-        finally:
-            intpath = _intpath_orig
-            os.environ["MINIAN_INTERMEDIATE"] = intpath
+    The dashboard binds to a free port by default (MINIAN_DASHBOARD to pin one),
+    so several clusters on one node do not collide on :8787.
+    Pass the result of cluster_sizing.plan_cluster() to size it automatically.
+    """
+    sys.path.append(MINIAN_PATH)
+    from minian.utilities import TaskAnnotation
 
-        C = save_minian(
-            C_new.rename("C").chunk({"unit_id": 1, "frame": -1}), intpath, overwrite=True
-        )
-        C_chk = save_minian(
-            C.rename("C_chk"),
-            intpath,
-            overwrite=True,
-            chunks={"unit_id": -1, "frame": chk["frame"]},
-        )
-        S = save_minian(
-            S_new.rename("S").chunk({"unit_id": 1, "frame": -1}), intpath, overwrite=True
-        )
-        b0 = save_minian(
-            b0_new.rename("b0").chunk({"unit_id": 1, "frame": -1}), intpath, overwrite=True
-        )
-        c0 = save_minian(
-            c0_new.rename("c0").chunk({"unit_id": 1, "frame": -1}), intpath, overwrite=True
-        )
-        A = A.sel(unit_id=C.coords["unit_id"].values)
-
-        # -------------------------------------------------------------------
-        # Merge units (between CNMF iterations)
-        # -------------------------------------------------------------------
-        print("[pipeline] Merging units (first merge) ...")
-        A_mrg, C_mrg, [sig_mrg] = unit_merge(A, C, [C + b0 + c0], **param_first_merge)
-
-        A = save_minian(A_mrg.rename("A_mrg"), intpath, overwrite=True)
-        C = save_minian(C_mrg.rename("C_mrg"), intpath, overwrite=True)
-        C_chk = save_minian(
-            C.rename("C_mrg_chk"),
-            intpath,
-            overwrite=True,
-            chunks={"unit_id": -1, "frame": chk["frame"]},
-        )
-        sig = save_minian(sig_mrg.rename("sig_mrg"), intpath, overwrite=True)
-
-        # -------------------------------------------------------------------
-        # Second spatial update
-        # -------------------------------------------------------------------
-        print("[pipeline] Second spatial update ...")
-        A_new, mask, norm_fac = update_spatial(
-            Y_hw_chk, A, C, sn_spatial, **param_second_spatial
-        )
-        C_new = save_minian(
-            (C.sel(unit_id=mask) * norm_fac).rename("C_new"), intpath, overwrite=True
-        )
-        C_chk_new = save_minian(
-            (C_chk.sel(unit_id=mask) * norm_fac).rename("C_chk_new"), intpath, overwrite=True
-        )
-        b_new, f_new = update_background(Y_fm_chk, A_new, C_chk_new)
+    if n_workers is None:
+        n_workers = int(os.getenv("MINIAN_NWORKERS", 4))
+    if dashboard_address is None:
+        dashboard_address = os.getenv("MINIAN_DASHBOARD", ":0")
 
-        A = save_minian(
-            A_new.rename("A"),
-            intpath,
-            overwrite=True,
-            chunks={"unit_id": 1, "height": -1, "width": -1},
-        )
-        b = save_minian(b_new.rename("b"), intpath, overwrite=True)
-        f = save_minian(
-            f_new.chunk({"frame": chk["frame"]}).rename("f"), intpath, overwrite=True
-        )
-        C = save_minian(C_new.rename("C"), intpath, overwrite=True)
-        C_chk = save_minian(C_chk_new.rename("C_chk"), intpath, overwrite=True)
-
-        # -------------------------------------------------------------------
-        # Second temporal update
-        # -------------------------------------------------------------------
-        print("[pipeline] Computing trace (2nd temporal) ...")
-        YrA = save_minian(
-            compute_trace(Y_fm_chk, A, b, C_chk, f).rename("YrA"),
-            intpath,
-            overwrite=True,
-            chunks={"unit_id": 1, "frame": -1},
-        )
+    print(
+        f"[pipeline] Starting Dask cluster ({n_workers} workers x "
+        f"{threads_per_worker} threads, {memory_limit} each) ..."
+    )
+    cluster = LocalCluster(
+        n_workers=n_workers,
+        memory_limit=memory_limit,
+        resources={"MEM": 1},
+        threads_per_worker=threads_per_worker,
+        dashboard_address=dashboard_address,
+        processes=True,
+    )
+    annt_plugin = TaskAnnotation()
+    cluster.scheduler.add_plugin(annt_plugin)
+    cluster.scheduler.add_plugin(TaskCounter())
+    client = Client(cluster)
+    print(f"[pipeline] Dask dashboard: {client.dashboard_link}")
+    return cluster, client
 
-        print("[pipeline] Second temporal update ...")
-        C_new, S_new, b0_new, c0_new, g, mask = update_temporal(
-            A, C, YrA=YrA, **param_second_temporal
-        )
 
-        C = save_minian(
-            C_new.rename("C").chunk({"unit_id": 1, "frame": -1}), intpath, overwrite=True
-        )
-        C_chk = save_minian(
-            C.rename("C_chk"),
-            intpath,
-            overwrite=True,
-            chunks={"unit_id": -1, "frame": chk["frame"]},
-        )
-        S = save_minian(
-            S_new.rename("S").chunk({"unit_id": 1, "frame": -1}), intpath, overwrite=True
-        )
-        b0 = save_minian(
-            b0_new.rename("b0").chunk({"unit_id": 1, "frame": -1}), intpath, overwrite=True
+def restart_workers(client: Client) -> None:
+    """
+    Release worker memory between sessions on a reused cluster.
+
+    Restarts the worker processes (the scheduler, its plugins and the dashboard
+    stay up), which is much cheaper than tearing down and rebuilding the cluster.
+    """
+    print("[pipeline] Restarting Dask workers ...")
+    try:
+        client.restart()
+    except Exception as exc:
+        print(f"[pipeline] WARNING: worker restart failed: {exc}")
+
+
+def _connect_client(client) -> tuple[Client, bool]:
+    """
+    Turn the `client` argument of run_pipeline into a Client.
+
+    Returns the client and whether run_pipeline opened it (and must close it).
+    """
+    if isinstance(client, Client):
+        return client, False
+    if isinstance(client, str):
+        return Client(client), True
+    # Any cluster object (LocalCluster, SLURMCluster, ...)
+    return Client(client), True
+
+
+def _cluster_config(client: Client) -> dict:
+    """Worker count, threads and memory limit of the cluster behind `client`."""
+    # n_workers=-1: by default scheduler_info only reports the first 5 workers
+    workers = client.scheduler_info(n_workers=-1).get("workers", {}).values()
+    return {
+        "n_workers": len(workers),
+        "threads_per_worker": max((w.get("nthreads", 0) for w in workers), default=0),
+        "memory_limit_bytes": max((w.get("memory_limit", 0) for w in workers), default=0),
+    }
+
+
+def run_pipeline(
+    dpath: str,
+    output_dir: str | None = None,
+    params: dict | None = None,
+    resume: bool = True,
+    client: Client | LocalCluster | str | None = None,
+    intpath: str | None = None,
+    stop_after: str | None = None,
+    cluster_size: str | dict | None = None,
+    keep_intermediate: bool = False,
+    compressor=None,
+    compute_only: bool = False,
+    render_in_background: bool = False,
+    footprints: str | None = None,
+    dry_run: bool = False,
+    profile_dirs: list[str] | None = None,
+    oom_retries: int = 2,
+    preview: bool | dict = False,
+    stage_slots: dict | None = None,
+) -> dict | None:
+    """
+    Run the full Minian CNMF pipeline on a single session folder.
+
+    Parameters
+    ----------
+    dpath : str
+        Path to the local folder that contains the raw .avi videos.
+        When called from low_level_loop.py this is the /scratch download path.
+    output_dir : str | None
+        Output folder where minian arrays, videos, CSVs, and figures are saved.
+        If None, outputs are written inside dpath (original behavior).
+    params : dict | None
+        Overrides for default_params(), keyed by parameter name
+        (e.g. {"param_first_spatial": {...}}). Each given entry replaces the default.
+    resume : bool
+        Skip stages recorded as complete in the stage manifest (default True).
+        False discards the manifest and recomputes everything.
+    client : Client | LocalCluster | str | None
+        An existing Client, a cluster object or a scheduler address to run on.
+        That cluster is left running afterwards (register TaskAnnotation on it,
+        or create it with start_cluster()). If None, a LocalCluster is started
+        and closed for this call.
+    intpath : str | None
+        Folder for intermediate zarr stores (default <output_dir>/minian_intermediate).
+        Runs that execute at the same time need different folders.
+    stop_after : str | None
+        Name of the last stage to run (see PIPELINE_STAGES), e.g. "spatial_noise"
+        to compute only the shared pre-processing / motion / initialization part.
+    cluster_size : "auto" | dict | None
+        Size of the LocalCluster started when no client is given. "auto" sizes it
+        from the cores / memory available to the job (SLURM, cgroups) and the input
+        movie size (see cluster_sizing.plan_cluster); a dict is passed on to
+        start_cluster (n_workers, threads_per_worker, memory_limit). None keeps the
+        fixed defaults, unless MINIAN_CLUSTER_SIZE=auto is set.
+    keep_intermediate : bool
+        Keep every intermediate array instead of deleting it once no later stage
+        needs it (always the case with stop_after). Makes reruns with changed
+        late-stage parameters cheaper, at the cost of scratch space.
+    compressor : None | str | codec
+        Compressor for intermediate arrays, e.g. "zstd" or "zstd:5" for Blosc zstd
+        with byte shuffle (default: MINIAN_COMPRESSOR, else the zarr default).
+    compute_only : bool
+        Headless mode: skip all visualization (holoviews, MP4 encoding, figures).
+        The arrays the videos need are kept in <output_dir>/render_inputs so
+        render.py can produce them later. Also enabled by MINIAN_COMPUTE_ONLY=1.
+    render_in_background : bool
+        With compute_only, start render.py as a low-priority background process
+        once the scientific outputs are saved.
+    footprints : str | None
+        Path to an existing A.zarr or A_sparse (or a minian output folder with one),
+        already registered to this session's max projection. C / S are then
+        extracted with only the background and second temporal update, skipping
+        seeds, initialization and the spatial updates. The unit_ids of A are kept.
+    dry_run : bool
+        Only read the video headers and print the predicted per-stage runtime,
+        peak memory, scratch disk and a recommended cluster / SLURM request (see
+        preflight.py); nothing is computed. Returns the estimate.
+    profile_dirs : list[str] | None
+        Folders with previous runs whose pipeline_profile.json calibrate the
+        dry-run estimate (default: the parent folder of output_dir).
+    oom_retries : int
+        How often a stage that lost a worker to the memory limit (KilledWorker /
+        MemoryError) is retried, first with halved chunks, then with quartered
+        chunks and one task per worker. Downgrades are logged and recorded in
+        the profile. 0 fails straight away.
+    preview : bool | dict
+        Fast low-resolution QA run into <output_dir>/preview: the first
+        frames_per_file frames of the first n_files videos, factor times stronger
+        spatial downsampling, pixel-sized parameters scaled to match, no videos,
+        and a QA bundle (seed / unit counts, max projection with footprints) in
+        <output_dir>/preview/qa. A dict overrides factor, n_files and
+        frames_per_file (see preview.py).
+    stage_slots : dict | None
+        Limit on stages of each kind ("io", "compute") running at once across all
+        run_pipeline calls on the same cluster, e.g. {"io": 1, "compute": 3}.
+        Used by multi_session.py to interleave several sessions.
+    """
+
+    pipeline_start = time.time()
+
+    # -----------------------------------------------------------------------
+    # Add minian to path
+    # -----------------------------------------------------------------------
+    sys.path.append(MINIAN_PATH)
+
+    # -----------------------------------------------------------------------
+    # Parameters
+    # -----------------------------------------------------------------------
+    dpath = os.path.abspath(dpath)
+    output_dir = os.path.abspath(output_dir) if output_dir else dpath
+    if preview:
+        preview = {**DEFAULT_PREVIEW, **(preview if isinstance(preview, dict) else {})}
+        output_dir = os.path.join(output_dir, "preview")
+    os.makedirs(output_dir, exist_ok=True)
+
+    minian_ds_path = os.path.join(output_dir, "minian")
+    intpath = os.path.abspath(intpath or os.path.join(output_dir, "minian_intermediate"))
+
+    param_save_minian = {
+        "dpath": minian_ds_path,
+        "meta_dict": dict(session=-1, animal=-2),
+        "overwrite": True,
+    }
+
+    compute_only = compute_only or os.getenv("MINIAN_COMPUTE_ONLY") == "1"
+    run_params = default_params()
+    run_params.update(params or {})
+    if preview:
+        run_params = preview_params(run_params, preview)
+        run_params["preview"] = preview
+        compute_only = True
+
+    if dry_run:
+        stages = pipeline_stages(compute_only, fixed_footprints=footprints is not None, preview=bool(preview))
+        stage_names = [stage.name for stage in stages]
+        est = estimate(
+            dpath,
+            profile_dirs or [os.path.dirname(output_dir)],
+            run_params["param_load_videos"],
+            stages=stage_names,
         )
-        c0 = save_minian(
-            c0_new.rename("c0").chunk({"unit_id": 1, "frame": -1}), intpath, overwrite=True
+        print_estimate(est)
+        return est
+
+    run_params["compute_only"] = compute_only
+    if footprints is not None:
+        footprints = os.path.abspath(footprints)
+        for name in ("A.zarr", SPARSE_A_NAME):
+            if os.path.isdir(os.path.join(footprints, name)):
+                footprints = os.path.join(footprints, name)
+                break
+        # Hashed with the store's mtime so re-registered footprints rerun the extraction
+        run_params["footprints"] = footprints
+        run_params["footprints_mtime"] = store_mtime(footprints)
+
+    stages = pipeline_stages(
+        compute_only, fixed_footprints=footprints is not None, preview=bool(preview)
+    )
+    if stop_after is not None:
+        names = [stage.name for stage in stages]
+        if stop_after not in names:
+            raise ValueError(f"Unknown stage '{stop_after}'; expected one of {names}")
+        stages = stages[: names.index(stop_after) + 1]
+
+    os.environ["OMP_NUM_THREADS"] = "1"
+    os.environ["MKL_NUM_THREADS"] = "1"
+    os.environ["OPENBLAS_NUM_THREADS"] = "1"
+    os.environ["MINIAN_INTERMEDIATE"] = intpath
+
+    manifest = StageManifest(os.path.join(output_dir, MANIFEST_NAME))
+    if not resume:
+        manifest.clear()
+
+    store = IntermediateStore(
+        intpath,
+        compressor=compressor or os.getenv("MINIAN_COMPRESSOR"),
+        keep=keep_intermediate or stop_after is not None,
+    )
+
+    def make_context(stage_name: str) -> StageContext:
+        return StageContext(
+            stage_name, store, dpath, output_dir, run_params, param_save_minian
         )
-        A = A.sel(unit_id=C.coords["unit_id"].values)
-
-        # ===================================================================
-        # FINAL VISUALISATIONS & SAVE
-        # ===================================================================
-        print("[pipeline] Generating output video ...")
-        generate_videos(varr.sel(subset), Y_fm_chk, A=A, C=C_chk, vpath=output_dir)
-
-        print("[pipeline] Saving final results ...")
-        A  = save_minian(A.rename("A"),   **param_save_minian)
-        C  = save_minian(C.rename("C"),   **param_save_minian)
-        S  = save_minian(S.rename("S"),   **param_save_minian)
-        c0 = save_minian(c0.rename("c0"), **param_save_minian)
-        b0 = save_minian(b0.rename("b0"), **param_save_minian)
-        b  = save_minian(b.rename("b"),   **param_save_minian)
-        f  = save_minian(f.rename("f"),   **param_save_minian)
-
-        # ===================================================================
-        # POST-PROCESSING SCRIPTS (convert_to_csv, plotting, map)
-        # ===================================================================
-        _script_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts")
-
-        def _load_module_from_file(module_name: str, file_path: str):
-            spec = importlib.util.spec_from_file_location(module_name, file_path)
-            if spec is None or spec.loader is None:
-                raise ImportError(f"Could not load module '{module_name}' from {file_path}")
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
-            return module
-
-        try:
-            convert_mod = _load_module_from_file(
-                "convert_to_csv", os.path.join(_script_dir, "convert_to_csv.py")
-            )
-            print("[pipeline] Running convert_to_csv.py ...")
-            convert_mod.convert_to_csv(param_save_minian=param_save_minian, file_name="C.csv")
-        except Exception as exc:
-            print(f"[pipeline] WARNING: convert_to_csv failed: {exc}")
-
-        try:
-            binary_mod = _load_module_from_file(
-                "bina_csv_data", os.path.join(_script_dir, "bina_csv_data.py")
-            )
-            c_csv = os.path.join(minian_ds_path, "C.csv")
-            if os.path.exists(c_csv):
-                print("[pipeline] Running bina_csv_data.py ...")
-                df_binary, df_filtered, df_normalized, df_derivative = binary_mod.process_calcium_data(c_csv)
-                df_binary.to_csv(os.path.join(minian_ds_path, "C_binary.csv"), index=False)
-                df_filtered.to_csv(os.path.join(minian_ds_path, "C_filtered.csv"), index=False)
-                df_normalized.to_csv(os.path.join(minian_ds_path, "C_normalized.csv"), index=False)
-                df_derivative.to_csv(os.path.join(minian_ds_path, "C_derivative.csv"), index=False)
-            else:
-                print(f"[pipeline] WARNING: C.csv not found at {c_csv}; skipping bina_csv_data")
-        except Exception as exc:
-            print(f"[pipeline] WARNING: bina_csv_data failed: {exc}")
-
-        try:
-            plotting_mod = _load_module_from_file(
-                "plotting", os.path.join(_script_dir, "plotting.py")
+
+    # -----------------------------------------------------------------------
+    # Module initialisation
+    # -----------------------------------------------------------------------
+    if not compute_only:
+        # Only the rendering needs holoviews; compute-only runs never import it
+        import holoviews as hv
+
+        hv.extension("bokeh", logo=False)
+
+    # -----------------------------------------------------------------------
+    # Start Dask cluster (or connect to the one we were given)
+    # -----------------------------------------------------------------------
+    if cluster_size is None and os.getenv("MINIAN_CLUSTER_SIZE") == "auto":
+        cluster_size = "auto"
+    cluster_plan = None
+    if client is None:
+        if cluster_size == "auto":
+            cluster_plan = plan_cluster(
+                dpath,
+                run_params["param_load_videos"]["pattern"],
+                run_params["param_load_videos"].get("downsample"),
             )
-            c_binary_csv = os.path.join(minian_ds_path, "C_binary.csv")
-            if os.path.exists(c_binary_csv):
-                print("[pipeline] Running plotting.py ...")
-                plotting_mod.plot_cells(file_name="C_binary.csv", csv_path=c_binary_csv, save_figure=True)
-            else:
-                print(f"[pipeline] WARNING: C_binary.csv not found at {c_binary_csv}; skipping plotting")
-        except Exception as exc:
-            print(f"[pipeline] WARNING: plotting failed: {exc}")
-
-        map_path = os.path.join(_script_dir, "map.py")
-        if not os.path.exists(map_path):
-            print(f"[pipeline] INFO: map.py not found at {map_path}; skipping.")
+            print(f"[pipeline] Auto cluster size: {cluster_plan}")
+            cluster_kwargs = {
+                k: cluster_plan[k] for k in ("n_workers", "threads_per_worker", "memory_limit")
+            }
+        else:
+            cluster_kwargs = dict(cluster_size or {})
+        cluster, client = start_cluster(**cluster_kwargs)
+        owns_client = True
+    else:
+        cluster = None
+        client, owns_client = _connect_client(client)
+        print(f"[pipeline] Using existing Dask cluster at {client.scheduler.address}")
+
+    profiler = StageProfiler(
+        client,
+        os.path.join(output_dir, PROFILE_NAME),
+        meta={
+            "dpath": dpath,
+            **_cluster_config(client),
+            "cluster_plan": cluster_plan,
+            "shared_cluster": cluster is None,
+            "fixed_footprints": footprints is not None,
+            "compute_only": compute_only,
+            "preview": bool(preview),
+        },
+    )
+
+    state = {}
+    try:
+        run_stages(
+            stages,
+            state,
+            params=run_params,
+            manifest=manifest,
+            root_hash=param_hash({"dpath": dpath}),
+            make_context=make_context,
+            profiler=profiler,
+            store=store,
+            oom_retries=oom_retries,
+            gate=slot_gate(stage_slots) if stage_slots else None,
+        )
+        store.cleanup()
 
     finally:
-        # Always close cluster, even if something fails mid-pipeline
-        print("[pipeline] Closing Dask cluster ...")
-        client.close()
-        cluster.close()
+        # Size of the movie actually processed (after downsample, video subset
+        # and preview subset), used to calibrate preflight.py
+        if "varr" in state:
+            profiler.record["meta"]["input_voxels"] = int(np.prod(state["varr"].shape))
+        profiler.record["peak_scratch_bytes"] = store.peak
+        profiler.write()
+        # Always close our own cluster, even if something fails mid-pipeline
+        if owns_client:
+            client.close()
+        if cluster is not None:
+            print("[pipeline] Closing Dask cluster ...")
+            cluster.close()
 
     pipeline_end = time.time()
     total_runtime = pipeline_end - pipeline_start
@@ -565,6 +1166,11 @@ def run_pipeline(dpath: str, output_dir: str | None = None) -> None:
         f"[pipeline] Done. Total runtime: {total_runtime:.2f}s "
         f"({total_runtime / 60:.2f} min)"
     )
+    if compute_only and render_in_background and stop_after is None and not preview:
+        spawn_renderer(output_dir, minian_path=os.path.abspath(MINIAN_PATH))
+    print(f"[pipeline] Peak intermediate scratch usage: {store.peak / 1024**3:.2f} GB")
+    print(f"[pipeline] Stage profile written to {profiler.path}")
+    return None
 
 
 # ---------------------------------------------------------------------------
@@ -0,0 +1,176 @@
+"""
+Post-processing of the final traces
+-----------------------------------
+Turns the final C (unit_id x frame) into the tables and figure next to the
+minian outputs without a round trip through disk. C is read once into a wide
+frame x cell_<unit_id> table, and every step below works on that in-memory
+table:
+
+    traces                 C DataArray -> wide table
+    ├── export_csv         C.csv
+    ├── export_parquet     C.parquet (needs pyarrow or fastparquet)
+    └── binarize           C_binary / C_filtered / C_normalized / C_derivative .csv
+        └── figure         Figure_1.pdf (not in compute-only mode)
+
+Steps run in a thread pool as soon as their inputs are ready. A failing step is
+reported with its error; only the steps depending on it are skipped. The
+per-step status and runtime are written to <output_dir>/postprocessing_report.json.
+"""
+
+import importlib.util
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+REPORT_NAME = "postprocessing_report.json"
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts")
+
+
+def _load_script(module_name: str):
+    """Load one of the scripts/ modules (they are not a package)."""
+    file_path = os.path.join(SCRIPT_DIR, module_name + ".py")
+    spec = importlib.util.spec_from_file_location(module_name, file_path)
+    if spec is None or spec.loader is None:
+        raise ImportError(f"Could not load module '{module_name}' from {file_path}")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _parquet_engine() -> str | None:
+    for engine in ("pyarrow", "fastparquet"):
+        if importlib.util.find_spec(engine) is not None:
+            return engine
+    return None
+
+
+def traces_table(C: xr.DataArray) -> pd.DataFrame:
+    """Wide table with a 'frame' column and one 'cell_<unit_id>' column per unit (as C.csv)."""
+    C = C.sortby("unit_id").transpose("frame", "unit_id")
+    df = pd.DataFrame(
+        np.asarray(C.values),
+        columns=[f"cell_{uid}" for uid in C.coords["unit_id"].values],
+    )
+    df.insert(0, "frame", C.coords["frame"].values)
+    return df
+
+
+def run_steps(steps: dict[str, tuple[Callable, tuple[str, ...]]], max_workers: int = 4) -> tuple[dict, dict]:
+    """
+    Run a small DAG of steps concurrently.
+
+    steps : dict
+        name -> (fn, dependencies); fn is called with the results of its
+        dependencies, in order.
+
+    Returns the results of the successful steps and a report per step
+    ({"status": "ok" | "failed" | "skipped", "seconds", "error"}).
+    """
+    pending = dict(steps)
+    results, report, running = {}, {}, {}
+
+    def timed(fn, *args):
+        start = time.time()
+        return fn(*args), time.time() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name, (fn, deps) in list(pending.items()):
+                broken = [dep for dep in deps if report.get(dep, {}).get("status") in ("failed", "skipped")]
+                if broken:
+                    report[name] = {"status": "skipped", "seconds": None, "error": f"needs {broken}"}
+                    del pending[name]
+                elif all(dep in results for dep in deps):
+                    running[pool.submit(timed, fn, *(results[dep] for dep in deps))] = name
+                    del pending[name]
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name], seconds = future.result()
+                    report[name] = {"status": "ok", "seconds": round(seconds, 2), "error": None}
+                except Exception as exc:
+                    report[name] = {"status": "failed", "seconds": None, "error": f"{type(exc).__name__}: {exc}"}
+                    print(f"[postprocess] ERROR: step '{name}' failed: {exc}")
+    return results, report
+
+
+def postprocess(
+    C: xr.DataArray,
+    minian_ds_path: str,
+    output_dir: str,
+    sampling_frequency: float = 30,
+    z_threshold: float = 2.0,
+    formats: tuple[str, ...] = ("csv", "parquet"),
+    figure: bool = True,
+) -> dict:
+    """
+    Export, binarize and plot the traces C; returns the per-step report.
+
+    Tables go to `minian_ds_path`, the report to `output_dir`. `formats` picks
+    the exports ("csv", "parquet"); figure=False skips Figure_1.pdf.
+    """
+    def export_csv(df):
+        path = os.path.join(minian_ds_path, "C.csv")
+        df.to_csv(path, index=False)
+        return path
+
+    def export_parquet(df):
+        path = os.path.join(minian_ds_path, "C.parquet")
+        df.to_parquet(path, index=False, engine=engine)
+        return path
+
+    def binarize(df):
+        # Loaded here, so a broken script only fails this step (and the figure)
+        binary_mod = _load_script("bina_csv_data")
+        tables = binary_mod.process_calcium_frame(df, sampling_frequency, z_threshold)
+        for suffix, table in zip(("binary", "filtered", "normalized", "derivative"), tables):
+            table.to_csv(os.path.join(minian_ds_path, f"C_{suffix}.csv"), index=False)
+        return tables[0]
+
+    def plot(df_binary):
+        import matplotlib
+
+        matplotlib.use("Agg")
+        plotting_mod = _load_script("plotting")
+        path = os.path.join(minian_ds_path, "Figure_1.pdf")
+        plotting_mod.plot_cells_frame(df_binary, save_path=path, show=False)
+        return path
+
+    steps = {"traces": (lambda: traces_table(C), ())}
+    skipped = {}
+    if "csv" in formats:
+        steps["export_csv"] = (export_csv, ("traces",))
+    engine = _parquet_engine()
+    if "parquet" in formats:
+        if engine is not None:
+            steps["export_parquet"] = (export_parquet, ("traces",))
+        else:
+            skipped["export_parquet"] = "neither pyarrow nor fastparquet is installed"
+    steps["binarize"] = (binarize, ("traces",))
+    if figure:
+        steps["figure"] = (plot, ("binarize",))
+    else:
+        skipped["figure"] = "compute-only: figure deferred to render.py"
+
+    print(f"[postprocess] Running {', '.join(steps)} ...")
+    _, report = run_steps(steps)
+    for name, reason in skipped.items():
+        report[name] = {"status": "skipped", "seconds": None, "error": reason}
+
+    with open(os.path.join(output_dir, REPORT_NAME), "w") as fh:
+        json.dump(report, fh, indent=2)
+    failed = [name for name, entry in report.items() if entry["status"] == "failed"]
+    print(
+        f"[postprocess] {sum(e['status'] == 'ok' for e in report.values())}/{len(report)} steps ok"
+        + (f"; failed: {failed}" if failed else "")
+    )
+    return report
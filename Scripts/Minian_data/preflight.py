@@ -0,0 +1,298 @@
+"""
+Pre-flight cost estimate for run_pipeline
+-----------------------------------------
+Predicts what a session will cost before a SLURM job is submitted, without
+decoding any video:
+
+    1. the AVI headers matched by param_load_videos["pattern"] give the frame
+       count and frame size; the configured downsample gives the movie size
+       (voxels = frames x height x width) the pipeline will actually process
+    2. previous runs' pipeline_profile.json files in the same mode (full or
+       fixed-footprint; preview runs and runs on a shared cluster are
+       skipped) calibrate, per stage,
+         runtime      core-seconds per voxel (wall time x cores / voxels)
+         peak memory  peak worker RSS (chunk-bound, so taken as the 90th percentile)
+       and overall the peak scratch bytes per voxel; only the stages the
+       requested run will execute are predicted
+    3. the cluster plan (cluster_sizing.plan_cluster) for this job is checked
+       against the predicted worker memory, and a walltime / memory request is
+       recommended
+
+Without previous profiles only the movie size, a rule-of-thumb scratch estimate
+and the cluster plan are reported.
+
+Usage
+-----
+    python preflight.py /scratch/s4750098/session_001 --profiles /scratch/s4750098/minian_outputs
+
+    # or from Python / through run_pipeline
+    run_pipeline(dpath, output_dir, dry_run=True)
+"""
+
+import argparse
+import glob
+import json
+import math
+import os
+import sys
+
+import numpy as np
+from dask.utils import parse_bytes
+
+from cluster_sizing import GB, available_cpus, available_memory, movie_bytes, plan_cluster, probe_videos
+from stage_profile import PROFILE_NAME
+
+# Scratch space without calibration: varr, varr_ref, Y_fm_chk, Y_hw_chk (+ split copy)
+# as float64, plus CNMF arrays
+UNCALIBRATED_SCRATCH_COPIES = 6
+# Stages that only run in fixed-footprint mode (pipeline._FIXED_FOOTPRINT_STAGES)
+FIXED_FOOTPRINT_STAGES = ("footprint_init", "fixed_temporal")
+# Safety margins on the recommendation
+WALLTIME_MARGIN = 1.3
+MEMORY_MARGIN = 1.2
+
+
+def _run_voxels(record: dict) -> int | None:
+    """Voxels processed by a profiled run (from its meta, else from the stored shapes)."""
+    voxels = record.get("meta", {}).get("input_voxels")
+    if voxels:
+        return int(voxels)
+    for stage in record.get("stages", []):
+        for name in ("varr", "varr_ref", "Y_fm_chk"):
+            shape = stage.get("store_shapes", {}).get(name)
+            if shape:
+                return int(math.prod(shape.values()))
+    return None
+
+
+def _fixed_footprints(record: dict) -> bool:
+    """Whether a profiled run extracted traces on fixed footprints."""
+    meta = record.get("meta", {})
+    if "fixed_footprints" in meta:
+        return bool(meta["fixed_footprints"])
+    return any(stage.get("stage") in FIXED_FOOTPRINT_STAGES for stage in record.get("stages", []))
+
+
+def _is_preview(record: dict) -> bool:
+    meta = record.get("meta", {})
+    if "preview" in meta:
+        return bool(meta["preview"])
+    return any(stage.get("stage") == "qa_bundle" for stage in record.get("stages", []))
+
+
+def load_profiles(roots: list[str], fixed_footprints: bool = False) -> list[dict]:
+    """
+    Profiles below `roots` that can calibrate a run in the given mode.
+
+    Runs in the other mode (their stages and scratch use differ), preview runs
+    (a short, heavily downsampled subset) and runs on a shared cluster (their
+    wall times depend on the other jobs) are skipped.
+    """
+    profiles = []
+    for root in roots:
+        for path in glob.glob(os.path.join(root, "**", PROFILE_NAME), recursive=True):
+            try:
+                with open(path, "r") as fh:
+                    record = json.load(fh)
+            except (OSError, ValueError):
+                continue
+            meta = record.get("meta", {})
+            if (
+                meta.get("shared_cluster")
+                or _is_preview(record)
+                or _fixed_footprints(record) != fixed_footprints
+            ):
+                continue
+            record["voxels"] = _run_voxels(record)
+            record["cores"] = meta.get("n_workers", 0) * meta.get("threads_per_worker", 0)
+            if record["voxels"] and record["cores"]:
+                profiles.append(record)
+    return profiles
+
+
+def calibrate(profiles: list[dict]) -> dict:
+    """Per-stage cost model from previous profiles."""
+    per_stage: dict[str, dict[str, list]] = {}
+    scratch = []
+    for record in profiles:
+        if record.get("peak_scratch_bytes"):
+            scratch.append(record["peak_scratch_bytes"] / record["voxels"])
+        for stage in record.get("stages", []):
+            if stage.get("skipped") or stage.get("status") != "ok":
+                continue
+            entry = per_stage.setdefault(stage["stage"], {"core_s_per_voxel": [], "peak_rss": []})
+            entry["core_s_per_voxel"].append(stage["wall_time_s"] * record["cores"] / record["voxels"])
+            entry["peak_rss"].append(stage.get("peak_rss_max_bytes", 0))
+
+    model = {"n_runs": len(profiles), "stages": {}, "scratch_bytes_per_voxel": None}
+    for name, entry in per_stage.items():
+        model["stages"][name] = {
+            "n": len(entry["core_s_per_voxel"]),
+            "core_s_per_voxel": float(np.median(entry["core_s_per_voxel"])),
+            "peak_rss_bytes": float(np.percentile(entry["peak_rss"], 90)),
+        }
+    if scratch:
+        model["scratch_bytes_per_voxel"] = float(np.median(scratch))
+    return model
+
+
+def _hms(seconds: float) -> str:
+    seconds = int(math.ceil(seconds))
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def estimate(
+    dpath: str,
+    profile_dirs: list[str] | None = None,
+    param_load_videos: dict | None = None,
+    cpus: int | None = None,
+    memory: int | None = None,
+    stages: list[str] | None = None,
+) -> dict:
+    """
+    Predict per-stage runtime, peak worker memory and scratch disk for `dpath`.
+
+    Parameters
+    ----------
+    dpath : str
+        Session folder with the raw videos (only their headers are read).
+    profile_dirs : list[str] | None
+        Folders searched recursively for previous pipeline_profile.json files.
+    param_load_videos : dict | None
+        pattern / downsample to apply (default: pipeline.default_params()).
+    cpus, memory : optional
+        Cores / bytes to plan for (default: what this job may use).
+    stages : list[str] | None
+        Names of the stages the run will execute (default: the full
+        pipeline.pipeline_stages()). Only these are predicted, and profiles
+        are taken from runs in the same mode.
+
+    Returns
+    -------
+    dict with the movie info, per-stage predictions, totals, the cluster plan
+    and the recommended SLURM request.
+    """
+    if param_load_videos is None or stages is None:
+        import pipeline
+
+        if param_load_videos is None:
+            param_load_videos = pipeline.default_params()["param_load_videos"]
+        if stages is None:
+            stages = [stage.name for stage in pipeline.pipeline_stages()]
+    downsample = param_load_videos.get("downsample") or {}
+    cpus = cpus or available_cpus()
+    memory = memory or available_memory(cpus)
+
+    video = probe_videos(dpath, param_load_videos["pattern"])
+    size = movie_bytes(video, downsample)
+    voxels = size // 8 if size else None
+    plan = plan_cluster(dpath, param_load_videos["pattern"], downsample, cpus=cpus, memory=memory)
+    cores = plan["n_workers"] * plan["threads_per_worker"]
+
+    fixed_footprints = any(name in FIXED_FOOTPRINT_STAGES for name in stages)
+    model = calibrate(load_profiles(profile_dirs or [], fixed_footprints))
+    predicted = {}
+    if voxels:
+        for name in stages:
+            coef = model["stages"].get(name)
+            if coef is None:
+                continue
+            predicted[name] = {
+                "runtime_s": round(coef["core_s_per_voxel"] * voxels / cores, 1),
+                "peak_worker_memory_bytes": int(coef["peak_rss_bytes"]),
+                "calibration_runs": coef["n"],
+            }
+
+    runtime = sum(s["runtime_s"] for s in predicted.values()) if predicted else None
+    worker_mem = max((s["peak_worker_memory_bytes"] for s in predicted.values()), default=0)
+    if voxels and model["scratch_bytes_per_voxel"]:
+        scratch = int(model["scratch_bytes_per_voxel"] * voxels)
+    else:
+        scratch = int(size * UNCALIBRATED_SCRATCH_COPIES) if size else None
+
+    # Raise the per-worker limit to the predicted peak, with fewer workers if needed
+    limit = max(parse_bytes(plan["memory_limit"]), worker_mem * MEMORY_MARGIN)
+    n_workers = min(plan["n_workers"], max(int((memory * 0.9) // limit), 1))
+    recommendation = {
+        "n_workers": n_workers,
+        "threads_per_worker": plan["threads_per_worker"],
+        "memory_limit": f"{limit / GB:.1f}GiB",
+        "slurm_mem": f"{math.ceil((n_workers * limit + 2 * GB) / GB)}G",
+        "slurm_time": _hms(runtime * WALLTIME_MARGIN * cores / (n_workers * plan["threads_per_worker"]))
+        if runtime
+        else None,
+    }
+    return {
+        "dpath": os.path.abspath(dpath),
+        "video": video,
+        "downsample": downsample,
+        "voxels": voxels,
+        "movie_bytes_float64": size,
+        "calibrated": bool(predicted),
+        "calibration_runs": model["n_runs"],
+        "stages": predicted,
+        "runtime_s": runtime,
+        "peak_worker_memory_bytes": worker_mem or None,
+        "scratch_bytes": scratch,
+        "cluster_plan": plan,
+        "recommendation": recommendation,
+    }
+
+
+def print_estimate(est: dict) -> None:
+    video = est["video"]
+    print(f"[preflight] {est['dpath']}")
+    print(
+        f"[preflight] {video['files']} videos, {video['frames']} frames of "
+        f"{video['height']}x{video['width']} -> {est['voxels']} voxels after downsample {est['downsample']}"
+    )
+    if est["calibrated"]:
+        print(f"[preflight] Calibrated on {est['calibration_runs']} previous run(s):")
+        for name, s in est["stages"].items():
+            print(
+                f"    {name:<20} {_hms(s['runtime_s'])}  "
+                f"peak worker {s['peak_worker_memory_bytes'] / GB:5.1f} GB  (n={s['calibration_runs']})"
+            )
+        print(f"[preflight] Predicted runtime {_hms(est['runtime_s'])}")
+    else:
+        print("[preflight] No usable previous profiles; runtime cannot be predicted")
+    if est["scratch_bytes"]:
+        print(f"[preflight] Predicted peak scratch {est['scratch_bytes'] / GB:.1f} GB")
+    rec = est["recommendation"]
+    print(
+        f"[preflight] Recommended: {rec['n_workers']} workers x {rec['threads_per_worker']} threads, "
+        f"memory_limit={rec['memory_limit']}; SLURM --mem={rec['slurm_mem']}"
+        + (f" --time={rec['slurm_time']}" if rec["slurm_time"] else "")
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predict the cost of run_pipeline on a session.")
+    parser.add_argument("dpath", help="session folder with the raw .avi videos")
+    parser.add_argument(
+        "--profiles",
+        nargs="*",
+        default=[p for p in [os.getenv("MINIAN_PROFILE_DIR")] if p],
+        help="folders with previous run outputs (searched for pipeline_profile.json)",
+    )
+    parser.add_argument("--minian-path", default=".", help="folder containing the minian package")
+    parser.add_argument("--json", action="store_true", help="print the full estimate as JSON")
+    parser.add_argument(
+        "--compute-only", action="store_true", help="predict a compute-only run (no rendering)"
+    )
+    parser.add_argument(
+        "--fixed-footprints", action="store_true", help="predict a run on fixed footprints"
+    )
+    args = parser.parse_args()
+
+    sys.path.append(args.minian_path)
+    import pipeline
+
+    stage_names = [
+        stage.name for stage in pipeline.pipeline_stages(args.compute_only, args.fixed_footprints)
+    ]
+    result = estimate(args.dpath, args.profiles, stages=stage_names)
+    if args.json:
+        print(json.dumps(result, indent=2, default=repr))
+    else:
+        print_estimate(result)
@@ -0,0 +1,107 @@
+"""
+Low-resolution preview runs for parameter QA
+--------------------------------------------
+run_pipeline(..., preview=True) runs the whole chain on a small version of the
+session, in `<output_dir>/preview`, to check seeds, PNR / KS thresholds and
+merges before paying for a full-resolution run:
+
+    - only the first `frames_per_file` frames of the first `n_files` videos
+    - `factor` times stronger spatial downsampling than configured
+    - pixel-sized parameters (windows, distances, size thresholds) scaled to the
+      coarser grid, and the seed window clamped to the shorter movie
+    - no videos; instead a QA bundle in `<output_dir>/preview/qa`:
+        qa_summary.json         seed and unit counts per step, movie shape, settings
+        max_proj_footprints.png max projection with the final footprints outlined
+"""
+
+import copy
+import json
+import math
+import os
+
+import numpy as np
+
+DEFAULT_PREVIEW = {"factor": 2, "n_files": 3, "frames_per_file": 300}
+QA_DIR = "qa"
+
+
+def _odd(value: float) -> int:
+    return max(int(round(value)) // 2 * 2 + 1, 3)
+
+
+def preview_params(params: dict, preview: dict) -> dict:
+    """
+    Parameter dict for a preview run derived from the full-run `params`.
+
+    preview : dict
+        factor, n_files, frames_per_file (see DEFAULT_PREVIEW).
+    """
+    p = copy.deepcopy(params)
+    factor = preview["factor"]
+    n_frames = preview["n_files"] * preview["frames_per_file"]
+
+    plv = p["param_load_videos"]
+    downsample = dict(plv.get("downsample") or {})
+    for dim in ("height", "width"):
+        downsample[dim] = downsample.get(dim, 1) * factor
+    plv.update(downsample=downsample, downsample_strategy="subset")
+    p["param_video_subset"] = {
+        "max_files": preview["n_files"],
+        "frames_per_file": preview["frames_per_file"],
+    }
+
+    # Lengths in pixels shrink by factor, areas by factor**2
+    p["param_denoise"]["ksize"] = _odd(p["param_denoise"]["ksize"] / factor)
+    p["param_background_removal"]["wnd"] = max(round(p["param_background_removal"]["wnd"] / factor), 1)
+    p["param_seeds_init"]["max_wnd"] = max(round(p["param_seeds_init"]["max_wnd"] / factor), 1)
+    p["param_seeds_merge"]["thres_dist"] = p["param_seeds_merge"]["thres_dist"] / factor
+    p["param_initialize"]["wnd"] = max(round(p["param_initialize"]["wnd"] / factor), 1)
+    for key in ("param_first_spatial", "param_second_spatial"):
+        p[key]["dl_wnd"] = max(round(p[key]["dl_wnd"] / factor), 1)
+        lo, hi = p[key]["size_thres"]
+        p[key]["size_thres"] = (
+            None if lo is None else max(math.floor(lo / factor**2), 1),
+            None if hi is None else math.ceil(hi / factor**2),
+        )
+
+    # The rolling seed window must fit in the shorter movie
+    seeds = p["param_seeds_init"]
+    seeds["wnd_size"] = min(seeds["wnd_size"], n_frames)
+    seeds["stp_size"] = min(seeds["stp_size"], max(seeds["wnd_size"] // 2, 1))
+    return p
+
+
+def write_qa_bundle(out_dir: str, max_proj, A, summary: dict) -> str:
+    """
+    Write qa_summary.json and max_proj_footprints.png into out_dir/qa.
+
+    max_proj : DataArray (height, width); A : DataArray (unit_id, height, width)
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    qa_dir = os.path.join(out_dir, QA_DIR)
+    os.makedirs(qa_dir, exist_ok=True)
+
+    max_proj = np.asarray(max_proj.transpose("height", "width").values)
+    A = A.transpose("unit_id", "height", "width")
+    fig, ax = plt.subplots(figsize=(8, 8 * max_proj.shape[0] / max(max_proj.shape[1], 1)))
+    ax.imshow(max_proj, cmap="gray")
+    for uid in A.coords["unit_id"].values:
+        fp = np.asarray(A.sel(unit_id=uid).values)
+        if fp.max() <= 0:
+            continue
+        ax.contour(fp, levels=[0.3 * fp.max()], colors="tab:red", linewidths=0.6)
+        cy, cx = np.unravel_index(np.argmax(fp), fp.shape)
+        ax.text(cx, cy, str(uid), color="yellow", fontsize=5, ha="center", va="center")
+    ax.set_title(f"{A.sizes['unit_id']} units")
+    ax.set_axis_off()
+    fig.savefig(os.path.join(qa_dir, "max_proj_footprints.png"), dpi=150, bbox_inches="tight")
+    plt.close(fig)
+
+    with open(os.path.join(qa_dir, "qa_summary.json"), "w") as fh:
+        json.dump(summary, fh, indent=2, default=repr)
+    print(f"[preview] QA bundle written to {qa_dir}")
+    return qa_dir
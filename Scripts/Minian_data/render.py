@@ -0,0 +1,170 @@
+"""
+Deferred video rendering for run_pipeline
+-----------------------------------------
+In compute-only mode (run_pipeline(..., compute_only=True)) the pipeline does
+not encode any MP4 inside the critical path. Instead it moves the few arrays the
+videos need into `<output_dir>/render_inputs/` and writes `render_job.json`.
+This module turns such a job into the usual outputs later:
+
+    - minian_mc.mp4        (raw vs motion corrected, side by side)
+    - minian.mp4           (Minian generate_videos: movie, A*C, residual, ...)
+    - minian/Figure_1.pdf  (plotting.py on C_binary.csv, if it is not there yet)
+
+and removes render_inputs/ afterwards.
+
+Usage
+-----
+    # from Python
+    from render import render_session
+    render_session("/scratch/s4750098/minian_outputs/24_20190905_T2")
+
+    # from the shell, e.g. at the end of a SLURM job or on a login node
+    python render.py /scratch/s4750098/minian_outputs/24_20190905_T2 --minian-path /path/to/minian
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import xarray as xr
+
+from stage_manifest import open_stage_array
+
+RENDER_JOB_NAME = "render_job.json"
+RENDER_INPUTS_DIR = "render_inputs"
+
+
+# ---------------------------------------------------------------------------
+# Renderers (also used inline by run_pipeline when not in compute-only mode)
+# ---------------------------------------------------------------------------
+
+def render_mc_video(varr_ref: xr.DataArray, Y_fm_chk: xr.DataArray, vpath: str) -> None:
+    """Write minian_mc.mp4: pre-processed vs motion corrected movie."""
+    from minian.visualization import write_video
+
+    print("[render] Writing motion correction video ...")
+    vid_arr = xr.concat([varr_ref, Y_fm_chk], "width").chunk({"width": -1})
+    write_video(vid_arr, "minian_mc.mp4", vpath)
+
+
+def render_cnmf_video(
+    varr: xr.DataArray, Y_fm_chk: xr.DataArray, A: xr.DataArray, C_chk: xr.DataArray, vpath: str
+) -> None:
+    """Write the Minian summary video (generate_videos)."""
+    from minian.visualization import generate_videos
+
+    print("[render] Generating output video ...")
+    generate_videos(varr, Y_fm_chk, A=A, C=C_chk, vpath=vpath)
+
+
+def render_figure(minian_ds_path: str) -> None:
+    """Run plotting.py on C_binary.csv if Figure_1.pdf does not exist yet."""
+    import importlib.util
+
+    c_binary_csv = os.path.join(minian_ds_path, "C_binary.csv")
+    if not os.path.exists(c_binary_csv) or os.path.exists(os.path.join(minian_ds_path, "Figure_1.pdf")):
+        return
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts", "plotting.py")
+    spec = importlib.util.spec_from_file_location("plotting", script)
+    plotting_mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plotting_mod)
+
+    import matplotlib
+
+    matplotlib.use("Agg")
+    print("[render] Running plotting.py ...")
+    plotting_mod.plot_cells(file_name="C_binary.csv", csv_path=c_binary_csv, save_figure=True)
+
+
+# ---------------------------------------------------------------------------
+# Render jobs
+# ---------------------------------------------------------------------------
+
+def write_render_job(
+    output_dir: str, arrays: dict[str, str], subset: dict, movable_root: str
+) -> str:
+    """
+    Move the arrays the renderer needs into output_dir/render_inputs and write
+    the job file. `arrays` maps role (varr, varr_ref, Y_fm_chk, A, C_chk) to the
+    zarr store path. Only stores under `movable_root` (the intermediate store,
+    which is deleted anyway) are moved; others (final outputs, the decoded-video
+    cache) are referenced in place.
+    """
+    inputs_dir = os.path.join(output_dir, RENDER_INPUTS_DIR)
+    movable_root = os.path.abspath(movable_root)
+    os.makedirs(inputs_dir, exist_ok=True)
+
+    job_arrays = {}
+    for role, src in arrays.items():
+        if os.path.commonpath([os.path.abspath(src), movable_root]) != movable_root:
+            job_arrays[role] = src
+            continue
+        dst = os.path.join(inputs_dir, os.path.basename(src))
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+        try:
+            os.rename(src, dst)
+        except OSError:
+            # Different filesystem: fall back to a copy
+            shutil.copytree(src, dst)
+        job_arrays[role] = dst
+
+    # Frame subset as [start, stop, step] per dimension
+    subset = {dim: [sl.start, sl.stop, sl.step] for dim, sl in (subset or {}).items()}
+
+    job_path = os.path.join(output_dir, RENDER_JOB_NAME)
+    with open(job_path, "w") as fh:
+        json.dump({"output_dir": output_dir, "arrays": job_arrays, "subset": subset}, fh, indent=2)
+    print(f"[render] Render job written to {job_path}")
+    return job_path
+
+
+def render_session(output_dir: str, keep_inputs: bool = False) -> None:
+    """Render the videos of a compute-only run from its render job."""
+    output_dir = os.path.abspath(output_dir)
+    job_path = os.path.join(output_dir, RENDER_JOB_NAME)
+    with open(job_path, "r") as fh:
+        job = json.load(fh)
+
+    arrays = {role: open_stage_array(path) for role, path in job["arrays"].items()}
+    subset = {dim: slice(*bounds) for dim, bounds in job["subset"].items()}
+    render_mc_video(arrays["varr_ref"], arrays["Y_fm_chk"], output_dir)
+    render_cnmf_video(
+        arrays["varr"].sel(subset), arrays["Y_fm_chk"], arrays["A"], arrays["C_chk"], output_dir
+    )
+    render_figure(os.path.join(output_dir, "minian"))
+
+    if not keep_inputs:
+        shutil.rmtree(os.path.join(output_dir, RENDER_INPUTS_DIR), ignore_errors=True)
+        os.remove(job_path)
+    print(f"[render] Done rendering {output_dir}")
+
+
+def spawn_renderer(output_dir: str, minian_path: str = ".", niceness: int = 19) -> subprocess.Popen:
+    """Start render_session for `output_dir` in a low-priority background process."""
+    log_path = os.path.join(output_dir, "render.log")
+    cmd = [sys.executable, os.path.abspath(__file__), output_dir, "--minian-path", minian_path]
+    with open(log_path, "a") as log:
+        proc = subprocess.Popen(
+            cmd,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            preexec_fn=lambda: os.nice(niceness),
+            env={**os.environ, "OMP_NUM_THREADS": "1", "MKL_NUM_THREADS": "1"},
+        )
+    print(f"[render] Background renderer started (pid {proc.pid}), log: {log_path}")
+    return proc
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render videos of a compute-only Minian run.")
+    parser.add_argument("output_dir", help="run_pipeline output folder containing render_job.json")
+    parser.add_argument("--minian-path", default=".", help="folder containing the minian package")
+    parser.add_argument("--keep-inputs", action="store_true", help="keep render_inputs/ afterwards")
+    args = parser.parse_args()
+
+    sys.path.append(args.minian_path)
+    render_session(args.output_dir, keep_inputs=args.keep_inputs)
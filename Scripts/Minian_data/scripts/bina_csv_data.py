@@ -61,6 +61,15 @@ def process_calcium_data(csv_path, sampling_frequency=30, z_threshold=2.0):
     
     # Load the wide format data
     df = pd.read_csv(csv_path)
+    return process_calcium_frame(df, sampling_frequency, z_threshold)
+
+def process_calcium_frame(df, sampling_frequency=30, z_threshold=2.0):
+    """
+    Same as process_calcium_data, on a wide DataFrame already in memory
+
+    Input:
+    - DataFrame with a 'frame' column and one 'cell_<unit_id>' column per cell
+    """
     
     # Get cell columns (all except 'frame')
     cell_columns = [col for col in df.columns if col.startswith('cell_')]
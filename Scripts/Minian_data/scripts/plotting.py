@@ -23,7 +23,18 @@ def plot_cells(file_name, csv_path, save_figure=True):
     """
     # Load the data
     df = pd.read_csv(csv_path)
-    
+    save_path = os.path.join(os.path.dirname(csv_path), "Figure_1.pdf") if save_figure else None
+    plot_cells_frame(df, save_path=save_path)
+
+def plot_cells_frame(df, save_path=None, show=True):
+    """
+    Same as plot_cells, on a DataFrame already in memory
+
+    Parameters:
+    - df: DataFrame with a 'frame' column and one column per cell
+    - save_path: where to save the figure as PDF, None to not save it
+    - show: call plt.show() (False when running headless / in a thread)
+    """
     # Automatically detect all cell columns
     cell_columns = [col for col in df.columns if col != 'frame']
     num_cells = len(cell_columns)
@@ -54,14 +65,13 @@ def plot_cells(file_name, csv_path, save_figure=True):
     plt.tight_layout()
     
     # Save figure if requested
-    if save_figure:
-        # Get the directory from csv_path
-        output_dir = os.path.dirname(csv_path)
-        save_path = os.path.join(output_dir, "Figure_1.pdf")
-        # Save the figure
-        plt.savefig(save_path, format='pdf', dpi=300, bbox_inches='tight')
+    if save_path is not None:
+        fig.savefig(save_path, format='pdf', dpi=300, bbox_inches='tight')
     
-    plt.show()
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)
 
 # Example usage
 if __name__ == "__main__":    
@@ -0,0 +1,126 @@
+"""
+Stage manifest for checkpoint / resume of run_pipeline
+-------------------------------------------------------
+Every completed pipeline stage is recorded in a small JSON file next to the
+outputs, together with a hash of the parameters it ran with and the zarr stores
+it wrote. When run_pipeline is restarted on the same session, stages whose hash
+still matches (and whose stores are still on disk, untouched) are skipped and
+their stores are reopened instead of recomputed.
+
+The hash of a stage is chained onto the hash of the stage before it, so changing
+any parameter invalidates that stage and everything downstream of it.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import xarray as xr
+
+MANIFEST_NAME = "stage_manifest.json"
+
+
+def param_hash(params, parent: str = "") -> str:
+    """
+    Return a short, stable hash of a parameter dict, chained onto `parent`.
+
+    Non-JSON values (slices, numpy dtypes, ...) are hashed by their repr, which
+    is stable across runs for everything used in the pipeline parameters.
+    """
+    payload = json.dumps(params, sort_keys=True, default=repr)
+    return hashlib.sha256((parent + payload).encode("utf-8")).hexdigest()[:16]
+
+
+def store_mtime(path: str) -> float | None:
+    """Modification time of a zarr store directory, or None if it is missing."""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def open_stage_array(path: str) -> xr.DataArray:
+    """Reopen a DataArray written by save_minian from its `<name>.zarr` path."""
+    name = os.path.basename(os.path.normpath(path))
+    if name.endswith(".zarr"):
+        name = name[: -len(".zarr")]
+    return xr.open_zarr(path)[name]
+
+
+class StageManifest:
+    """
+    Persistent record of completed pipeline stages.
+
+    Layout of the JSON file::
+
+        {
+          "stages": {
+            "<stage name>": {
+              "hash": "<chained parameter hash>",
+              "completed": <unix time>,
+              "outputs": {"<var>": {"path": ..., "mtime": ..., "final": bool}},
+              "meta": {...}          # small JSON values, e.g. chunk sizes
+            },
+            ...
+          }
+        }
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.stages: dict[str, dict] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as fh:
+                    self.stages = json.load(fh).get("stages", {})
+            except (OSError, ValueError) as exc:
+                print(f"[manifest] WARNING: could not read {path} ({exc}); starting fresh")
+                self.stages = {}
+
+    def save(self) -> None:
+        """Write the manifest atomically so a crash never leaves it half-written."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump({"stages": self.stages}, fh, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def matches(self, name: str, digest: str) -> bool:
+        """True if `name` was completed with the same chained parameter hash."""
+        record = self.stages.get(name)
+        return record is not None and record.get("hash") == digest
+
+    def output_valid(self, name: str, var: str) -> bool:
+        """True if the store recorded for `var` still exists and was not rewritten."""
+        entry = self.stages.get(name, {}).get("outputs", {}).get(var)
+        if entry is None:
+            return False
+        mtime = store_mtime(entry["path"])
+        return mtime is not None and abs(mtime - entry["mtime"]) < 1e-3
+
+    def mark_complete(
+        self, name: str, digest: str, outputs: dict[str, str], meta: dict, final: set[str]
+    ) -> None:
+        """Record `name` as done. `outputs` maps state variable -> zarr store path."""
+        self.stages[name] = {
+            "hash": digest,
+            "completed": time.time(),
+            "outputs": {
+                var: {"path": path, "mtime": store_mtime(path), "final": var in final}
+                for var, path in outputs.items()
+            },
+            "meta": meta,
+        }
+        self.save()
+
+    def invalidate(self, names) -> None:
+        """Drop the records of `names` (a stage and everything after it)."""
+        dropped = [n for n in names if self.stages.pop(n, None) is not None]
+        if dropped:
+            self.save()
+
+    def clear(self) -> None:
+        self.stages = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
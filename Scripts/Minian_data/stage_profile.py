@@ -0,0 +1,184 @@
+"""
+Per-stage profiling for run_pipeline
+------------------------------------
+Records, for every pipeline stage:
+    - wall time
+    - peak RSS per Dask worker (sampled from the scheduler heartbeat metrics)
+    - bytes read / written by the worker processes (OS-level I/O counters)
+    - on-disk size of the zarr stores the stage saved through save_minian
+      (stores it adopted or promoted from elsewhere are not counted)
+    - number of Dask tasks the scheduler completed (None on a shared cluster,
+      where the scheduler also counts the other clients' tasks)
+
+The result is written as JSON next to the outputs (PROFILE_NAME), so SLURM
+requests can be sized from previous runs and regressions spotted across batches.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from distributed.diagnostics.plugin import SchedulerPlugin
+
+PROFILE_NAME = "pipeline_profile.json"
+
+
+class TaskCounter(SchedulerPlugin):
+    """Scheduler plugin counting tasks that finished (in memory or erred)."""
+
+    name = "stage-task-counter"
+
+    def __init__(self):
+        self.count = 0
+
+    def transition(self, key, start, finish, *args, **kwargs):
+        if finish in ("memory", "erred"):
+            self.count += 1
+
+
+def scheduler_task_count(dask_scheduler=None) -> int:
+    """Tasks finished since the cluster started; run with client.run_on_scheduler."""
+    plugin = dask_scheduler.plugins.get(TaskCounter.name)
+    return plugin.count if plugin is not None else 0
+
+
+def _worker_io_counters() -> dict:
+    import psutil
+
+    io = psutil.Process().io_counters()
+    return {"read_bytes": io.read_bytes, "write_bytes": io.write_bytes}
+
+
+def dir_size(path: str) -> int:
+    """Total size in bytes of all files below `path` (0 if it does not exist)."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            try:
+                total += os.path.getsize(os.path.join(root, fn))
+            except OSError:
+                pass
+    return total
+
+
+class StageProfiler:
+    """
+    Collects a profile record per stage and writes them to a JSON file.
+
+    Parameters
+    ----------
+    client : distributed.Client
+        Client of the cluster the pipeline runs on.
+    path : str
+        Output JSON path.
+    meta : dict | None
+        Extra run information stored at the top level (cluster config, session, ...).
+    interval : float
+        Sampling interval in seconds for worker memory.
+    """
+
+    def __init__(self, client, path: str, meta: dict | None = None, interval: float = 0.5):
+        self.client = client
+        self.path = path
+        self.interval = interval
+        self.record = {"started": time.time(), "meta": meta or {}, "stages": []}
+
+    # -----------------------------------------------------------------------
+    # Cluster probes
+    # -----------------------------------------------------------------------
+    def _task_count(self) -> int:
+        try:
+            return int(self.client.run_on_scheduler(scheduler_task_count))
+        except Exception:
+            return 0
+
+    def _io_counters(self) -> dict:
+        try:
+            return self.client.run(_worker_io_counters)
+        except Exception:
+            return {}
+
+    def _sample_memory(self, peaks: dict, stop: threading.Event) -> None:
+        while True:
+            try:
+                # n_workers=-1: by default only the first 5 workers are reported
+                workers = self.client.scheduler_info(n_workers=-1).get("workers", {})
+                for addr, info in workers.items():
+                    rss = info.get("metrics", {}).get("memory", 0)
+                    peaks[addr] = max(peaks.get(addr, 0), rss)
+            except Exception:
+                pass
+            if stop.wait(self.interval):
+                return
+
+    # -----------------------------------------------------------------------
+    # Public API
+    # -----------------------------------------------------------------------
+    def skipped(self, name: str) -> None:
+        self.record["stages"].append({"stage": name, "skipped": True})
+
+    @contextmanager
+    def stage(self, name: str, ctx=None):
+        """Profile the body of the `with` block as stage `name`."""
+        peaks: dict[str, int] = {}
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample_memory, args=(peaks, stop), daemon=True)
+
+        # The counter is cluster-wide; on a shared cluster it would include other runs
+        count_tasks = not self.record["meta"].get("shared_cluster")
+        tasks_before = self._task_count() if count_tasks else 0
+        io_before = self._io_counters()
+        sampler.start()
+        start = time.time()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            wall = time.time() - start
+            stop.set()
+            sampler.join()
+            io_after = self._io_counters()
+
+            io = {"read_bytes": 0, "write_bytes": 0}
+            for addr, after in io_after.items():
+                before = io_before.get(addr, {"read_bytes": 0, "write_bytes": 0})
+                for k in io:
+                    io[k] += max(after[k] - before[k], 0)
+
+            stores, shapes = {}, {}
+            if ctx is not None:
+                stores = {store: dir_size(ctx.paths[store]) for store in sorted(ctx.written)}
+                shapes = dict(ctx.shapes)
+
+            self.record["stages"].append(
+                {
+                    "stage": name,
+                    "status": status,
+                    "wall_time_s": round(wall, 3),
+                    "peak_rss_bytes": peaks,
+                    "peak_rss_max_bytes": max(peaks.values(), default=0),
+                    "worker_read_bytes": io["read_bytes"],
+                    "worker_write_bytes": io["write_bytes"],
+                    "stores_written_bytes": stores,
+                    "total_store_bytes": sum(stores.values()),
+                    "store_shapes": shapes,
+                    "tasks": self._task_count() - tasks_before if count_tasks else None,
+                }
+            )
+            self.write()
+
+    def write(self) -> None:
+        """Write the profile collected so far (called after every stage)."""
+        self.record["wall_time_s"] = round(time.time() - self.record["started"], 3)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(self.record, fh, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,450 @@
+"""
+Stage runner for run_pipeline
+-----------------------------
+The pipeline is expressed as an ordered list of `Stage`s. Each stage function
+receives a `StageContext` (where to save, which parameters to use) and the
+current pipeline state (a dict of DataArrays and small metadata values), and
+returns the new state entries it produced.
+
+`run_stages` consults the `StageManifest` to skip every stage that already
+completed with the same parameters, reopens the zarr stores those stages left
+behind, and continues from the first stage that is missing or stale. After
+every stage it lets the `IntermediateStore` drop arrays no later stage reads.
+
+A stage that fails because a worker ran out of memory (KilledWorker or
+MemoryError) is retried with its inputs read in smaller chunks and, from the
+second retry on, with at most one task per worker (through the "MEM" worker
+resource).
+
+Stages are either "io" or "compute" heavy (`Stage.kind`). Several runs on one
+cluster can share a limit on concurrently running stages of each kind through
+`slot_gate`, so their I/O and compute phases interleave (see multi_session.py).
+"""
+
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Callable
+
+import xarray as xr
+
+from intermediate_store import IntermediateStore, promote_store
+from stage_manifest import StageManifest, open_stage_array, param_hash
+
+
+@dataclass
+class Stage:
+    """
+    One step of the pipeline.
+
+    name       : unique stage name, also the sub-folder of the intermediate store
+    fn         : callable(ctx, state) -> dict of new state entries
+    params     : keys of the parameter dict this stage depends on (hashed)
+    inputs     : state entries the stage reads
+    checkpoint : record the stage in the manifest so it can be skipped on resume.
+                 Only trailing stages (final save, post-processing) should be False.
+    kind       : "compute" or "io", what mostly limits the stage (see slot_gate)
+    """
+
+    name: str
+    fn: Callable[["StageContext", dict], dict]
+    params: tuple[str, ...] = ()
+    inputs: tuple[str, ...] = ()
+    checkpoint: bool = True
+    kind: str = "compute"
+
+
+class StageContext:
+    """Everything a stage function needs besides the pipeline state."""
+
+    def __init__(
+        self,
+        name: str,
+        store: IntermediateStore,
+        dpath: str,
+        output_dir: str,
+        params: dict,
+        param_save_minian: dict,
+    ):
+        self.name = name
+        self.store = store
+        self.dir = store.stage_dir(name)
+        self.dpath = dpath
+        self.output_dir = output_dir
+        self.params = params
+        self.param_save_minian = param_save_minian
+        self.paths: dict[str, str] = {}
+        # Names of the stores this stage wrote itself (not adopted / promoted)
+        self.written: set[str] = set()
+        # Zarr store of every state array produced so far (filled in by run_stages)
+        self.var_paths: dict[str, str] = {}
+        self.shapes: dict[str, dict[str, int]] = {}
+        self.final: set[str] = set()
+
+    def save(self, arr: xr.DataArray, **kwargs) -> xr.DataArray:
+        """save_minian `arr` (named) into this stage's intermediate folder."""
+        from minian.utilities import save_minian
+
+        os.makedirs(self.dir, exist_ok=True)
+        arr = save_minian(self.store.prepare(arr), self.dir, overwrite=True, **kwargs)
+        self.paths[arr.name] = os.path.join(self.dir, arr.name + ".zarr")
+        self.written.add(arr.name)
+        self.store.added(self.paths[arr.name])
+        self.shapes[arr.name] = {dim: int(size) for dim, size in arr.sizes.items()}
+        return arr
+
+    def adopt(self, path: str) -> xr.DataArray:
+        """
+        Use a zarr store written outside save_minian as a stage output. Stores
+        inside the intermediate store are released like any other; stores
+        elsewhere (e.g. the decoded-video cache) are tracked on resume but never deleted.
+        """
+        arr = open_stage_array(path)
+        self.paths[arr.name] = path
+        if os.path.commonpath([os.path.abspath(path), self.store.root]) == self.store.root:
+            self.store.added(path)
+        self.shapes[arr.name] = {dim: int(size) for dim, size in arr.sizes.items()}
+        return arr
+
+    def promote_final(self, var: str) -> xr.DataArray | None:
+        """
+        Make the intermediate store of state variable `var` a final output by
+        rename / hard-link (see promote_store) instead of re-saving it.
+
+        Only stores inside the intermediate store whose array name is `var` can
+        be promoted; returns None otherwise, and the caller should save_final.
+        The meta_dict coordinates save_minian would add are written alongside.
+        """
+        src = self.var_paths.get(var)
+        if src is None or os.path.basename(os.path.normpath(src)) != var + ".zarr":
+            return None
+        if os.path.commonpath([os.path.abspath(src), self.store.root]) != self.store.root:
+            return None
+
+        minian_ds_path = self.param_save_minian["dpath"]
+        dst = os.path.join(minian_ds_path, var + ".zarr")
+        how = promote_store(src, dst, link=self.store.keep)
+        if how != "link":
+            self.store.moved_out(src)
+        meta_dict = self.param_save_minian.get("meta_dict")
+        if meta_dict:
+            # As save_minian: indices into the path of the folder holding dpath
+            pathlist = os.path.dirname(os.path.abspath(minian_ds_path)).split(os.sep)
+            _add_scalar_coords(dst, var, {dim: pathlist[idx] for dim, idx in meta_dict.items()})
+        print(f"[pipeline] Promoted {var} to the final outputs ({how})")
+
+        arr = open_stage_array(dst)
+        self.paths[arr.name] = dst
+        self.shapes[arr.name] = {dim: int(size) for dim, size in arr.sizes.items()}
+        self.final.add(arr.name)
+        return arr
+
+    def save_final(self, arr: xr.DataArray, **kwargs) -> xr.DataArray:
+        """save_minian `arr` (named) into the final minian output folder."""
+        from minian.utilities import save_minian
+
+        arr = save_minian(arr, **self.param_save_minian, **kwargs)
+        self.paths[arr.name] = os.path.join(self.param_save_minian["dpath"], arr.name + ".zarr")
+        self.written.add(arr.name)
+        self.shapes[arr.name] = {dim: int(size) for dim, size in arr.sizes.items()}
+        self.final.add(arr.name)
+        return arr
+
+
+def _add_scalar_coords(path: str, name: str, coords: dict[str, str]) -> None:
+    """
+    Add scalar coordinates to array `name` of the zarr store `path` without
+    rewriting its chunks, so it reopens as if save_minian had assign_coords'ed them.
+    """
+    import zarr
+
+    xr.Dataset(coords=coords).to_zarr(path, mode="a", consolidated=False)
+    group = zarr.open_group(path, mode="r+")
+    listed = str(group[name].attrs.get("coordinates", "")).split()
+    group[name].attrs["coordinates"] = " ".join(dict.fromkeys(listed + list(coords)))
+    zarr.consolidate_metadata(path)
+
+
+# ---------------------------------------------------------------------------
+# Out-of-memory retries
+# ---------------------------------------------------------------------------
+
+def _is_oom(exc: BaseException) -> bool:
+    from distributed import KilledWorker
+
+    return isinstance(exc, (KilledWorker, MemoryError))
+
+
+def _workers_have_mem_resource() -> bool:
+    """True if every worker of the current cluster has the "MEM" resource."""
+    try:
+        from distributed import get_client
+
+        workers = get_client().scheduler_info(n_workers=-1)["workers"].values()
+    except (ImportError, ValueError, KeyError):
+        return False
+    return bool(workers) and all("MEM" in w.get("resources", {}) for w in workers)
+
+
+def _shrink_chunks(
+    arr: xr.DataArray, factor: int, path: str | None, retry_dir: str
+) -> tuple[xr.DataArray, str | None]:
+    """
+    `arr` with the chunks of every dimension that is already chunked split by
+    `factor`, read that way from its zarr store `path`.
+
+    Re-chunking a lazily opened array still reads every on-disk chunk whole,
+    so it does not lower the memory a task needs. Chunks that are still a
+    multiple of the on-disk chunks are read as such (open_zarr(chunks=...));
+    smaller ones are first rewritten to `<retry_dir>/<name>.zarr` with the new
+    chunks, one on-disk chunk per task. Returns the array and the store written
+    (None if none was). Arrays without a store are only re-chunked.
+    """
+    if arr.chunks is None:
+        return arr, None
+    target = {
+        dim: max(max(sizes) // factor, 1)
+        for dim, sizes in zip(arr.dims, arr.chunks)
+        if len(sizes) > 1
+    }
+    if not target:
+        return arr, None
+    if path is None:
+        return arr.chunk(target), None
+
+    name = os.path.basename(os.path.normpath(path))[: -len(".zarr")]
+    on_disk = xr.open_zarr(path)[name]
+    disk = dict(zip(on_disk.dims, on_disk.encoding.get("chunks", on_disk.shape)))
+    chunks = {dim: target.get(dim, max(sizes)) for dim, sizes in zip(arr.dims, arr.chunks)}
+    if all(chunks[dim] >= disk[dim] for dim in target):
+        aligned = {
+            dim: size // disk[dim] * disk[dim] if dim in target else size for dim, size in chunks.items()
+        }
+        return xr.open_zarr(path, chunks=aligned)[name], None
+
+    os.makedirs(retry_dir, exist_ok=True)
+    dst = os.path.join(retry_dir, name + ".zarr")
+    small = on_disk.chunk(chunks)
+    small.encoding = {}
+    small.to_dataset().to_zarr(dst, mode="w")
+    return xr.open_zarr(dst)[name], dst
+
+
+def _downgrade(
+    state: dict,
+    inputs: tuple[str, ...],
+    level: int,
+    var_paths: dict,
+    store: IntermediateStore,
+    stage_name: str,
+) -> tuple[dict, dict]:
+    """
+    State for retry `level` (1, 2, ...) and a description of the downgrade.
+    Only the copy is changed, so smaller chunks stay local to the retried stage;
+    inputs rewritten with smaller chunks go to `<store>/<stage_name>_retry<level>`
+    and are released with the other intermediate arrays.
+    """
+    factor = 2**level
+    retry_dir = store.stage_dir(f"{stage_name}_retry{level}")
+    retry_state, rewritten = dict(state), []
+    for var in inputs:
+        if isinstance(state.get(var), xr.DataArray):
+            retry_state[var], written = _shrink_chunks(state[var], factor, var_paths.get(var), retry_dir)
+            if written is not None:
+                store.added(written)
+                rewritten.append(var)
+    if isinstance(state.get("chk"), dict):
+        retry_state["chk"] = {dim: max(int(size) // factor, 1) for dim, size in state["chk"].items()}
+    downgrade = {
+        "chunk_factor": 1 / factor,
+        "chk": retry_state.get("chk"),
+        "rewritten": rewritten,
+        "one_task_per_worker": level >= 2 and _workers_have_mem_resource(),
+    }
+    return retry_state, downgrade
+
+
+def _run_stage(stage: Stage, state: dict, make_context, var_paths: dict, profiler, retries: int):
+    """Run one stage, retrying with downgraded chunking / concurrency after an OOM."""
+    import dask
+
+    level, run_state, annotations = 0, state, {}
+    while True:
+        ctx = make_context(stage.name)
+        ctx.var_paths = dict(var_paths)
+        try:
+            with profiler.stage(stage.name, ctx) if profiler is not None else nullcontext():
+                with dask.annotate(**annotations):
+                    return ctx, stage.fn(ctx, run_state)
+        except Exception as exc:
+            if not _is_oom(exc) or level >= retries:
+                raise
+            level += 1
+            run_state, downgrade = _downgrade(state, stage.inputs, level, var_paths, ctx.store, stage.name)
+            # start_cluster gives every worker one "MEM" resource
+            annotations = {"resources": {"MEM": 1}} if downgrade["one_task_per_worker"] else {}
+            print(
+                f"[pipeline] WARNING: stage '{stage.name}' ran out of memory ({type(exc).__name__}); "
+                f"retry {level}/{retries} with chunks x{downgrade['chunk_factor']}"
+                + (f", rewrote {downgrade['rewritten']}" if downgrade["rewritten"] else "")
+                + (", one task per worker" if downgrade["one_task_per_worker"] else "")
+            )
+            if profiler is not None:
+                profiler.record.setdefault("downgrades", []).append(
+                    {"stage": stage.name, "time": time.time(), "error": repr(exc), "retry": level, **downgrade}
+                )
+
+
+def slot_gate(slots: dict[str, int], prefix: str = "minian"):
+    """
+    Gate for run_stages that holds a cluster-wide slot while a stage runs.
+
+    `slots` maps a stage kind to the number of stages of that kind that may run
+    at once across every client of the cluster (a distributed.Semaphore per
+    kind, named `<prefix>-<kind>-stages`); kinds not listed are not limited.
+    Needs a default Client, i.e. call it after connecting to the cluster.
+    """
+    from distributed import Semaphore
+
+    semaphores = {
+        kind: Semaphore(max_leases=int(n), name=f"{prefix}-{kind}-stages")
+        for kind, n in slots.items()
+    }
+
+    @contextmanager
+    def gate(stage: Stage):
+        semaphore = semaphores.get(stage.kind)
+        if semaphore is None:
+            yield
+            return
+        start = time.time()
+        with semaphore:
+            waited = time.time() - start
+            if waited > 1:
+                print(f"[pipeline] Stage '{stage.name}' waited {waited:.0f}s for a free {stage.kind} slot")
+            yield
+
+    return gate
+
+
+def _live_outputs(stages: list[Stage], manifest: StageManifest) -> dict[str, tuple[int, dict]]:
+    """Map each state variable to (index of its latest writer, manifest entry)."""
+    live: dict[str, tuple[int, dict]] = {}
+    for idx, stage in enumerate(stages):
+        for var, entry in manifest.stages[stage.name]["outputs"].items():
+            live[var] = (idx, entry)
+    return live
+
+
+def run_stages(
+    stages: list[Stage],
+    state: dict,
+    *,
+    params: dict,
+    manifest: StageManifest,
+    root_hash: str,
+    make_context: Callable[[str], StageContext],
+    profiler=None,
+    store: IntermediateStore | None = None,
+    oom_retries: int = 0,
+    gate: Callable[[Stage], object] | None = None,
+) -> dict:
+    """
+    Run `stages` in order, resuming from the first missing or stale one.
+
+    Parameters
+    ----------
+    stages : list[Stage]
+    state : dict
+        Initial pipeline state; updated in place and returned.
+    params : dict
+        Full parameter dict; each stage hashes the keys listed in `Stage.params`.
+    manifest : StageManifest
+    root_hash : str
+        Hash identifying the input session, so another session never matches.
+    make_context : callable(stage_name) -> StageContext
+    profiler : StageProfiler | None
+        If given, every executed stage is profiled and skipped stages are noted.
+    store : IntermediateStore | None
+        If given, intermediate arrays are released as soon as no remaining stage
+        lists them in its inputs.
+    oom_retries : int
+        Retries of a stage that failed with KilledWorker / MemoryError; retry n
+        splits the chunks of the stage inputs (and `chk`) by 2**n, reading the
+        inputs from disk with those chunks (see _shrink_chunks), and from n = 2
+        on runs at most one task per worker. Each downgrade is printed and
+        recorded under "downgrades" in the profile.
+    gate : callable(stage) -> context manager | None
+        Entered around every executed stage, e.g. slot_gate() to share stage
+        slots with other runs on the same cluster.
+    """
+    digests = []
+    parent = root_hash
+    for stage in stages:
+        parent = param_hash({k: params.get(k) for k in stage.params}, parent)
+        digests.append(parent)
+
+    # First stage whose record is missing or was run with other parameters
+    start = 0
+    while (
+        start < len(stages)
+        and stages[start].checkpoint
+        and manifest.matches(stages[start].name, digests[start])
+    ):
+        start += 1
+
+    # Stores still needed downstream must be intact; otherwise step back to their writer
+    while True:
+        live = _live_outputs(stages[:start], manifest)
+        needed = {var for stage in stages[start:] for var in stage.inputs}
+        lost = [
+            idx
+            for var, (idx, entry) in live.items()
+            if (var in needed or entry["final"])
+            and not manifest.output_valid(stages[idx].name, var)
+        ]
+        if not lost:
+            break
+        start = min(lost)
+
+    manifest.invalidate([stage.name for stage in stages[start:]])
+    for stage in stages[:start]:
+        print(f"[pipeline] Resume: skipping '{stage.name}' (checkpoint found)")
+        if profiler is not None:
+            profiler.skipped(stage.name)
+        state.update(manifest.stages[stage.name]["meta"])
+    var_paths = {var: entry["path"] for var, (_, entry) in live.items()}
+    for var in needed & var_paths.keys():
+        state[var] = open_stage_array(var_paths[var])
+    if store is not None:
+        # Leftovers of stages that will be recomputed (or crashed half-way)
+        store.release({var_paths[var] for var in needed & var_paths.keys()})
+
+    for idx in range(start, len(stages)):
+        stage, digest = stages[idx], digests[idx]
+        with gate(stage) if gate is not None else nullcontext():
+            ctx, result = _run_stage(stage, state, make_context, var_paths, profiler, oom_retries)
+        state.update(result)
+
+        outputs, meta, final = {}, {}, set()
+        for var, value in result.items():
+            if not isinstance(value, xr.DataArray):
+                meta[var] = value
+                continue
+            if value.name not in ctx.paths:
+                raise ValueError(
+                    f"Stage '{stage.name}' returned '{var}' without saving it through its context"
+                )
+            outputs[var] = ctx.paths[value.name]
+            if value.name in ctx.final:
+                final.add(var)
+        var_paths.update(outputs)
+        if stage.checkpoint:
+            manifest.mark_complete(stage.name, digest, outputs, meta, final)
+
+        if store is not None:
+            needed = {var for later in stages[idx + 1 :] for var in later.inputs}
+            store.release({var_paths[var] for var in needed & var_paths.keys()})
+
+    return state
@@ -0,0 +1,474 @@
+"""
+Parallel AVI ingest with a decoded-video cache
+----------------------------------------------
+Replaces `load_videos` + `save_minian(varr)` at the start of run_pipeline:
+
+    1. the frames of every msCam*.avi matching param_load_videos["pattern"] are
+       counted up front (container packets, no decoding), which fixes where each
+       file's frames go in the movie
+    2. the files are decoded in a process pool straight into one frame-chunked
+       `varr.zarr` (same dims, coords and dtype as Minian's load_videos would
+       give); the spatial downsample is applied while decoding, so
+       full-resolution frames never reach disk. Every decoder writes the zarr
+       chunks that lie within its own file; the few chunks shared by two files
+       are written by the parent process
+    3. the per-pixel minimum over all frames is collected while decoding and
+       kept next to the store, so glow removal needs no extra pass over the movie
+    4. the store is kept in a cache folder under a key built from the file
+       content hashes and the param_load_videos settings, so repeat runs and
+       parameter sweeps on the same session skip decoding entirely. The cache
+       is capped at `max_bytes`: least recently used entries are removed first
+
+The cache key uses full-file content hashes, so a re-downloaded copy of the
+same videos still hits the cache. The hashes are memoised on each file's
+path, size and modification time; a fresh copy is hashed again, which reads
+the files once (in parallel) but decodes nothing.
+
+Decoding uses the ffmpeg binary with the same rawvideo/gray conversion as
+Minian's load_avi_lazy, and falls back to OpenCV if ffmpeg is not installed.
+If a file decodes to another number of frames than counted, the decode is
+redone once with the decoded counts. Only downsample_strategy="subset" (and
+"mean" without frame downsampling) is supported; anything else falls back to
+Minian's load_videos.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import re
+import shutil
+import multiprocessing as mp
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+from stage_manifest import param_hash
+from stage_profile import dir_size
+
+HASH_MEMO_NAME = "file_hashes.json"
+INGEST_INFO_NAME = "ingest.json"
+MIN_PROJECTION_NAME = "varr_min.npy"
+
+
+def _natural_key(name: str):
+    return [int(tok) if tok.isdigit() else tok.lower() for tok in re.split(r"(\d+)", name)]
+
+
+def list_videos(dpath: str, pattern: str) -> list[str]:
+    """Video files in `dpath` matching `pattern`, in natural order (msCam2 < msCam10)."""
+    files = [f for f in os.listdir(dpath) if re.search(pattern, f)]
+    if not files:
+        raise FileNotFoundError(f"No videos matching {pattern!r} found in {dpath}")
+    return [os.path.join(dpath, f) for f in sorted(files, key=_natural_key)]
+
+
+def ingest_supported(param_load_videos: dict) -> bool:
+    """True if the downsample settings can be applied while decoding."""
+    strategy = param_load_videos.get("downsample_strategy", "subset")
+    downsample = param_load_videos.get("downsample") or {}
+    return strategy == "subset" or (strategy == "mean" and downsample.get("frame", 1) == 1)
+
+
+# ---------------------------------------------------------------------------
+# Worker functions (run in the process pool)
+# ---------------------------------------------------------------------------
+
+def _hash_file(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(8 * 1024**2), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _frame_size(fname: str) -> tuple[int, int]:
+    import cv2
+
+    cap = cv2.VideoCapture(fname)
+    try:
+        return int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    finally:
+        cap.release()
+
+
+def _count_frames(fname: str) -> int:
+    """
+    Frame count of `fname` from its container (ffprobe packet count, else
+    OpenCV's frame count); 0 if neither knows. Checked against the decode.
+    """
+    if shutil.which("ffprobe"):
+        result = subprocess.run(
+            [
+                "ffprobe", "-v", "error", "-select_streams", "v:0", "-count_packets",
+                "-show_entries", "stream=nb_read_packets", "-of", "csv=p=0", fname,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode == 0 and result.stdout.strip().isdigit():
+            return int(result.stdout.strip())
+    import cv2
+
+    cap = cv2.VideoCapture(fname)
+    try:
+        return max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+    finally:
+        cap.release()
+
+
+def _iter_frames(fname: str):
+    """Yield grayscale uint8 frames of `fname`."""
+    if shutil.which("ffmpeg"):
+        h, w = _frame_size(fname)
+        proc = subprocess.Popen(
+            ["ffmpeg", "-v", "error", "-i", fname, "-f", "rawvideo", "-pix_fmt", "gray", "pipe:"],
+            stdout=subprocess.PIPE,
+        )
+        try:
+            while True:
+                buf = proc.stdout.read(h * w)
+                if len(buf) < h * w:
+                    break
+                yield np.frombuffer(buf, np.uint8).reshape(h, w)
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        return
+
+    import cv2
+
+    cap = cv2.VideoCapture(fname)
+    try:
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    finally:
+        cap.release()
+
+
+def _downsample_frame(frame: np.ndarray, downsample: dict, strategy: str) -> np.ndarray:
+    dh, dw = downsample.get("height", 1), downsample.get("width", 1)
+    if strategy == "subset":
+        return frame[::dh, ::dw]
+    # "mean": same as xarray coarsen(boundary="trim").mean()
+    h, w = (frame.shape[0] // dh) * dh, (frame.shape[1] // dw) * dw
+    return frame[:h, :w].reshape(h // dh, dh, w // dw, dw).mean(axis=(1, 3))
+
+
+def _decode_file(job: tuple) -> tuple[int, np.ndarray | None, list[tuple[int, np.ndarray]]]:
+    """
+    Decode one video into its frames of the `varr` array in the zarr store.
+
+    The file's raw frames start at raw frame `raw_offset` of the movie and are
+    expected to number `n_expected`; only every `step`-th raw frame of the movie
+    is kept. Zarr chunks entirely within the file's frames are written here;
+    the frames of chunks it shares with other files are returned instead as
+    (first frame index, frames) pieces, one per chunk.
+
+    Returns the number of raw frames decoded, the per-pixel minimum over the
+    kept frames and the pieces.
+    """
+    import zarr
+
+    fname, store_path, downsample, strategy, raw_offset, n_expected, max_frames, step = job
+    target = zarr.open_group(store_path, mode="r+")["varr"]
+    chunk = target.chunks[0]
+    end = -(-(raw_offset + n_expected) // step)
+    buf, buf_start, pieces = [], -(-raw_offset // step), []
+    n_raw, frame_min = 0, None
+
+    def flush():
+        nonlocal buf_start
+        if not buf:
+            return
+        block = np.stack(buf).astype(target.dtype)
+        c0 = buf_start // chunk * chunk
+        c1 = min(c0 + chunk, target.shape[0])
+        if buf_start == c0 and buf_start + len(block) == c1:
+            target[c0:c1] = block
+        else:
+            pieces.append((buf_start, block))
+        buf_start += len(block)
+        buf.clear()
+
+    for i, frame in enumerate(itertools.islice(_iter_frames(fname), max_frames)):
+        n_raw += 1
+        raw = raw_offset + i
+        if i >= n_expected or raw % step:
+            continue
+        frame = _downsample_frame(frame, downsample, strategy)
+        frame_min = frame if frame_min is None else np.minimum(frame_min, frame)
+        buf.append(frame)
+        idx = raw // step
+        if (idx + 1) % chunk == 0 or idx + 1 == end:
+            flush()
+    flush()
+    if n_raw == 0:
+        raise RuntimeError(f"No frames could be decoded from {fname}")
+    return n_raw, frame_min, pieces
+
+
+# ---------------------------------------------------------------------------
+# Cache
+# ---------------------------------------------------------------------------
+
+def _file_hashes(files: list[str], cache_root: str, pool: ProcessPoolExecutor) -> list[str]:
+    """
+    Full content hashes of `files`, memoised in the cache root on
+    (path, size, mtime): only new or changed files are read.
+    """
+    memo_path = os.path.join(cache_root, HASH_MEMO_NAME)
+    memo = {}
+    if os.path.exists(memo_path):
+        try:
+            with open(memo_path, "r") as fh:
+                memo = json.load(fh)
+        except (OSError, ValueError):
+            memo = {}
+
+    keys = []
+    for path in files:
+        st = os.stat(path)
+        keys.append(f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}")
+    todo = [(f, k) for f, k in zip(files, keys) if k not in memo]
+    for (_, key), digest in zip(todo, pool.map(_hash_file, [f for f, _ in todo])):
+        memo[key] = digest
+
+    tmp_path = memo_path + ".tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump(memo, fh, indent=2)
+    os.replace(tmp_path, memo_path)
+    return [memo[k] for k in keys]
+
+
+def evict_cache(cache_root: str, max_bytes: int | None, keep: str | None = None) -> int:
+    """
+    Remove the least recently used entries of the cache in `cache_root` until
+    it holds at most `max_bytes` (None: no limit); the entry `keep` is never
+    removed. Unfinished (".tmp") entries are left alone. Returns the bytes freed.
+    """
+    if max_bytes is None or not os.path.isdir(cache_root):
+        return 0
+    entries = []
+    for name in os.listdir(cache_root):
+        info = os.path.join(cache_root, name, INGEST_INFO_NAME)
+        if os.path.exists(info):
+            path = os.path.join(cache_root, name)
+            entries.append((os.path.getmtime(info), path, dir_size(path)))
+    total, freed = sum(size for _, _, size in entries), 0
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.normpath(path) == os.path.normpath(keep):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        freed += size
+        print(f"[ingest] Evicted decoded video cache entry {os.path.basename(path)} ({size / 1024**3:.2f} GB)")
+    return freed
+
+
+def cache_key(file_hashes: list[str], param_load_videos: dict, video_subset: dict | None = None) -> str:
+    """Cache key of a decoded session: file contents + the load settings."""
+    payload = {"files": file_hashes, "param_load_videos": param_load_videos}
+    if video_subset:
+        payload["video_subset"] = video_subset
+    return param_hash(payload)
+
+
+def _create_store(
+    path: str, n_frames: int, frame_shape: tuple[int, int], dtype, steps: tuple[int, int, int]
+) -> None:
+    """Empty `varr` store with Minian's coords and the chunking run_pipeline uses."""
+    import dask.array as darr
+    from minian.utilities import get_optimal_chk
+
+    step, dh, dw = steps
+    varr = xr.DataArray(
+        darr.zeros((n_frames,) + frame_shape, dtype=dtype),
+        dims=["frame", "height", "width"],
+        # Both "subset" and coarsen(coord_func="min") keep the first index of every step
+        coords=dict(
+            frame=np.arange(n_frames) * step,
+            height=np.arange(frame_shape[0]) * dh,
+            width=np.arange(frame_shape[1]) * dw,
+        ),
+        name="varr",
+    )
+    chk, _ = get_optimal_chk(varr, dtype=float)
+    varr = varr.chunk({"frame": chk["frame"], "height": -1, "width": -1})
+    # Writes the metadata and coords only; the decoders fill in the frames
+    varr.to_dataset().to_zarr(path, mode="w", compute=False)
+
+
+def _decode_into(
+    store_path: str,
+    files: list[str],
+    counts: list[int],
+    frame_shape: tuple[int, int],
+    dtype,
+    downsample: dict,
+    strategy: str,
+    max_frames: int | None,
+    pool: ProcessPoolExecutor,
+) -> tuple[list[int], list]:
+    """
+    Decode `files` into a new store at `store_path`, assuming `counts` raw
+    frames per file. Returns the decoded frame counts and per-file minima; the
+    store is only complete if the counts match.
+    """
+    import zarr
+
+    step = downsample.get("frame", 1)
+    n_frames = -(-sum(counts) // step)
+    _create_store(
+        store_path, n_frames, frame_shape, dtype, (step, downsample.get("height", 1), downsample.get("width", 1))
+    )
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+    jobs = [
+        (f, store_path, downsample, strategy, int(offset), count, max_frames, step)
+        for f, offset, count in zip(files, offsets, counts)
+    ]
+    decoded, frame_mins, pieces = zip(*pool.map(_decode_file, jobs))
+
+    # Chunks shared by several files: join their pieces and write each chunk once
+    target = zarr.open_group(store_path, mode="r+")["varr"]
+    shared: dict[int, list] = {}
+    for start, block in itertools.chain.from_iterable(pieces):
+        shared.setdefault(start // target.chunks[0], []).append((start, block))
+    for parts in shared.values():
+        parts.sort(key=lambda part: part[0])
+        block = np.concatenate([b for _, b in parts])
+        target[parts[0][0] : parts[0][0] + len(block)] = block
+    return list(decoded), list(frame_mins)
+
+
+def ingest_videos(
+    dpath: str,
+    param_load_videos: dict,
+    cache_root: str,
+    n_procs: int | None = None,
+    video_subset: dict | None = None,
+    max_bytes: int | str | None = None,
+) -> str:
+    """
+    Decode the session videos into a cached `varr.zarr` and return its path.
+
+    Parameters
+    ----------
+    dpath : str
+        Session folder with the raw videos.
+    param_load_videos : dict
+        Same settings as for Minian's load_videos (pattern, dtype, downsample,
+        downsample_strategy).
+    cache_root : str
+        Folder holding one sub-folder per cache key.
+    n_procs : int | None
+        Decoder processes (default: one per video, at most the available cores).
+    video_subset : dict | None
+        Only decode the first "max_files" videos and the first "frames_per_file"
+        frames of each (either may be None), e.g. for preview runs.
+    max_bytes : int | str | None
+        Size cap of the cache, e.g. "50GB" (None: unlimited). Least recently
+        used entries are removed once the entry of this session is in place.
+        With a cache folder shared by concurrent runs, keep it above what those
+        runs decode together.
+    """
+    video_subset = video_subset or {}
+    files = list_videos(dpath, param_load_videos["pattern"])[: video_subset.get("max_files")]
+    max_frames = video_subset.get("frames_per_file")
+    downsample = dict(param_load_videos.get("downsample") or {})
+    strategy = param_load_videos.get("downsample_strategy", "subset")
+    if isinstance(max_bytes, str):
+        from dask.utils import parse_bytes
+
+        max_bytes = parse_bytes(max_bytes)
+    if n_procs is None:
+        try:
+            n_procs = len(os.sched_getaffinity(0))
+        except AttributeError:
+            n_procs = os.cpu_count() or 1
+    n_procs = max(min(n_procs, len(files)), 1)
+    os.makedirs(cache_root, exist_ok=True)
+
+    # spawn, not fork: the Dask client and the profiler's sampler thread are alive here
+    with ProcessPoolExecutor(max_workers=n_procs, mp_context=mp.get_context("spawn")) as pool:
+        key = cache_key(_file_hashes(files, cache_root, pool), param_load_videos, video_subset)
+        entry = os.path.join(cache_root, key)
+        store_path = os.path.join(entry, "varr.zarr")
+        info_path = os.path.join(entry, INGEST_INFO_NAME)
+        if os.path.exists(info_path):
+            print(f"[ingest] Decoded video cache hit ({key}); skipping decode")
+            os.utime(info_path)  # most recently used
+            evict_cache(cache_root, max_bytes, keep=entry)
+            return store_path
+
+        # load_videos casts before downsampling, so a "mean" result stays float
+        dtype = np.uint8 if strategy == "subset" else np.float64
+        if strategy == "subset" and param_load_videos.get("dtype") is not None:
+            dtype = np.dtype(param_load_videos["dtype"])
+        h, w = _frame_size(files[0])
+        dh, dw = downsample.get("height", 1), downsample.get("width", 1)
+        if strategy == "subset":
+            frame_shape = (-(-h // dh), -(-w // dw))
+        else:
+            frame_shape = (h // dh, w // dw)
+
+        counts = [min(n, max_frames) if max_frames else n for n in pool.map(_count_frames, files)]
+        print(f"[ingest] Decoding {len(files)} videos ({sum(counts)} frames) with {n_procs} processes ...")
+        tmp_entry = entry + ".tmp"
+        tmp_store = os.path.join(tmp_entry, "varr.zarr")
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+        args = (frame_shape, dtype, downsample, strategy, max_frames, pool)
+        frame_counts, frame_mins = _decode_into(tmp_store, files, counts, *args)
+        if frame_counts != counts:
+            print(
+                f"[ingest] WARNING: decoded frame counts {frame_counts} differ from the container "
+                f"counts {counts}; decoding again with the decoded counts"
+            )
+            counts = frame_counts
+            frame_counts, frame_mins = _decode_into(tmp_store, files, counts, *args)
+            if frame_counts != counts:
+                raise RuntimeError(f"Frame counts of {dpath} changed between two decodes")
+
+    n_frames = -(-sum(frame_counts) // downsample.get("frame", 1))
+    # The min-projection only matches varr if no frames were dropped
+    has_min = downsample.get("frame", 1) == 1
+    if has_min:
+        varr_min = np.minimum.reduce([m for m in frame_mins if m is not None]).astype(dtype)
+        np.save(os.path.join(tmp_entry, MIN_PROJECTION_NAME), varr_min)
+
+    with open(os.path.join(tmp_entry, INGEST_INFO_NAME), "w") as fh:
+        json.dump(
+            {
+                "dpath": os.path.abspath(dpath),
+                "files": [os.path.basename(f) for f in files],
+                "frames_per_file": list(frame_counts),
+                "min_projection": has_min,
+                "param_load_videos": param_load_videos,
+                "video_subset": video_subset,
+                "shape": [n_frames, *frame_shape],
+            },
+            fh,
+            indent=2,
+            default=repr,
+        )
+    shutil.rmtree(entry, ignore_errors=True)
+    os.rename(tmp_entry, entry)
+    print(f"[ingest] Decoded {n_frames} frames into cache entry {key}")
+    evict_cache(cache_root, max_bytes, keep=entry)
+    return store_path
+
+
+def load_min_projection(store_path: str) -> np.ndarray | None:
+    """Min-projection collected while decoding `store_path`, or None if there is none."""
+    path = os.path.join(os.path.dirname(store_path), MIN_PROJECTION_NAME)
+    if not os.path.exists(path):
+        return None
+    return np.load(path)
@@ -0,0 +1,154 @@
+"""
+Resumable batch manifest for low_level_loop.py
+----------------------------------------------
+One SQLite file in OUTPUT_BASE (batch_manifest.sqlite) records, per session:
+
+    status        running | done | failed
+    input_hash    hash of the (path, size) list of the files the pipeline reads
+    param_hash    hash of the pipeline parameters / mode the batch ran with
+    started, finished, runtime_s, error
+    outputs       inventory of <output>/minian: entry name -> bytes
+
+A rerun processes a session only if it is new, failed (or was interrupted
+while running), or stale: its inputs or parameters changed, or an
+inventoried output is gone. Sizes stand in for checksums: iRODS does not
+always have checksums, and computing them would mean reading every video.
+
+Usage
+-----
+    manifest = BatchManifest("/scratch/s4750098/minian_outputs/batch_manifest.sqlite")
+    reason = manifest.needs_run("Batch 1/24/24_T2", input_hash, param_hash, output_dir)
+    # None: complete and current; otherwise why it has to run
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+BATCH_MANIFEST_NAME = "batch_manifest.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session     TEXT PRIMARY KEY,
+    status      TEXT NOT NULL,
+    input_hash  TEXT,
+    inputs      TEXT,
+    param_hash  TEXT,
+    started     REAL,
+    finished    REAL,
+    runtime_s   REAL,
+    error       TEXT,
+    outputs     TEXT
+)
+"""
+
+
+def input_hash(files) -> str:
+    """Hash of a list of (relative path, size) pairs, independent of their order."""
+    payload = json.dumps(sorted((str(path), int(size)) for path, size in files))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def _tree_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+def output_inventory(output_dir: str) -> dict[str, int]:
+    """Bytes of every entry (zarr store, CSV, figure, ...) in <output_dir>/minian."""
+    minian_dir = os.path.join(output_dir, "minian")
+    if not os.path.isdir(minian_dir):
+        return {}
+    return {name: _tree_size(os.path.join(minian_dir, name)) for name in sorted(os.listdir(minian_dir))}
+
+
+class BatchManifest:
+    """SQLite record of the sessions of a batch (see the module docstring)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as db:
+            db.execute(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """Connection that commits on success and is always closed."""
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def get(self, session: str) -> dict | None:
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM sessions WHERE session = ?", (session,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def needs_run(self, session: str, in_hash: str, run_hash: str, output_dir: str) -> str | None:
+        """Why `session` has to be (re)processed, or None if it is complete and current."""
+        row = self.get(session)
+        if row is None:
+            return "new"
+        if row["status"] != "done":
+            return row["status"]
+        if row["input_hash"] != in_hash:
+            return "stale: input files changed"
+        if row["param_hash"] != run_hash:
+            return "stale: parameters changed"
+        outputs = json.loads(row["outputs"] or "{}")
+        if not outputs:
+            return "stale: no outputs recorded"
+        missing = [name for name in outputs if not os.path.exists(os.path.join(output_dir, "minian", name))]
+        if missing:
+            return f"stale: outputs missing ({', '.join(missing)})"
+        return None
+
+    def mark_running(self, session: str, in_hash: str, inputs, run_hash: str) -> None:
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO sessions "
+                "(session, status, input_hash, inputs, param_hash, started, finished, runtime_s, error, outputs) "
+                "VALUES (?, 'running', ?, ?, ?, ?, NULL, NULL, NULL, NULL)",
+                (
+                    session,
+                    in_hash,
+                    json.dumps([(str(path), int(size)) for path, size in inputs]),
+                    run_hash,
+                    time.time(),
+                ),
+            )
+
+    def mark_done(self, session: str, output_dir: str) -> None:
+        self._finish(session, "done", None, json.dumps(output_inventory(output_dir)))
+
+    def mark_failed(self, session: str, error: str) -> None:
+        self._finish(session, "failed", error, None)
+
+    def _finish(self, session: str, status: str, error: str | None, outputs: str | None) -> None:
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "UPDATE sessions SET status = ?, finished = ?, runtime_s = ? - started, error = ?, outputs = ? "
+                "WHERE session = ?",
+                (status, now, now, error, outputs, session),
+            )
+
+    def summary(self) -> dict[str, int]:
+        """Number of sessions per status."""
+        with self._connect() as db:
+            rows = db.execute("SELECT status, COUNT(*) FROM sessions GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
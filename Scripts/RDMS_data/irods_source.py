@@ -0,0 +1,375 @@
+"""
+Where low_level_loop.py reads its sessions from
+-----------------------------------------------
+    IrodsSource      iRODS through the icommands (ils / iget)
+    LocalDirSource   a local folder laid out like IRODS_BASE; a stand-in for
+                     iRODS in tests, or for data that is already on disk
+
+Both offer the same calls, with collection paths relative to their base:
+    discover(root_rel)        every collection below root_rel
+    size(rel)                 bytes in collection rel (for the /scratch budget)
+    fetch(rel, local_path)    download collection rel into local_path
+
+Discovery (IrodsSource): "ils" walks the recursive `ils -r` listing, which
+also prints every data object. "query" asks the catalog for the collection
+names only (`iquest`). "cached" takes the collection tree from the same single
+catalog query (names and modification times) and keeps the data objects of
+every collection in a JSON cache: only collections that are new or whose time
+changed are listed again (non-recursive `ils -l`), and size() / fetch() of a
+cached collection need no `ils` at all. A collection's time changes when data
+objects are added to or removed from it; an object overwritten in place with
+another size is only picked up once its collection is re-listed. All icommands
+are configurable; tests/fake_icommands has `ils` / `iquest` stand-ins that
+serve a local folder.
+
+Selective transfers: given a `pattern` (regular expression, as
+param_load_videos["pattern"]) and/or an `include` list (file name globs, e.g.
+"timestamp.dat"), only the matching files are fetched and counted by size(),
+one file per transfer on a pool of `n_threads` threads. Every file is retried
+up to `retries` times, and per-file and total throughput is logged. Without
+either, the whole collection is fetched as before.
+
+Usage
+-----
+    source = LocalDirSource("/scratch/s4750098/fake_irods")
+    for rel in source.discover("Batch 1/24"):
+        print(rel, source.size(rel))
+"""
+
+import abc
+import fnmatch
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+
+
+class _Source(abc.ABC):
+    """File selection and the parallel per-file transfer shared by both sources."""
+
+    def __init__(
+        self,
+        pattern: str | None = None,
+        include: tuple[str, ...] = (),
+        n_threads: int = 4,
+        retries: int = 3,
+    ):
+        self.pattern = pattern
+        self.include = tuple(include)
+        self.n_threads = max(int(n_threads), 1)
+        self.retries = max(int(retries), 0)
+
+    @property
+    def selective(self) -> bool:
+        return self.pattern is not None or bool(self.include)
+
+    def wanted(self, name: str) -> bool:
+        """Whether a file name matches the pattern or the include list."""
+        if self.pattern is not None and re.search(self.pattern, name):
+            return True
+        return any(fnmatch.fnmatch(name, glob) for glob in self.include)
+
+    @abc.abstractmethod
+    def discover(self, root_rel: str) -> list[PurePosixPath]:
+        """Every collection below root_rel, relative to the base."""
+
+    @abc.abstractmethod
+    def list_files(self, rel) -> list[tuple[PurePosixPath, int]]:
+        """(path inside the collection, size) of every file in collection rel."""
+
+    @abc.abstractmethod
+    def fetch(self, rel, local_path: Path) -> None:
+        """Download collection rel (or its selected files) into local_path."""
+
+    @abc.abstractmethod
+    def _fetch_file(self, rel, path: PurePosixPath, local_file: Path) -> None:
+        """Download one file of collection rel to local_file."""
+
+    def selected_files(self, rel) -> list[tuple[PurePosixPath, int]]:
+        files = self.list_files(rel)
+        if not self.selective:
+            return files
+        return [(path, size) for path, size in files if self.wanted(path.name)]
+
+    def size(self, rel) -> int:
+        return sum(size for _, size in self.selected_files(rel))
+
+    def _fetch_with_retries(self, rel, path: PurePosixPath, size: int, local_file: Path) -> float:
+        local_file.parent.mkdir(parents=True, exist_ok=True)
+        for attempt in range(self.retries + 1):
+            start = time.time()
+            try:
+                self._fetch_file(rel, path, local_file)
+            except Exception as exc:
+                if attempt == self.retries:
+                    raise
+                wait = 2**attempt
+                print(f"[transfer] WARNING: {path} failed ({exc}); retry {attempt + 1}/{self.retries} in {wait}s")
+                time.sleep(wait)
+                continue
+            wall = time.time() - start
+            print(f"[transfer] {path}: {size / 1024**2:.1f} MB in {wall:.1f}s ({size / 1024**2 / max(wall, 1e-9):.1f} MB/s)")
+            return wall
+
+    def fetch_selected(self, rel, local_path: Path) -> None:
+        """Fetch only the selected files of `rel`, n_threads at a time."""
+        files = self.selected_files(rel)
+        if not files:
+            raise RuntimeError(f"No files in {rel} match pattern {self.pattern!r} / include {self.include}")
+        total = sum(size for _, size in files)
+        print(
+            f"[transfer] Fetching {len(files)} file(s) of {rel} ({total / 1024**3:.2f} GB) "
+            f"with {self.n_threads} thread(s) ..."
+        )
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            futures = [
+                pool.submit(self._fetch_with_retries, rel, path, size, local_path / Path(*path.parts))
+                for path, size in files
+            ]
+            for future in futures:
+                future.result()
+        wall = time.time() - start
+        print(f"[transfer] {rel}: {total / 1024**3:.2f} GB in {wall:.1f}s ({total / 1024**2 / max(wall, 1e-9):.1f} MB/s)")
+
+
+class IrodsSource(_Source):
+    """
+    Parameters
+    ----------
+    base : str
+        iRODS collection the relative paths start from (IRODS_BASE).
+    ils, iget, iquest : str
+        icommand executables, e.g. fake scripts in tests.
+    discovery : "ils" | "query" | "cached"
+        How discover() finds collections (see the module docstring).
+    cache_path : str | None
+        JSON file of the "cached" discovery.
+    pattern, include, n_threads, retries :
+        Selective transfer settings (see the module docstring).
+    """
+
+    def __init__(
+        self,
+        base: str,
+        ils: str = "ils",
+        iget: str = "iget",
+        iquest: str = "iquest",
+        discovery: str = "ils",
+        cache_path: str | None = None,
+        **transfer,
+    ):
+        super().__init__(**transfer)
+        if discovery not in ("ils", "query", "cached"):
+            raise ValueError(f"Unknown discovery mode '{discovery}'")
+        if discovery == "cached" and cache_path is None:
+            raise ValueError("discovery='cached' needs a cache_path")
+        self.base = base.rstrip("/")
+        self.ils = ils
+        self.iget = iget
+        self.iquest = iquest
+        self.discovery = discovery
+        self.cache_path = cache_path
+        self._cache: dict | None = None
+
+    def _abs(self, rel) -> str:
+        return f"{self.base}/{PurePosixPath(rel).as_posix()}"
+
+    def _run(self, args: list[str]) -> str:
+        result = subprocess.run(args, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"{' '.join(args)} failed\nstderr: {result.stderr.strip()}")
+        return result.stdout
+
+    def _relative(self, colls) -> list[PurePosixPath]:
+        folders = []
+        for coll in colls:
+            try:
+                folders.append(PurePosixPath(coll).relative_to(PurePosixPath(self.base)))
+            except ValueError:
+                continue
+        return folders
+
+    def discover(self, root_rel: str) -> list[PurePosixPath]:
+        """Collections below root_rel (root_rel included), relative to base."""
+        root = self._abs(root_rel).rstrip("/")
+        if self.discovery == "query":
+            return self._relative(self._query_collections(root))
+        if self.discovery == "cached":
+            return self._relative(self._discover_cached(root))
+        return self._discover_ils(root_rel)
+
+    def _query_collections(self, root: str) -> dict[str, str]:
+        """Modification time of root and every collection below it, from the catalog."""
+        args = [
+            self.iquest,
+            "--no-page",
+            "%s|%s",
+            f"SELECT COLL_NAME, COLL_MODIFY_TIME WHERE COLL_NAME = '{root}' || like '{root}/%'",
+        ]
+        result = subprocess.run(args, capture_output=True, text=True)
+        if "CAT_NO_ROWS_FOUND" in result.stdout + result.stderr:
+            raise RuntimeError(f"{root} not found")
+        if result.returncode != 0:
+            raise RuntimeError(f"{' '.join(args)} failed\nstderr: {result.stderr.strip()}")
+        mtimes = {}
+        for line in result.stdout.splitlines():
+            coll, sep, mtime = line.strip().rpartition("|")
+            if sep:
+                mtimes[coll] = mtime
+        return mtimes
+
+    def _load_cache(self) -> dict:
+        if self._cache is None:
+            self._cache = {}
+            if os.path.exists(self.cache_path):
+                with open(self.cache_path, "r") as fh:
+                    self._cache = json.load(fh)
+        return self._cache
+
+    def _discover_cached(self, root: str) -> list[str]:
+        cache = self._load_cache()
+        old = cache.get(root, {}).get("collections", {})
+
+        # The tree comes from the query; only new or modified collections are listed again
+        mtimes = self._query_collections(root)
+        collections, relisted = {}, 0
+        for coll, mtime in mtimes.items():
+            if coll in old and old[coll]["mtime"] == mtime and "files" in old[coll]:
+                collections[coll] = old[coll]
+            else:
+                files = self._ils_objects(coll, recursive=False)
+                collections[coll] = {"mtime": mtime, "files": [[str(path), size] for path, size in files]}
+                relisted += 1
+        cache[root] = {"collections": collections, "refreshed": time.time()}
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(cache, fh)
+        os.replace(tmp_path, self.cache_path)
+        print(f"[discover] {root}: {len(collections)} collection(s), {relisted} re-listed")
+        return sorted(collections)
+
+    def _cached_files(self, coll: str) -> list[tuple[PurePosixPath, int]] | None:
+        """list_files of `coll` from the discovery cache, or None if it is not cached."""
+        for root, entry in self._load_cache().items():
+            collections = entry["collections"]
+            if coll not in collections:
+                continue
+            files = []
+            for sub, info in collections.items():
+                if sub == coll or sub.startswith(coll + "/"):
+                    prefix = PurePosixPath(sub).relative_to(PurePosixPath(coll))
+                    files.extend((prefix / name, int(size)) for name, size in info["files"])
+            return files
+        return None
+
+    def _discover_ils(self, root_rel: str) -> list[PurePosixPath]:
+        # Run the ils command with flag -r to get a recursive list of the root folder.
+        stdout = self._run([self.ils, "-r", self._abs(root_rel)])
+
+        # The output lines that end with ":" indicate folders.
+        folders = []
+        for line in stdout.splitlines():
+            s = line.strip()
+            if not s.endswith(":"):
+                continue
+            s = s[:-1]
+            if s.startswith("C- "):
+                s = s[3:].strip()
+            try:
+                rel = PurePosixPath(s).relative_to(PurePosixPath(self.base))
+            except ValueError:
+                continue
+            folders.append(rel)
+        return folders
+
+    def list_files(self, rel) -> list[tuple[PurePosixPath, int]]:
+        """(path relative to the collection, size in bytes) of every data object below rel."""
+        coll = self._abs(rel).rstrip("/")
+        if self.discovery == "cached":
+            files = self._cached_files(coll)
+            if files is not None:
+                return files
+        return self._ils_objects(coll, recursive=True)
+
+    def _ils_objects(self, coll: str, recursive: bool) -> list[tuple[PurePosixPath, int]]:
+        """Data objects of `coll` (and, if recursive, below it) from `ils -l`."""
+        coll = PurePosixPath(coll)
+        stdout = self._run([self.ils, "-l", *(["-r"] if recursive else []), str(coll)])
+
+        files, seen = [], set()
+        current = coll
+        for line in stdout.splitlines():
+            s = line.strip()
+            if not s or s.startswith("C- "):
+                continue
+            if s.endswith(":") and s.startswith("/"):
+                current = PurePosixPath(s[:-1])
+                continue
+            # owner  replica  resource  size  date  status  name
+            fields = s.split(maxsplit=6)
+            if len(fields) < 7 or not fields[3].isdigit():
+                continue
+            path = (current / fields[6]).relative_to(coll)
+            # Every replica of an object is listed; count it once
+            if path not in seen:
+                seen.add(path)
+                files.append((path, int(fields[3])))
+        return files
+
+    def _fetch_file(self, rel, path: PurePosixPath, local_file: Path) -> None:
+        self._run([self.iget, "-f", f"{self._abs(rel)}/{path.as_posix()}", str(local_file)])
+
+    def fetch(self, rel, local_path: Path) -> None:
+        """Download the selected files, or the whole collection with `iget -r -f`."""
+        if self.selective:
+            self.fetch_selected(rel, local_path)
+            return
+        irods_path = self._abs(rel)
+        local_path.mkdir(parents=True, exist_ok=True)
+        self._run([self.iget, "-r", "-f", irods_path, str(local_path)])
+        print(f"[iget] Downloaded {irods_path} -> {local_path}")
+
+
+class LocalDirSource(_Source):
+    """A local folder laid out like the iRODS tree under IRODS_BASE."""
+
+    def __init__(self, base: str, **transfer):
+        super().__init__(**transfer)
+        self.base = Path(base)
+
+    def discover(self, root_rel: str) -> list[PurePosixPath]:
+        root = self.base / root_rel
+        if not root.is_dir():
+            raise RuntimeError(f"{root} does not exist")
+        folders = [PurePosixPath(root_rel)]
+        for dirpath, dirnames, _ in os.walk(root):
+            for name in dirnames:
+                folders.append(PurePosixPath(Path(dirpath, name).relative_to(self.base).as_posix()))
+        return folders
+
+    def list_files(self, rel) -> list[tuple[PurePosixPath, int]]:
+        coll = self.base / rel
+        files = []
+        for dirpath, _, filenames in os.walk(coll):
+            for name in filenames:
+                path = Path(dirpath, name)
+                files.append((PurePosixPath(path.relative_to(coll).as_posix()), path.stat().st_size))
+        return files
+
+    def _fetch_file(self, rel, path: PurePosixPath, local_file: Path) -> None:
+        shutil.copyfile(self.base / rel / Path(*path.parts), local_file)
+
+    def fetch(self, rel, local_path: Path) -> None:
+        if self.selective:
+            self.fetch_selected(rel, local_path)
+            return
+        src = self.base / rel
+        shutil.copytree(src, local_path, dirs_exist_ok=True)
+        print(f"[copy] Copied {src} -> {local_path}")
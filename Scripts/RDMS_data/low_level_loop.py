@@ -5,6 +5,8 @@ For each folder in FOLDER_LIST:
   1. iget  : download from iRODS -> /scratch
   2. compute: run your analysis on the local copy
   3. cleanup: delete the local /scratch copy (iRODS copy is untouched)
+Sessions already completed with the same inputs and parameters are skipped
+(RESUME_BATCH, see batch_manifest.py).
 
 Requirements
   - icommands installed and iinit authenticated before running (Hábrok has it preinstalled)
@@ -29,7 +31,6 @@ Requirements
 ----------------------------------------------------------------------------------------------------
 """
 
-import subprocess
 import shutil
 import sys
 import os
@@ -42,6 +43,13 @@ _THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 _MINIAN_SCRIPTS_DIR = os.path.join(_THIS_DIR, "..", "Minian_data")
 if _MINIAN_SCRIPTS_DIR not in sys.path:
     sys.path.insert(0, os.path.abspath(_MINIAN_SCRIPTS_DIR))
+if _THIS_DIR not in sys.path:
+    sys.path.insert(0, _THIS_DIR)
+
+from dask.utils import parse_bytes  # noqa: E402
+from batch_manifest import BATCH_MANIFEST_NAME, BatchManifest, input_hash  # noqa: E402
+from irods_source import IrodsSource, LocalDirSource  # noqa: E402
+from prefetch import Prefetcher  # noqa: E402
 
 _PIPELINE_FILE = os.path.join(_MINIAN_SCRIPTS_DIR, "pipeline.py")
 _pipeline_spec = importlib.util.spec_from_file_location("pipeline", _PIPELINE_FILE)
@@ -69,31 +77,86 @@ REQUIRED = ("_T", "_PostEx")
 # Example: ("_T1", "_T2") to process only those sessions.
 T_SUBSET = ()
 
+# Keep one Dask cluster alive for all sessions instead of building a new one per
+# session. Workers are restarted between sessions to release their memory.
+REUSE_CLUSTER = True
+
+# "auto" sizes the Dask cluster from the cores / memory of this SLURM job
+# (see Minian_data/cluster_sizing.py); None keeps the fixed pipeline defaults.
+CLUSTER_SIZE = "auto"
+
+# Skip all video / figure rendering on the cluster. The arrays the videos need are
+# kept in <output>/render_inputs; run Minian_data/render.py on them later.
+COMPUTE_ONLY = False
+
+# Download the next sessions in the background while the current one computes
+# (see prefetch.py). PREFETCH_DEPTH sessions are fetched ahead; 0 is the old
+# download -> compute -> cleanup order.
+PREFETCH_DEPTH = 1
+
+# Most /scratch space the downloaded sessions (computing + prefetched) may take
+# together, e.g. "300GB"; None only limits by PREFETCH_DEPTH.
+SCRATCH_BUDGET = None
+
+# Local folder laid out like IRODS_BASE to read sessions from instead of iRODS
+# (a stand-in for tests, or data already on disk); None uses iRODS.
+LOCAL_SOURCE = None
+
+
+# Download only the files run_pipeline reads: the videos matching
+# param_load_videos["pattern"] plus INCLUDE_FILES (file name globs), TRANSFER_THREADS
+# files at a time with TRANSFER_RETRIES retries each. False fetches whole collections.
+SELECTIVE_DOWNLOAD = True
+INCLUDE_FILES = ("timestamp.dat",)
+TRANSFER_THREADS = 4
+TRANSFER_RETRIES = 3
+
+
+# Skip sessions that the batch manifest (OUTPUT_BASE/batch_manifest.sqlite) records
+# as completed with the same input files and parameters, and whose outputs are
+# still there (see batch_manifest.py). False reprocesses every selected session.
+RESUME_BATCH = True
+
+
+# How discover_folders_under finds the session collections (see irods_source.py):
+#   "ils"     recursive `ils -r` of the whole root, which lists every data object
+#   "query"   collection names straight from the catalog (`iquest`)
+#   "cached"  collection tree from the same query; the files of every collection
+#             are cached in DISCOVERY_CACHE and only collections whose modification
+#             time changed since the last run are listed again
+# "query" and "cached" need iquest on the catalog; opt in once that works on your zone
+DISCOVERY = "ils"
+DISCOVERY_CACHE = OUTPUT_BASE / "irods_discovery_cache.json"
+
+# icommand executables; point them at fake scripts to test without iRODS
+ICOMMANDS = {"ils": "ils", "iget": "iget", "iquest": "iquest"}
+
+
+def make_source():
+    """The iRODS collection (or local stand-in) sessions are read from."""
+    transfer = {}
+    if SELECTIVE_DOWNLOAD:
+        transfer = {
+            "pattern": pipeline.default_params()["param_load_videos"]["pattern"],
+            "include": INCLUDE_FILES,
+            "n_threads": TRANSFER_THREADS,
+            "retries": TRANSFER_RETRIES,
+        }
+    if LOCAL_SOURCE is not None:
+        return LocalDirSource(LOCAL_SOURCE, **transfer)
+    return IrodsSource(
+        IRODS_BASE,
+        discovery=DISCOVERY,
+        cache_path=str(DISCOVERY_CACHE),
+        **ICOMMANDS,
+        **transfer,
+    )
+
+
 # Function for looking through the total on iRODS_BASE before downloading. 
 def discover_folders_under(root_rel: str) -> list[PurePosixPath]:
-    root_abs = f"{IRODS_BASE}/{root_rel}"
-    # Run the ils command with flag -r to get a recursive list of the root folder.
-    result = subprocess.run(["ils", "-r", root_abs], capture_output=True, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(result.stderr.strip())
-
-    # Parse the output to extract folder paths relative to IRODS_BASE. The output lines that end with ":" indicate folders.
-    folders = []
-    for line in result.stdout.splitlines():
-        s = line.strip()
-        if not s.endswith(":"):
-            continue
-        s = s[:-1]
-        if s.startswith("C- "):
-            s = s[3:].strip()
-        p = PurePosixPath(s)
-        try:
-            rel = p.relative_to(PurePosixPath(IRODS_BASE))
-        except ValueError:
-            continue
-        folders.append(rel)
-
-    return folders
+    # Every collection below the root folder, relative to IRODS_BASE (DISCOVERY mode, see irods_source.py)
+    return make_source().discover(root_rel)
 
 def select_folders_for_download(folders: list[PurePosixPath]) -> list[PurePosixPath]:
     selected: list[PurePosixPath] = []
@@ -110,21 +173,9 @@ def select_folders_for_download(folders: list[PurePosixPath]) -> list[PurePosixP
 
 
 def iget(irods_path: str, local_path: Path) -> None:
-    """Download a collection from iRODS to local_path using iget."""
-    local_path.mkdir(parents=True, exist_ok=True)
-    # run the iget function in terminal using subprocess, together with the -r (progress) and -f (force) flags
-    result = subprocess.run(
-        ["iget", "-r", "-f", irods_path, str(local_path)],
-        capture_output=True,
-        text=True,
-    )
-    # Check if the command was successful, if not raise an error with the stderr output
-    if result.returncode != 0:
-        raise RuntimeError(
-            f"iget failed for {irods_path}\n"
-            f"stderr: {result.stderr.strip()}"
-        )
-    print(f"[iget] Downloaded {irods_path} -> {local_path}")
+    """Download a collection from iRODS to local_path using iget (see IrodsSource.fetch)."""
+    base, name = irods_path.rstrip("/").rsplit("/", 1)
+    IrodsSource(base).fetch(name, local_path)
 
 
 def cleanup_local(local_path: Path) -> None:
@@ -140,18 +191,34 @@ def cleanup_local(local_path: Path) -> None:
 # COMPUTATION  – replace / extend this with your actual analysis
 # ---------------------------------------------------------------------------
 
-def run_computation(local_folder: Path, output_folder: Path) -> None:
+def run_computation(local_folder: Path, output_folder: Path, client=None) -> None:
     """
     Run the full Minian CNMF pipeline on the downloaded session folder,
     then run the post-processing scripts (convert_to_csv, plotting, map).
     local_folder is the Path to the downloaded data on /scratch.
+    client is an optional pooled Dask Client; if None the pipeline starts its own cluster.
     """
     print(f"[compute] Starting Minian pipeline on {local_folder} ...")
-    pipeline.run_pipeline(str(local_folder), output_dir=str(output_folder))
+    pipeline.run_pipeline(
+        str(local_folder),
+        output_dir=str(output_folder),
+        client=client,
+        cluster_size=CLUSTER_SIZE,
+        compute_only=COMPUTE_ONLY,
+    )
     print(f"[compute] Pipeline finished for {local_folder}")
 
 
 
+def batch_param_hash() -> str:
+    """Hash of everything that changes the outputs of a session."""
+    # Cache location and rechunk memory do not change the results (not hashed by the pipeline either)
+    params = {
+        k: v for k, v in pipeline.default_params().items() if k not in ("param_ingest", "param_rechunk")
+    }
+    return pipeline.param_hash({"params": params, "compute_only": COMPUTE_ONLY})
+
+
 # ---------------------------------------------------------------------------
 # MAIN LOOP
 # ---------------------------------------------------------------------------
@@ -166,29 +233,99 @@ def main():
         print(f"[info] No matching folders found under {FOLDER_LIST}")
         return
 
-    print(f"[info] Found {len(dwnld_folders)} folder(s) to process")
+    print(f"[info] Found {len(dwnld_folders)} folder(s)")
 
+    source = make_source()
+    manifest = BatchManifest(str(OUTPUT_BASE / BATCH_MANIFEST_NAME))
+    run_hash = batch_param_hash()
+    inputs: dict[PurePosixPath, tuple[str | None, list]] = {}
     for folder_name in dwnld_folders:
-        irods_path = f"{IRODS_BASE}/{folder_name.as_posix()}"
-        local_folder = SCRATCH_BASE / Path(*folder_name.parts)
-        output_folder = OUTPUT_BASE / folder_name.name
-        output_folder.mkdir(parents=True, exist_ok=True)
-
-        print(f"\n{'='*60}")
-        print(f"Processing folder: {folder_name}")
-        print(f"Output folder: {output_folder}")
-        print(f"{'='*60}")
-
         try:
-            iget(irods_path, local_folder)
-            run_computation(local_folder, output_folder)
+            files = source.selected_files(folder_name)
+            in_hash = input_hash(files)
+            reason = manifest.needs_run(
+                folder_name.as_posix(), in_hash, run_hash, str(OUTPUT_BASE / folder_name.name)
+            )
         except Exception as e:
-            print(f"[ERROR] {folder_name}: {e}")
-        finally:
-            # Always clean up local scratch, even if computation failed
-            cleanup_local(local_folder)
+            files, in_hash, reason = [], None, f"listing failed: {e}"
+        if reason is None and RESUME_BATCH:
+            print(f"[skip] {folder_name}: complete in the batch manifest")
+            continue
+        print(f"[todo] {folder_name}: {reason or 'rerun requested'}")
+        inputs[folder_name] = (in_hash, files)
+    dwnld_folders = list(inputs)
+    if not dwnld_folders:
+        print("[done] Nothing to process; every session is complete.")
+        return
 
-    print("\n[done] All folders processed.")
+    print(f"[info] {len(dwnld_folders)} folder(s) to process")
+
+    cluster, client = None, None
+    if REUSE_CLUSTER:
+        cluster_kwargs = {}
+        if CLUSTER_SIZE == "auto":
+            # Sessions are not downloaded yet, so size from the job's resources only
+            plan = pipeline.plan_cluster()
+            cluster_kwargs = {k: plan[k] for k in ("n_workers", "threads_per_worker", "memory_limit")}
+        cluster, client = pipeline.start_cluster(**cluster_kwargs)
+    try:
+        _process_folders(dwnld_folders, client, source, manifest, inputs, run_hash)
+    finally:
+        if cluster is not None:
+            client.close()
+            cluster.close()
+
+    print(f"\n[done] All folders processed. Batch manifest: {manifest.summary()}")
+
+
+def _process_folders(
+    dwnld_folders: list[PurePosixPath],
+    client,
+    source,
+    manifest: BatchManifest,
+    inputs: dict,
+    run_hash: str,
+) -> None:
+
+    def local_folder_of(folder_name: PurePosixPath) -> Path:
+        return SCRATCH_BASE / Path(*folder_name.parts)
+
+    budget = parse_bytes(SCRATCH_BUDGET) if isinstance(SCRATCH_BUDGET, str) else SCRATCH_BUDGET
+    prefetcher = Prefetcher(
+        dwnld_folders,
+        fetch=lambda folder_name: source.fetch(folder_name, local_folder_of(folder_name)),
+        size=source.size if budget is not None else None,
+        # Always clean up local scratch, even if computation failed
+        cleanup=lambda folder_name: cleanup_local(local_folder_of(folder_name)),
+        budget_bytes=budget,
+        depth=PREFETCH_DEPTH,
+    )
+    with prefetcher:
+        for i, (folder_name, download_error) in enumerate(prefetcher):
+            local_folder = local_folder_of(folder_name)
+            output_folder = OUTPUT_BASE / folder_name.name
+            output_folder.mkdir(parents=True, exist_ok=True)
+
+            print(f"\n{'='*60}")
+            print(f"Processing folder: {folder_name}")
+            print(f"Output folder: {output_folder}")
+            print(f"{'='*60}")
+
+            in_hash, files = inputs[folder_name]
+            manifest.mark_running(folder_name.as_posix(), in_hash, files, run_hash)
+            try:
+                if download_error is not None:
+                    raise download_error
+                run_computation(local_folder, output_folder, client=client)
+                manifest.mark_done(folder_name.as_posix(), str(output_folder))
+            except Exception as e:
+                print(f"[ERROR] {folder_name}: {e}")
+                manifest.mark_failed(folder_name.as_posix(), str(e))
+            finally:
+                prefetcher.release(folder_name)
+                # Fresh worker memory for the next session, without a cluster teardown
+                if client is not None and i < len(dwnld_folders) - 1:
+                    pipeline.restart_workers(client)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+"""
+Prefetching download scheduler
+------------------------------
+Downloads upcoming sessions in a background thread while the current one is
+computed, so the node does not sit idle during transfers.
+
+Two limits decide when the next download may start:
+    depth         at most `depth` sessions are downloaded ahead of the one being
+                  computed (0: download only once the previous one is released)
+    budget_bytes  the sessions on /scratch (computing, downloaded, downloading)
+                  may hold at most this many bytes together; a single session
+                  larger than the budget is still fetched once nothing else is held
+
+Sessions are handed out in order. A failed download is handed out with its
+error instead of stopping the batch.
+
+Usage
+-----
+    with Prefetcher(folders, fetch=..., size=..., cleanup=..., budget_bytes=200 * 1024**3) as prefetcher:
+        for folder, error in prefetcher:
+            try:
+                if error is not None:
+                    raise error
+                ...  # compute
+            finally:
+                prefetcher.release(folder)   # cleanup + frees its budget
+"""
+
+import threading
+import time
+from typing import Callable, Iterable
+
+
+class Prefetcher:
+    """
+    Parameters
+    ----------
+    items : iterable
+        Sessions in processing order.
+    fetch : callable(item)
+        Downloads one session (runs in the background thread).
+    size : callable(item) -> int | None
+        Bytes the session will take on /scratch; needed for budget_bytes.
+    cleanup : callable(item) | None
+        Removes the local copy; called by release().
+    budget_bytes : int | None
+        Scratch budget (None: unlimited).
+    depth : int
+        Sessions downloaded ahead of the one being computed.
+    """
+
+    def __init__(
+        self,
+        items: Iterable,
+        fetch: Callable,
+        size: Callable | None = None,
+        cleanup: Callable | None = None,
+        budget_bytes: int | None = None,
+        depth: int = 1,
+    ):
+        self.items = list(items)
+        self.fetch = fetch
+        self.size = size
+        self.cleanup = cleanup
+        self.budget_bytes = budget_bytes
+        self.depth = max(int(depth), 0)
+
+        self._cond = threading.Condition()
+        self._sizes: dict[int, int] = {}
+        self._done: dict[int, BaseException | None] = {}
+        self._held = 0
+        self._released = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._worker, name="prefetch", daemon=True)
+
+    # -- background thread ---------------------------------------------------
+
+    def _may_start(self, idx: int, size: int) -> bool:
+        if self._closed:
+            return True
+        if idx > self._released + self.depth:
+            return False
+        if self.budget_bytes is None or self._held == 0:
+            return True
+        return self._held + size <= self.budget_bytes
+
+    def _worker(self) -> None:
+        for idx, item in enumerate(self.items):
+            try:
+                size = int(self.size(item) or 0) if self.size is not None else 0
+            except Exception as exc:
+                print(f"[prefetch] WARNING: could not size {item}: {exc}")
+                size = 0
+            with self._cond:
+                self._cond.wait_for(lambda: self._may_start(idx, size))
+                if self._closed:
+                    return
+                if self.budget_bytes is not None and size > self.budget_bytes:
+                    print(
+                        f"[prefetch] WARNING: {item} ({size / 1024**3:.1f} GB) exceeds the "
+                        f"scratch budget ({self.budget_bytes / 1024**3:.1f} GB); fetching it alone"
+                    )
+                self._held += size
+                self._sizes[idx] = size
+                held = self._held
+
+            print(f"[prefetch] Downloading {item} ({size / 1024**3:.2f} GB, {held / 1024**3:.2f} GB held)")
+            start = time.time()
+            error = None
+            try:
+                self.fetch(item)
+            except Exception as exc:
+                error = exc
+                print(f"[prefetch] ERROR: download of {item} failed: {exc}")
+            else:
+                wall = time.time() - start
+                print(f"[prefetch] {item} ready after {wall:.1f}s ({size / 1024**2 / max(wall, 1e-9):.1f} MB/s)")
+            with self._cond:
+                self._done[idx] = error
+                self._cond.notify_all()
+
+    # -- consumer side -------------------------------------------------------
+
+    def __enter__(self) -> "Prefetcher":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        # Sessions downloaded ahead but never processed (the loop was left early)
+        if self.cleanup is not None:
+            for idx in sorted(self._sizes):
+                self.cleanup(self.items[idx])
+
+    def __iter__(self):
+        for idx, item in enumerate(self.items):
+            start = time.time()
+            with self._cond:
+                self._cond.wait_for(lambda: idx in self._done)
+                error = self._done[idx]
+            waited = time.time() - start
+            if waited > 1:
+                print(f"[prefetch] Waited {waited:.1f}s for {item}")
+            yield item, error
+
+    def release(self, item) -> None:
+        """Remove the local copy of `item` (the current session) and free its budget."""
+        idx = self._released
+        if self.items[idx] != item:
+            raise ValueError(f"release({item}) out of order; expected {self.items[idx]}")
+        if self.cleanup is not None:
+            self.cleanup(item)
+        with self._cond:
+            self._held -= self._sizes.pop(idx, 0)
+            self._released += 1
+            self._cond.notify_all()
@@ -0,0 +1,13 @@
+"""
+The Scripts/ folders are not packages: their modules import each other by
+plain name (e.g. `from intermediate_store import ...`), so put them on sys.path.
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ("Scripts/Minian_data", "Scripts/RDMS_data"):
+    path = os.path.join(ROOT, *folder.split("/"))
+    if path not in sys.path:
+        sys.path.insert(0, path)
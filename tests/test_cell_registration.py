@@ -0,0 +1,57 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+pytest.importorskip("pandas")
+pytest.importorskip("scipy")
+pytest.importorskip("zarr")
+cv2 = pytest.importorskip("cv2")
+
+from cell_registration import register_sessions  # noqa: E402
+
+SIZE = 64
+SHIFT = (3, -2)  # field of view of the second session, relative to the first
+CELLS = {10: (15, 15), 11: (15, 45), 12: (45, 15), 13: (45, 45)}
+NEW_CELL = (30, 30)
+
+
+def _cell(centre) -> np.ndarray:
+    hh, ww = np.mgrid[:SIZE, :SIZE]
+    fp = np.exp(-((hh - centre[0]) ** 2 + (ww - centre[1]) ** 2) / (2 * 2.0**2))
+    return np.where(fp > 0.05, fp, 0)
+
+
+def _write_session(path, unit_ids, footprints, background):
+    minian = path / "minian"
+    minian.mkdir(parents=True)
+    coords = {"height": np.arange(SIZE), "width": np.arange(SIZE)}
+    A = xr.DataArray(
+        np.stack(footprints), dims=("unit_id", "height", "width"), coords={"unit_id": unit_ids, **coords}, name="A"
+    )
+    A.to_dataset().to_zarr(str(minian / "A.zarr"))
+    max_proj = xr.DataArray(background + A.sum("unit_id").values * 50, dims=("height", "width"), coords=coords)
+    max_proj.rename("max_proj").to_dataset().to_zarr(str(minian / "max_proj.zarr"))
+    return str(path)
+
+
+def test_two_sessions_match_shifted_cells(tmp_path):
+    background = cv2.GaussianBlur(np.random.default_rng(0).random((SIZE, SIZE)), (0, 0), 3) * 100
+
+    first = _write_session(tmp_path / "T1", list(CELLS), [_cell(c) for c in CELLS.values()], background)
+    # Second session: the whole field of view moved by SHIFT, cell 12 lost, one new cell,
+    # and unit ids assigned in another order
+    moved = {uid: np.roll(_cell(c), SHIFT, axis=(0, 1)) for uid, c in CELLS.items() if uid != 12}
+    second_ids = [7, 3, 5, 1]
+    second_fps = [moved[13], moved[10], np.roll(_cell(NEW_CELL), SHIFT, axis=(0, 1)), moved[11]]
+    second = _write_session(
+        tmp_path / "T2", second_ids, second_fps, np.roll(background, SHIFT, axis=(0, 1))
+    )
+
+    table = register_sessions([first, second])
+
+    pairs = {
+        (None if np.isnan(a) else int(a), None if np.isnan(b) else int(b))
+        for a, b in table[["T1", "T2"]].astype(float).itertuples(index=False)
+    }
+    assert pairs == {(10, 3), (11, 1), (13, 7), (12, None), (None, 5)}
+    assert sorted(table["n_sessions"]) == [1, 1, 2, 2, 2]
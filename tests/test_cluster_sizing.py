@@ -0,0 +1,14 @@
+import pytest
+
+pytest.importorskip("dask")
+from dask.utils import parse_bytes  # noqa: E402
+
+from cluster_sizing import GB, plan_cluster  # noqa: E402
+
+
+@pytest.mark.parametrize("cpus, memory", [(32, 128 * GB), (8, 16 * GB), (4, 3 * GB), (2, int(1.5 * GB))])
+def test_workers_fit_in_the_node(cpus, memory):
+    plan = plan_cluster(cpus=cpus, memory=memory)
+    assert plan["memory_limit"].endswith("GiB")
+    assert plan["n_workers"] >= 1
+    assert plan["n_workers"] * parse_bytes(plan["memory_limit"]) <= memory
@@ -0,0 +1,54 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+cv2 = pytest.importorskip("cv2")
+
+from coarse_to_fine import _refine_block  # noqa: E402
+
+SIZE = 64
+N_FRAMES = 40
+STEP = (3, -2)  # (height, width) shift of the second half of the movie, in pixels
+
+
+def _texture() -> np.ndarray:
+    smooth = cv2.GaussianBlur(np.random.default_rng(0).random((SIZE, SIZE)), (0, 0), 2)
+    return (smooth - smooth.min()) / (smooth.max() - smooth.min()) * 255
+
+
+def _shifted_movie() -> xr.DataArray:
+    template = _texture()
+    half = N_FRAMES // 2
+    frames = np.stack([template] * half + [np.roll(template, STEP, axis=(0, 1))] * (N_FRAMES - half))
+    return xr.DataArray(
+        frames,
+        dims=("frame", "height", "width"),
+        coords={"frame": np.arange(N_FRAMES), "height": np.arange(SIZE), "width": np.arange(SIZE)},
+        name="varr",
+    ).chunk({"frame": 10})
+
+
+def test_refine_returns_the_shift_that_undoes_the_motion():
+    template = _texture()
+    frame = np.roll(template, (2, -3), axis=(0, 1))
+    (residual,) = _refine_block(frame[None], np.fft.fft2(template), radius=4)
+    np.testing.assert_allclose(residual, [-2, 3], atol=0.05)
+
+
+def test_coarse_to_fine_matches_estimate_motion():
+    pytest.importorskip("minian")
+    from coarse_to_fine import compare_motion, estimate_motion_c2f
+    from minian.motion_correction import estimate_motion
+
+    varr = _shifted_movie()
+    c2f = estimate_motion_c2f(varr, spatial_factor=2, temporal_bin=5, dim="frame")
+    full = estimate_motion(varr, dim="frame").compute()
+
+    half = N_FRAMES // 2
+    for step, dim in zip(STEP, ("height", "width")):
+        # Shift between the two halves: the known step, with Minian's sign
+        moved_c2f = np.median(c2f.sel(shift_dim=dim)[half:]) - np.median(c2f.sel(shift_dim=dim)[:half])
+        moved_full = np.median(full.sel(shift_dim=dim)[half:]) - np.median(full.sel(shift_dim=dim)[:half])
+        assert moved_c2f == pytest.approx(-step, abs=0.25)
+        assert np.sign(moved_c2f) == np.sign(moved_full)
+    assert all(r["rms_px"] < 0.5 for r in compare_motion(c2f, full).values())
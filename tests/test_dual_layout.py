@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+pytest.importorskip("zarr")
+pytest.importorskip("dask")
+
+from dual_layout import write_dual_layout  # noqa: E402
+
+SHAPE = (10, 13, 17)  # neither the frames nor the tiles divide the movie evenly
+TILE = {"height": 5, "width": 6}
+
+
+@pytest.mark.parametrize("per_batch", [1, 2, 4, 100])
+def test_hw_layout_equals_fm_layout(tmp_path, per_batch):
+    Y = xr.DataArray(
+        np.random.default_rng(1).random(SHAPE),
+        dims=("frame", "height", "width"),
+        coords={dim: np.arange(n) for dim, n in zip(("frame", "height", "width"), SHAPE)},
+    ).chunk({"frame": 4})
+    fm_path, hw_path = str(tmp_path / "Y_fm_chk.zarr"), str(tmp_path / "Y_hw_chk.zarr")
+    tile_bytes = SHAPE[0] * TILE["height"] * TILE["width"] * 8
+
+    write_dual_layout(Y, fm_path, hw_path, TILE, memory_budget=per_batch * tile_bytes)
+
+    Y_fm = xr.open_zarr(fm_path)["Y_fm_chk"]
+    Y_hw = xr.open_zarr(hw_path)["Y_hw_chk"]
+    assert Y_hw.chunks == ((10,), (5, 5, 3), (6, 6, 5))
+    xr.testing.assert_equal(Y_hw.rename("Y_fm_chk").compute(), Y_fm.compute())
+    xr.testing.assert_equal(Y_fm.compute(), Y.rename("Y_fm_chk").compute())
+    # The split copy is gone once every tile is consolidated
+    assert sorted(os.listdir(tmp_path)) == ["Y_fm_chk.zarr", "Y_hw_chk.zarr"]
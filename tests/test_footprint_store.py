@@ -0,0 +1,28 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+
+from footprint_store import SparseFootprints, save_sparse_footprints  # noqa: E402
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_sparse_footprints_round_trip_keeps_values_and_dtype(tmp_path, dtype):
+    rng = np.random.default_rng(0)
+    A = np.zeros((3, 10, 12), dtype=dtype)
+    A[0, 1:4, 2:6] = rng.random((3, 4))
+    A[1, 5:9, 0:3] = rng.random((4, 3))
+    A = xr.DataArray(
+        A,
+        dims=("unit_id", "height", "width"),
+        coords={"unit_id": [4, 7, 9], "height": np.arange(10), "width": np.arange(12)},
+        name="A",
+    )
+
+    store = SparseFootprints(save_sparse_footprints(A, str(tmp_path / "A_sparse")))
+    dense = store.to_dense()
+
+    assert dense.dtype == dtype
+    np.testing.assert_array_equal(dense.values, A.values)
+    assert store.footprint(7).shape == (4, 3)
+    np.testing.assert_array_equal(store.footprint(9, dense=True).values, 0)
@@ -0,0 +1,39 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+pytest.importorskip("cv2")
+pytest.importorskip("scipy")
+pytest.importorskip("skimage")
+
+from fused_preprocessing import fused_preprocess, fused_supported  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "param_denoise, param_background_removal",
+    [
+        ({"method": "median", "ksize": 7}, {"method": "tophat", "wnd": 15}),
+        ({"method": "gaussian", "ksize": (5, 5), "sigmaX": 1.5}, {"method": "uniform", "wnd": 9}),
+    ],
+)
+def test_fused_pass_matches_minian_steps(param_denoise, param_background_removal):
+    pytest.importorskip("minian")
+    from minian.preprocessing import denoise, remove_background
+
+    rng = np.random.default_rng(0)
+    varr = xr.DataArray(
+        (rng.random((12, 32, 40)) * 200 + np.linspace(0, 50, 40)).astype(np.uint8),
+        dims=("frame", "height", "width"),
+        coords={"frame": np.arange(12), "height": np.arange(32), "width": np.arange(40)},
+        name="varr",
+    ).chunk({"frame": 5})
+    varr_min = varr.min("frame").compute()
+    assert fused_supported(param_denoise, param_background_removal)
+
+    sequential = varr - varr_min
+    sequential = denoise(sequential, **param_denoise)
+    sequential = remove_background(sequential, **param_background_removal)
+    fused = fused_preprocess(varr, varr_min, param_denoise, param_background_removal)
+
+    assert fused.dtype == sequential.dtype
+    np.testing.assert_array_equal(fused.compute().values, sequential.compute().values)
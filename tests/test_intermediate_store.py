@@ -0,0 +1,54 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+zarr = pytest.importorskip("zarr")
+pytest.importorskip("distributed")
+
+from dual_layout import write_dual_layout  # noqa: E402
+from intermediate_store import IntermediateStore  # noqa: E402
+
+FORMATS = [2, 3] if int(zarr.__version__.split(".")[0]) >= 3 else [2]
+
+
+def _codec_config(path: str, name: str) -> dict:
+    """cname / clevel of the single compressor zarr recorded for array `name`."""
+    (codec,) = zarr.open_group(path, mode="r")[name].compressors
+    if hasattr(codec, "to_dict"):  # zarr 3 codec
+        config = codec.to_dict()["configuration"]
+        return {"cname": str(getattr(config["cname"], "value", config["cname"])), "clevel": config["clevel"]}
+    config = codec.get_config()  # numcodecs codec (zarr format 2)
+    return {"cname": config["cname"], "clevel": config["clevel"]}
+
+
+def _movie() -> xr.DataArray:
+    return xr.DataArray(
+        np.random.default_rng(0).random((8, 12, 16)).astype(np.float32),
+        dims=("frame", "height", "width"),
+        coords={"frame": np.arange(8), "height": np.arange(12), "width": np.arange(16)},
+    ).chunk({"frame": 4})
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_prepare_compressor_reaches_the_store(tmp_path, fmt):
+    with zarr.config.set({"default_zarr_format": fmt}):
+        store = IntermediateStore(str(tmp_path / "intermediate"), compressor="zstd:5")
+        arr = store.prepare(_movie().rename("Y"))
+        arr.to_dataset().to_zarr(str(tmp_path / "Y.zarr"), mode="w")
+
+    assert _codec_config(str(tmp_path / "Y.zarr"), "Y") == {"cname": "zstd", "clevel": 5}
+
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_dual_layout_compressor_reaches_both_stores(tmp_path, fmt):
+    fm_path, hw_path = str(tmp_path / "Y_fm_chk.zarr"), str(tmp_path / "Y_hw_chk.zarr")
+    with zarr.config.set({"default_zarr_format": fmt}):
+        store = IntermediateStore(str(tmp_path / "intermediate"), compressor="lz4:1")
+        write_dual_layout(
+            _movie(), fm_path, hw_path, {"height": 6, "width": 8}, memory_budget="1MB",
+            compressor=store.compressor,
+        )
+
+    assert _codec_config(fm_path, "Y_fm_chk") == {"cname": "lz4", "clevel": 1}
+    assert _codec_config(hw_path, "Y_hw_chk") == {"cname": "lz4", "clevel": 1}
+    np.testing.assert_array_equal(xr.open_zarr(hw_path)["Y_hw_chk"].values, _movie().values)
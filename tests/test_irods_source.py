@@ -0,0 +1,104 @@
+import os
+import sys
+
+import pytest
+
+from irods_source import IrodsSource
+
+FAKE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_icommands")
+BASE = "/zone/home/lab"
+OLD = 1_700_000_000  # collection mtime before a change
+
+
+@pytest.fixture
+def irods(tmp_path, monkeypatch):
+    """A fake iRODS tree under BASE and the log of the icommands called."""
+    if sys.platform.startswith("win"):
+        pytest.skip("the fake icommands are executable scripts")
+    root = tmp_path / "irods"
+    monkeypatch.setenv("FAKE_IRODS_ROOT", str(root))
+    monkeypatch.setenv("FAKE_IRODS_LOG", str(tmp_path / "calls.log"))
+    for session in ("Batch 1/24/24_T1", "Batch 1/24/24_T2", "Batch 1/25/25_T1"):
+        folder = root / BASE.lstrip("/") / session
+        folder.mkdir(parents=True)
+        (folder / "0.avi").write_bytes(b"x" * 100)
+        (folder / "timestamp.dat").write_bytes(b"t" * 10)
+    _touch_tree(root)
+    return root, tmp_path / "calls.log"
+
+
+def _touch_tree(root) -> None:
+    for dirpath, _, _ in os.walk(root):
+        os.utime(dirpath, (OLD, OLD))
+
+
+def _calls(log) -> list[str]:
+    if not log.exists():
+        return []
+    calls = log.read_text().splitlines()
+    log.unlink()
+    return calls
+
+
+def _source(tmp_path, discovery: str) -> IrodsSource:
+    return IrodsSource(
+        BASE,
+        ils=os.path.join(FAKE, "ils"),
+        iquest=os.path.join(FAKE, "iquest"),
+        discovery=discovery,
+        cache_path=str(tmp_path / "cache.json"),
+    )
+
+
+def test_all_discovery_modes_agree(irods, tmp_path):
+    results = {mode: sorted(_source(tmp_path, mode).discover("Batch 1")) for mode in ("ils", "query", "cached")}
+    assert results["ils"] == results["query"] == results["cached"]
+    assert len(results["cached"]) == 6  # Batch 1, 24, 25 and three sessions
+
+
+def test_cached_discovery_relists_only_changed_collections(irods, tmp_path):
+    root, log = irods
+    first = sorted(_source(tmp_path, "cached").discover("Batch 1"))
+    assert sum(call.startswith("ils") for call in _calls(log)) == len(first)
+
+    # Unchanged tree: the single catalog query and nothing else
+    assert sorted(_source(tmp_path, "cached").discover("Batch 1")) == first
+    assert [call.split()[0] for call in _calls(log)] == ["iquest"]
+
+    # A file added to one session bumps only that collection's time
+    session = root / BASE.lstrip("/") / "Batch 1/24/24_T2"
+    (session / "1.avi").write_bytes(b"y" * 50)
+    os.utime(session, (OLD + 60, OLD + 60))
+    source = _source(tmp_path, "cached")
+    assert sorted(source.discover("Batch 1")) == first
+    assert [call for call in _calls(log) if call.startswith("ils")] == [f"ils -l {BASE}/Batch 1/24/24_T2"]
+    assert source.size("Batch 1/24/24_T2") == 160
+
+
+def test_cached_discovery_finds_collections_under_unchanged_parents(irods, tmp_path):
+    root, log = irods
+    _source(tmp_path, "cached").discover("Batch 1")
+    _calls(log)
+
+    # New sub-collection whose parent keeps its modification time
+    new = root / BASE.lstrip("/") / "Batch 1/24/24_PostEx"
+    new.mkdir()
+    (new / "0.avi").write_bytes(b"z" * 30)
+    os.utime(new.parent, (OLD, OLD))
+
+    found = _source(tmp_path, "cached").discover("Batch 1")
+    assert "Batch 1/24/24_PostEx" in {str(rel) for rel in found}
+    assert [call for call in _calls(log) if call.startswith("ils")] == [f"ils -l {BASE}/Batch 1/24/24_PostEx"]
+
+
+def test_cached_list_files_matches_ils(irods, tmp_path):
+    cached = _source(tmp_path, "cached")
+    cached.discover("Batch 1")
+    listed = _source(tmp_path, "ils")
+    for rel in ("Batch 1", "Batch 1/24", "Batch 1/25/25_T1"):
+        assert sorted(cached.list_files(rel)) == sorted(listed.list_files(rel))
+
+
+def test_missing_root_is_reported(irods, tmp_path):
+    with pytest.raises(RuntimeError, match="not found"):
+        _source(tmp_path, "cached").discover("Batch 9")
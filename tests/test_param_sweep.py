@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("xarray")
+pytest.importorskip("distributed")
+pytest.importorskip("dask")
+
+import param_sweep  # noqa: E402
+
+
+def test_sweepable_params_are_the_cnmf_stages_only():
+    assert param_sweep.sweepable_params() == {
+        "param_first_spatial",
+        "param_first_temporal",
+        "param_first_merge",
+        "param_second_spatial",
+        "param_second_temporal",
+    }
+
+
+@pytest.mark.parametrize("key", ["subset", "param_footprint_format", "param_postprocessing", "param_get_noise"])
+def test_run_sweep_rejects_other_parameters(tmp_path, key):
+    with pytest.raises(ValueError, match=key):
+        param_sweep.run_sweep(str(tmp_path), [{"name": "bad", key: None}], output_root=str(tmp_path / "sweep"))
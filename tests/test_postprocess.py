@@ -0,0 +1,34 @@
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+xr = pytest.importorskip("xarray")
+
+import postprocess  # noqa: E402
+
+
+def _traces() -> xr.DataArray:
+    return xr.DataArray(
+        np.random.default_rng(0).random((2, 50)),
+        dims=("unit_id", "frame"),
+        coords={"unit_id": [3, 1], "frame": np.arange(50)},
+        name="C",
+    )
+
+
+def test_broken_binarize_script_only_fails_its_steps(tmp_path, monkeypatch):
+    def load_script(name):
+        raise ImportError(f"cannot load {name}")
+
+    monkeypatch.setattr(postprocess, "_load_script", load_script)
+    report = postprocess.postprocess(_traces(), str(tmp_path), str(tmp_path), formats=("csv",))
+
+    assert report["traces"]["status"] == "ok"
+    assert report["export_csv"]["status"] == "ok"
+    assert report["binarize"]["status"] == "failed"
+    assert report["figure"]["status"] == "skipped"
+    assert list(pd.read_csv(tmp_path / "C.csv").columns) == ["frame", "cell_1", "cell_3"]
+    with open(tmp_path / postprocess.REPORT_NAME) as fh:
+        assert json.load(fh) == report
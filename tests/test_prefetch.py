@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+
+from prefetch import Prefetcher
+
+
+class SlowSource:
+    """Fake download source: every fetch takes `delay` seconds and records what is held."""
+
+    def __init__(self, sizes: dict, delay: float = 0.01, fail: tuple = ()):
+        self.sizes = sizes
+        self.delay = delay
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+        self.held: list = []  # fetched or being fetched, not yet cleaned up
+        self.released = 0
+        self.max_ahead = 0
+        self.max_bytes = 0
+        self.fetched: list = []
+
+    def fetch(self, item):
+        with self.lock:
+            self.held.append(item)
+            order = list(self.sizes).index(item)
+            # the session being computed counts as released - 1
+            self.max_ahead = max(self.max_ahead, order - self.released)
+            self.max_bytes = max(self.max_bytes, sum(self.sizes[i] for i in self.held))
+        time.sleep(self.delay)
+        with self.lock:
+            self.fetched.append(item)
+        if item in self.fail:
+            raise RuntimeError(f"download of {item} failed")
+
+    def cleanup(self, item):
+        with self.lock:
+            if item in self.held:
+                self.held.remove(item)
+
+    def size(self, item):
+        return self.sizes[item]
+
+
+def _consume(prefetcher: Prefetcher, source: SlowSource, work: float = 0.05) -> list:
+    seen = []
+    for item, error in prefetcher:
+        seen.append((item, error))
+        time.sleep(work)  # compute while the next one downloads
+        with source.lock:
+            source.released += 1
+        prefetcher.release(item)
+    return seen
+
+
+@pytest.mark.parametrize("depth", [0, 1, 2])
+def test_depth_is_respected(depth):
+    source = SlowSource({f"s{i}": 1 for i in range(6)})
+    with Prefetcher(source.sizes, source.fetch, source.size, source.cleanup, depth=depth) as prefetcher:
+        seen = _consume(prefetcher, source)
+
+    assert [item for item, _ in seen] == list(source.sizes)
+    assert all(error is None for _, error in seen)
+    assert source.max_ahead == depth
+    assert source.held == []
+
+
+def test_byte_budget_is_respected():
+    sizes = {"a": 40, "b": 50, "c": 30, "d": 60, "e": 10}
+    source = SlowSource(sizes)
+    with Prefetcher(sizes, source.fetch, source.size, source.cleanup, budget_bytes=100, depth=4) as prefetcher:
+        seen = _consume(prefetcher, source)
+
+    assert [item for item, _ in seen] == list(sizes)
+    assert source.max_bytes <= 100
+    assert source.max_ahead >= 1  # the budget still allowed some prefetching
+
+
+def test_session_larger_than_the_budget_is_fetched_alone():
+    sizes = {"a": 10, "huge": 500, "b": 10}
+    source = SlowSource(sizes)
+    with Prefetcher(sizes, source.fetch, source.size, source.cleanup, budget_bytes=100, depth=2) as prefetcher:
+        seen = _consume(prefetcher, source)
+
+    assert [item for item, _ in seen] == list(sizes)
+    assert source.max_bytes == 500
+
+
+def test_download_errors_reach_the_consumer():
+    source = SlowSource({"a": 1, "b": 1, "c": 1}, fail=("b",))
+    with Prefetcher(source.sizes, source.fetch, source.size, source.cleanup) as prefetcher:
+        seen = dict(_consume(prefetcher, source))
+
+    assert seen["a"] is None and seen["c"] is None
+    assert isinstance(seen["b"], RuntimeError)
+    assert "download of b failed" in str(seen["b"])
+
+
+def test_leaving_early_cleans_up_prefetched_sessions():
+    source = SlowSource({f"s{i}": 1 for i in range(5)})
+    with Prefetcher(source.sizes, source.fetch, source.size, source.cleanup, depth=2) as prefetcher:
+        for item, _ in prefetcher:
+            time.sleep(0.1)  # let the next sessions arrive
+            break
+
+    assert len(source.fetched) < len(source.sizes)
+    assert source.held == []
+
+
+def test_release_out_of_order_is_rejected():
+    source = SlowSource({"a": 1, "b": 1})
+    with Prefetcher(source.sizes, source.fetch, source.size, source.cleanup) as prefetcher:
+        with pytest.raises(ValueError, match="out of order"):
+            prefetcher.release("b")
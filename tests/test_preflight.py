@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("distributed")
+
+import preflight  # noqa: E402
+
+GB = 1024**3
+VOXELS = 1000 * 100 * 100
+
+
+def _write_profile(path, stages, **meta):
+    path.mkdir(parents=True)
+    record = {
+        "meta": {"n_workers": 2, "threads_per_worker": 2, "input_voxels": VOXELS, **meta},
+        "stages": [
+            {"stage": name, "status": "ok", "wall_time_s": 10.0, "peak_rss_max_bytes": GB}
+            for name in stages
+        ],
+        "peak_scratch_bytes": 8 * VOXELS,
+    }
+    (path / preflight.PROFILE_NAME).write_text(json.dumps(record))
+
+
+@pytest.fixture
+def profiles(tmp_path):
+    _write_profile(tmp_path / "full", ["ingest", "initialization", "render"])
+    _write_profile(tmp_path / "handoff", ["ingest", "initialization", "render_handoff"])
+    _write_profile(tmp_path / "fixed", ["ingest", "footprint_init", "fixed_temporal", "render"])
+    _write_profile(tmp_path / "shared", ["ingest", "initialization", "render"], shared_cluster=True)
+    _write_profile(tmp_path / "full" / "preview", ["ingest", "initialization", "qa_bundle"])
+    return tmp_path
+
+
+def test_load_profiles_keeps_runs_in_the_requested_mode(profiles):
+    full = preflight.load_profiles([str(profiles)])
+    assert sorted(r["meta"].get("fixed_footprints", False) for r in full) == [False, False]
+    assert len(preflight.load_profiles([str(profiles)], fixed_footprints=True)) == 1
+
+
+def test_estimate_predicts_only_the_requested_stages(profiles, monkeypatch):
+    video = {"files": 1, "frames": 1000, "height": 100, "width": 100}
+    monkeypatch.setattr(preflight, "probe_videos", lambda dpath, pattern: video)
+    monkeypatch.setattr(
+        preflight,
+        "plan_cluster",
+        lambda *args, **kwargs: {"n_workers": 2, "threads_per_worker": 2, "memory_limit": "4.0GiB"},
+    )
+
+    est = preflight.estimate(
+        str(profiles),
+        [str(profiles)],
+        {"pattern": ".*", "downsample": {}},
+        cpus=4,
+        memory=16 * GB,
+        stages=["ingest", "initialization", "render"],
+    )
+
+    # render_handoff and the fixed-footprint stages are never added on top
+    assert list(est["stages"]) == ["ingest", "initialization", "render"]
+    assert est["calibration_runs"] == 2
+    assert est["runtime_s"] == pytest.approx(30.0)
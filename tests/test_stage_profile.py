@@ -0,0 +1,36 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("distributed")
+
+from stage_profile import StageProfiler  # noqa: E402
+
+
+def _store(path, size):
+    path.mkdir(parents=True)
+    (path / "0.0").write_bytes(b"x" * size)
+    return str(path)
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_stage_counts_only_the_stores_it_wrote(tmp_path, shared):
+    ctx = SimpleNamespace(
+        paths={
+            "varr": _store(tmp_path / "cache" / "varr.zarr", 5000),
+            "Y_fm_chk": _store(tmp_path / "stage" / "Y_fm_chk.zarr", 300),
+        },
+        written={"Y_fm_chk"},
+        shapes={},
+    )
+    # No client: the cluster probes fall back to zero / nothing
+    profiler = StageProfiler(None, str(tmp_path / "profile.json"), meta={"shared_cluster": shared}, interval=0.01)
+    with profiler.stage("preprocessing", ctx):
+        pass
+
+    with open(tmp_path / "profile.json") as fh:
+        (record,) = json.load(fh)["stages"]
+    assert record["stores_written_bytes"] == {"Y_fm_chk": 300}
+    assert record["total_store_bytes"] == 300
+    assert record["tasks"] == (None if shared else 0)
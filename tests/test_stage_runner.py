@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+pytest.importorskip("zarr")
+pytest.importorskip("distributed")
+
+from intermediate_store import IntermediateStore  # noqa: E402
+from stage_runner import Stage, StageContext, _run_stage  # noqa: E402
+
+META_DICT = dict(session=-1, animal=-2)
+
+
+def _traces() -> xr.DataArray:
+    return xr.DataArray(
+        np.random.default_rng(0).random((3, 20)).astype(np.float32),
+        dims=("unit_id", "frame"),
+        coords={"unit_id": np.arange(3), "frame": np.arange(20)},
+        name="C",
+    ).chunk({"unit_id": 1, "frame": 10})
+
+
+def test_promoted_meta_coords_match_save_minian(tmp_path):
+    pytest.importorskip("minian")
+    from minian.utilities import save_minian
+
+    session_dir = tmp_path / "animal_7" / "session_3"
+    out_dir = session_dir / "minian"
+    ref_dir = session_dir / "reference"
+    store = IntermediateStore(str(tmp_path / "intermediate"))
+    ctx = StageContext(
+        "finalize",
+        store,
+        str(session_dir),
+        str(tmp_path),
+        {},
+        {"dpath": str(out_dir), "meta_dict": META_DICT, "overwrite": True},
+    )
+    ctx.save(_traces())
+    ctx.var_paths = dict(ctx.paths)
+
+    promoted = ctx.promote_final("C")
+    reference = save_minian(_traces(), str(ref_dir), meta_dict=META_DICT, overwrite=True)
+
+    assert promoted is not None
+    assert not os.path.exists(ctx.var_paths["C"])
+    assert promoted.coords["session"].item() == "session_3"
+    assert promoted.coords["animal"].item() == "animal_7"
+    xr.testing.assert_identical(promoted.load(), reference.load())
+
+
+@pytest.mark.parametrize("disk_frames, rewritten", [(8, False), (32, True)])
+def test_oom_retry_reads_inputs_in_smaller_chunks(tmp_path, disk_frames, rewritten):
+    store = IntermediateStore(str(tmp_path / "intermediate"))
+    path = os.path.join(store.stage_dir("previous"), "Y.zarr")
+    xr.DataArray(
+        np.arange(64 * 4, dtype=np.float32).reshape(64, 4),
+        dims=("frame", "unit_id"),
+        coords={"frame": np.arange(64), "unit_id": np.arange(4)},
+        name="Y",
+    ).chunk({"frame": disk_frames}).to_dataset().to_zarr(path, mode="w")
+    Y = xr.open_zarr(path, chunks={"frame": 32})["Y"]
+
+    seen = []
+
+    def flaky(ctx, state):
+        seen.append(state["Y"])
+        if len(seen) == 1:
+            raise MemoryError("simulated out-of-memory")
+        return {"total": float(state["Y"].sum().compute())}
+
+    def make_context(name):
+        return StageContext(name, store, str(tmp_path), str(tmp_path), {}, {"dpath": str(tmp_path / "minian")})
+
+    _, result = _run_stage(Stage("flaky", flaky, inputs=("Y",)), {"Y": Y}, make_context, {"Y": path}, None, 1)
+
+    assert len(seen) == 2
+    assert seen[0] is Y
+    retried = seen[1]
+    assert set(retried.chunks[0]) == {16}
+    assert retried.chunks[1] == (4,)
+    # Read from a store in the smaller chunks, not re-chunked after the read
+    assert not any(name.startswith("rechunk") for name in retried.data.dask.layers)
+    retry_store = os.path.join(store.stage_dir("flaky_retry1"), "Y.zarr")
+    assert os.path.isdir(retry_store) == rewritten
+    assert retried.encoding["chunks"][0] == (16 if rewritten else disk_frames)
+    assert result["total"] == float(Y.sum().compute())
@@ -0,0 +1,91 @@
+import json
+import os
+import shutil
+
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+pytest.importorskip("zarr")
+pytest.importorskip("distributed")
+
+import video_ingest  # noqa: E402
+from video_ingest import HASH_MEMO_NAME, INGEST_INFO_NAME, evict_cache, ingest_videos  # noqa: E402
+
+PATTERN = r"msCam[0-9]+\.avi$"
+FRAMES = (7, 5, 9)  # per file; the movie spans chunks shared by several files
+
+
+@pytest.fixture
+def session(tmp_path):
+    cv2 = pytest.importorskip("cv2")
+    dpath = tmp_path / "session"
+    dpath.mkdir()
+    rng = np.random.default_rng(0)
+    for i, n_frames in enumerate(FRAMES, start=1):
+        writer = cv2.VideoWriter(str(dpath / f"msCam{i}.avi"), cv2.VideoWriter_fourcc(*"FFV1"), 30, (16, 12))
+        for _ in range(n_frames):
+            gray = rng.integers(0, 255, (12, 16), dtype=np.uint8)
+            writer.write(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR))
+        writer.release()
+    return dpath
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    """Four frames per chunk, so files own some chunks and share others."""
+    utilities = pytest.importorskip("minian.utilities")
+    monkeypatch.setattr(utilities, "get_optimal_chk", lambda arr, dtype=None: ({"frame": 4}, None))
+
+
+@pytest.mark.parametrize("downsample", [dict(frame=1, height=2, width=2), dict(frame=2, height=3, width=1)])
+def test_ingest_matches_load_videos(session, tmp_path, small_chunks, downsample):
+    from minian.utilities import load_videos
+
+    params = {"pattern": PATTERN, "dtype": np.uint8, "downsample": downsample, "downsample_strategy": "subset"}
+    store_path = ingest_videos(str(session), params, str(tmp_path / "cache"), n_procs=3)
+
+    varr = xr.open_zarr(store_path)["varr"]
+    expected = load_videos(str(session), **params)
+    assert varr.chunks[0][0] == 4
+    xr.testing.assert_equal(varr.load(), expected.load().rename("varr"))
+    if downsample["frame"] == 1:
+        np.testing.assert_array_equal(video_ingest.load_min_projection(store_path), expected.min("frame").values)
+
+
+def test_cache_hit_survives_a_fresh_download(session, tmp_path):
+    pytest.importorskip("minian")
+    params = {"pattern": PATTERN, "dtype": np.uint8, "downsample": dict(frame=1, height=2, width=2)}
+    cache = tmp_path / "cache"
+    first = ingest_videos(str(session), params, str(cache), n_procs=2)
+    with open(cache / HASH_MEMO_NAME) as fh:
+        memo = json.load(fh)
+
+    # Same videos downloaded again: new paths and modification times
+    copy = tmp_path / "downloaded_again"
+    shutil.copytree(session, copy)
+    second = ingest_videos(str(copy), params, str(cache), n_procs=2)
+
+    # The copy is hashed in full and maps to the same cache entry
+    assert os.path.dirname(second) == os.path.dirname(first)
+    with open(cache / HASH_MEMO_NAME) as fh:
+        hashes = json.load(fh)
+    assert len(hashes) == 2 * len(memo)
+    assert sorted(hashes.values()) == sorted(list(memo.values()) * 2)
+
+
+def test_evict_cache_drops_least_recently_used_entries(tmp_path):
+    for age, name in enumerate(["newest", "middle", "oldest"]):
+        entry = tmp_path / name
+        entry.mkdir()
+        (entry / "data.bin").write_bytes(b"x" * 1000)
+        (entry / INGEST_INFO_NAME).write_text("{}")
+        stamp = 1_700_000_000 - age * 3600
+        os.utime(entry / INGEST_INFO_NAME, (stamp, stamp))
+    (tmp_path / "partial.tmp").mkdir()
+
+    freed = evict_cache(str(tmp_path), max_bytes=2100, keep=str(tmp_path / "oldest"))
+
+    assert sorted(os.listdir(tmp_path)) == ["newest", "oldest", "partial.tmp"]
+    assert freed == 1002
+    assert evict_cache(str(tmp_path), max_bytes=None) == 0